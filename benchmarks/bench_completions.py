@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Compare la transmission des résultats des threads vers le réacteur
+appel par appel (C{reactor.callFromThread}) et groupée
+(L{vigilo.correlator.completions.CompletionBuffer}) : nombre de
+réveils du réacteur par seconde et latence de transmission.
+
+Ce script doit être lancé depuis la racine du projet ::
+
+    python benchmarks/bench_completions.py [threads] [résultats par thread]
+"""
+
+from __future__ import print_function
+import sys
+import time
+import threading
+
+from twisted.internet import reactor
+
+from vigilo.correlator.completions import CompletionBuffer
+
+
+class Run(object):
+    def __init__(self, name, producers, count):
+        self.name = name
+        self.producers = producers
+        self.count = count
+        self.expected = producers * count
+        self.latencies = []
+        self.wakeups = 0
+        self.start = None
+        self.end = None
+
+    def delivered(self, produced_at):
+        self.latencies.append(time.time() - produced_at)
+        if len(self.latencies) == self.expected:
+            self.end = time.time()
+            reactor.stop()
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        duration = self.end - self.start
+        print("%-8s %10d %12.0f %12.0f %10.4f %10.4f" % (
+            self.name,
+            self.wakeups,
+            self.wakeups / duration,
+            self.expected / duration,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+        ))
+
+
+def bench(name, producers, count):
+    run = Run(name, producers, count)
+    real_call = reactor.callFromThread
+
+    def counting_call(func, *args):
+        run.wakeups += 1
+        return real_call(func, *args)
+
+    class CountingReactor(object):
+        callFromThread = staticmethod(counting_call)
+
+    if name == "direct":
+        call = counting_call
+    else:
+        call = CompletionBuffer(CountingReactor()).call_from_thread
+
+    def produce():
+        for _i in xrange(count):
+            call(run.delivered, time.time())
+
+    def start():
+        run.start = time.time()
+        for _i in xrange(producers):
+            threading.Thread(target=produce).start()
+
+    reactor.callWhenRunning(start)
+    reactor.run(installSignalHandlers=False)
+    return run
+
+
+def main(args):
+    producers = args and int(args[0]) or 4
+    count = len(args) > 1 and int(args[1]) or 50000
+    # Le réacteur de Twisted ne peut être démarré qu'une seule fois :
+    # chaque mode est mesuré dans un processus distinct.
+    mode = len(args) > 2 and args[2] or None
+    if mode:
+        bench(mode, producers, count).report()
+        return
+
+    import subprocess
+    print("%d threads x %d results" % (producers, count))
+    print("%-8s %10s %12s %12s %10s %10s" % (
+        "mode", "wakeups", "wakeups/s", "results/s", "p50 (ms)", "p99 (ms)"))
+    sys.stdout.flush()
+    for mode in ("direct", "batched"):
+        subprocess.call([sys.executable, __file__, str(producers),
+                         str(count), mode])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
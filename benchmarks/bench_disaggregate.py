@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Mesure le temps nécessaire au retour à la normale après une tempête
+d'alertes : un équipement central tombe, les alertes sur les C{N}
+équipements qui en dépendent sont agrégées dans son événement corrélé,
+puis l'équipement central redevient disponible, ce qui provoque la
+désagrégation (L{vigilo.correlator.correvent.CorrEventBuilder}).
+
+Ce script utilise la configuration des tests unitaires
+et doit être lancé depuis la racine du projet ::
+
+    python benchmarks/bench_disaggregate.py [taille ...]
+"""
+
+from __future__ import print_function
+import sys
+import time
+from datetime import datetime
+
+from mock import Mock
+
+from vigilo.correlator.test import helpers
+
+from vigilo.models.demo import functions
+from vigilo.models.session import DBSession
+from vigilo.models.tables import CorrEvent, StateName
+
+from vigilo.correlator.correvent import CorrEventBuilder
+from vigilo.correlator.db_thread import DummyDatabaseWrapper
+
+
+def prepare(size):
+    """
+    Crée un équipement central et C{size} équipements qui en dépendent
+    (la moitié d'entre eux ayant eux-mêmes un équipement dépendant),
+    tous en panne et agrégés dans l'événement corrélé du premier.
+    """
+    helpers.setup_db()
+    helpers.populate_statename()
+    root = functions.add_host(u'root')
+    root_event = functions.add_event(root, u'DOWN', u'DOWN')
+    events = [root_event]
+    for i in xrange(size):
+        host = functions.add_host(u'host%d' % i)
+        group = functions.add_dependency_group(host, None, u'topology', u'|')
+        functions.add_dependency(group, root, 1)
+        events.append(functions.add_event(host, u'UNREACHABLE', u'UNREACHABLE'))
+        if i % 2:
+            leaf = functions.add_host(u'leaf%d' % i)
+            group = functions.add_dependency_group(leaf, None,
+                                                   u'topology', u'|')
+            functions.add_dependency(group, host, 1)
+            functions.add_dependency(group, root, 2)
+            events.append(functions.add_event(leaf, u'UNREACHABLE',
+                                              u'UNREACHABLE'))
+    correvent = functions.add_correvent(events)
+    correvent.timestamp_active = datetime(2000, 1, 1)
+
+    # L'équipement central redevient disponible.
+    root_event.current_state = StateName.statename_to_value(u'UP')
+    DBSession.flush()
+    return root, root_event, len(events)
+
+
+def bench(size):
+    root, root_event, count = prepare(size)
+    factory = helpers.ContextStubFactory()
+    builder = CorrEventBuilder(Mock(), DummyDatabaseWrapper(True))
+    builder.context_factory = factory
+    ctx = factory(42)
+    ctx.set('raw_event_id', root_event.idevent)
+    ctx.set('idsupitem', root.idhost)
+    info_dictionary = {
+        'id': 42,
+        'host': root.name,
+        'service': u'',
+        'state': u'UP',
+        'message': u'UP',
+        'timestamp': datetime.utcnow(),
+    }
+
+    results = []
+    start = time.time()
+    d = builder.make_correvent(info_dictionary)
+    d.addBoth(results.append)
+    duration = time.time() - start
+
+    if not results or results[0] is None or \
+        not hasattr(results[0], 'idcorrevent'):
+        raise RuntimeError(results)
+    aggregates = DBSession.query(CorrEvent).count()
+    factory.reset()
+    helpers.teardown_db()
+    return count, aggregates, duration
+
+
+def main(args):
+    sizes = [int(arg) for arg in args] or [10, 500, 2000]
+    print("%10s %12s %12s" % ("events", "aggregates", "time (s)"))
+    for size in sizes:
+        count, aggregates, duration = bench(size)
+        print("%10d %12d %12.4f" % (count, aggregates, duration))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Mesure le temps nécessaire à la fusion de deux agrégats
+(L{vigilo.correlator.db_insertion.merge_aggregates})
+en fonction de la taille de l'agrégat source.
+
+Ce script utilise la configuration des tests unitaires
+et doit être lancé depuis la racine du projet ::
+
+    python benchmarks/bench_merge_aggregates.py [taille ...]
+"""
+
+from __future__ import print_function
+import sys
+import time
+
+from vigilo.correlator.test import helpers
+
+from vigilo.models.demo import functions
+from vigilo.models.session import DBSession
+
+from vigilo.correlator.db_insertion import merge_aggregates
+from vigilo.correlator.db_thread import DummyDatabaseWrapper
+
+
+def prepare(size):
+    """
+    Crée un agrégat source contenant C{size} événements
+    et un agrégat destination contenant un seul événement.
+    """
+    helpers.setup_db()
+    helpers.populate_statename()
+    host = functions.add_host(u'bench')
+    events = []
+    for i in xrange(size + 1):
+        service = functions.add_lowlevelservice(host, u'svc%d' % i)
+        events.append(functions.add_event(service, u'WARNING', u'WARNING'))
+    source = functions.add_correvent(events[:-1])
+    dest = functions.add_correvent(events[-1:])
+    DBSession.flush()
+    return source.idcorrevent, dest.idcorrevent
+
+
+def bench(size):
+    src, dest = prepare(size)
+    ctx = helpers.ContextStubFactory()(42)
+    results = []
+    start = time.time()
+    d = merge_aggregates(src, dest, DummyDatabaseWrapper(True), ctx)
+    d.addBoth(results.append)
+    duration = time.time() - start
+    helpers.ContextStubFactory().reset()
+    helpers.teardown_db()
+    moved = results and results[0] or []
+    if not isinstance(moved, list):
+        raise RuntimeError(moved)
+    return duration, len(moved)
+
+
+def main(args):
+    sizes = [int(arg) for arg in args] or [10, 1000, 10000]
+    print("%10s %10s %12s" % ("events", "moved", "time (s)"))
+    for size in sizes:
+        duration, moved = bench(size)
+        print("%10d %10d %12.4f" % (size, moved, duration))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
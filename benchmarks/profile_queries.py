@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Compare le temps passé côté Python dans la construction des requêtes SQL
+du corrélateur avec le temps passé dans leur exécution, avant (requêtes
+construites via l'ORM à chaque événement) et après (requêtes précompilées
+de L{vigilo.correlator.queries}).
+
+Ce script utilise la configuration des tests unitaires
+et doit être lancé depuis la racine du projet ::
+
+    python benchmarks/profile_queries.py [itérations]
+"""
+
+from __future__ import print_function
+import sys
+import time
+
+from sqlalchemy import not_, and_
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import literal
+
+from vigilo.correlator.test import helpers
+
+from vigilo.models.demo import functions
+from vigilo.models.session import DBSession
+from vigilo.models.tables import Event, CorrEvent, SupItem
+from vigilo.models.tables.secondary_tables import EVENTSAGGREGATE_TABLE
+
+from vigilo.correlator import queries
+
+
+def legacy_open_correvent(idsupitem, state_ok, state_up):
+    """Requête de _get_update_id / PriorityMaxRule avant précompilation."""
+    return DBSession.query(
+            CorrEvent.idcorrevent,
+            CorrEvent.priority,
+        ).join(
+            (Event, CorrEvent.idcause == Event.idevent),
+            (SupItem, SupItem.idsupitem == Event.idsupitem),
+        ).filter(SupItem.idsupitem == idsupitem
+        ).filter(
+            not_(and_(
+                Event.current_state.in_([state_ok, state_up]),
+                CorrEvent.ack == CorrEvent.ACK_CLOSED
+            ))
+        )
+
+
+def legacy_open_aggregate(idsupitem, state_ok, state_up):
+    """Requête de get_open_aggregate avant précompilation."""
+    return DBSession.query(
+            CorrEvent.idcorrevent
+        ).join(
+            (Event, CorrEvent.idcause == Event.idevent)
+        ).filter(not_(Event.current_state.in_([state_ok, state_up]))
+        ).filter(Event.idsupitem == idsupitem)
+
+
+def legacy_raw_event(idsupitem, state_ok, state_up):
+    """Requête de insert_event avant précompilation."""
+    event1 = DBSession.query(
+            Event,
+            literal(1).label("rank"),
+        ).join(
+            (CorrEvent, CorrEvent.idcause == Event.idevent),
+        ).filter(Event.idsupitem == idsupitem
+        ).filter(not_(and_(
+            Event.current_state.in_([state_ok, state_up]),
+            CorrEvent.ack == CorrEvent.ACK_CLOSED
+        )))
+    cause_event = aliased(Event)
+    found_event = aliased(Event)
+    event2 = DBSession.query(
+            found_event,
+            literal(2).label("rank"),
+        ).join(
+            (EVENTSAGGREGATE_TABLE,
+                EVENTSAGGREGATE_TABLE.c.idevent == found_event.idevent),
+            (CorrEvent,
+                CorrEvent.idcorrevent == EVENTSAGGREGATE_TABLE.c.idcorrevent),
+            (cause_event, cause_event.idevent == CorrEvent.idcause),
+        ).filter(found_event.idsupitem == idsupitem
+        ).filter(not_(and_(
+            cause_event.current_state.in_([state_ok, state_up]),
+            CorrEvent.ack == CorrEvent.ACK_CLOSED
+        )))
+    event3 = DBSession.query(
+            Event,
+            literal(3).label("rank"),
+        ).filter(Event.idsupitem == idsupitem
+        ).filter(~Event.idsupitem.in_(
+            DBSession.query(EVENTSAGGREGATE_TABLE.c.idevent))
+        ).filter(~Event.idsupitem.in_(
+            DBSession.query(CorrEvent.idcause)))
+    return event1.union_all(event2, event3).order_by("rank", Event.idevent
+                ).limit(2)
+
+
+def prepare():
+    helpers.setup_db()
+    helpers.populate_statename()
+    host = functions.add_host(u'profile')
+    service = functions.add_lowlevelservice(host, u'svc')
+    event = functions.add_event(service, u'WARNING', u'WARNING')
+    functions.add_correvent([event])
+    DBSession.flush()
+    return service.idsupitem
+
+
+def measure(func, iterations):
+    start = time.time()
+    for _i in xrange(iterations):
+        func()
+    return (time.time() - start) / iterations * 1000
+
+
+def main(args):
+    iterations = args and int(args[0]) or 1000
+    idsupitem = prepare()
+    params = queries.state_params()
+    dialect = DBSession.get_bind(clause=Event.__table__).dialect
+
+    cases = [
+        ("OPEN_CORREVENT", legacy_open_correvent, queries.OPEN_CORREVENT),
+        ("OPEN_AGGREGATE", legacy_open_aggregate, queries.OPEN_AGGREGATE),
+        ("RAW_EVENT_CANDIDATES", legacy_raw_event,
+            queries.RAW_EVENT_CANDIDATES),
+    ]
+
+    print("Average time per call (ms), %d iterations" % iterations)
+    print("%-22s %10s %10s %10s %10s" %
+          ("query", "build", "compile", "exec", "cached"))
+    for name, legacy, statement in cases:
+        def build():
+            return legacy(idsupitem, params['state_ok'], params['state_up'])
+        def compile_():
+            return build().statement.compile(dialect=dialect)
+        def execute():
+            return build().all()
+        def cached():
+            return queries.fetch_all(statement, idsupitem=idsupitem,
+                                     **params)
+        # Préchauffage (remplit notamment le cache de compilation).
+        cached()
+        t_build = measure(build, iterations)
+        t_compile = measure(compile_, iterations) - t_build
+        t_exec = measure(execute, iterations)
+        t_cached = measure(cached, iterations)
+        print("%-22s %10.4f %10.4f %10.4f %10.4f" %
+              (name, t_build, t_compile, t_exec, t_cached))
+
+    print()
+    print("build:   Python-side construction of the ORM Query (before)")
+    print("compile: SQL compilation of that Query (before)")
+    print("exec:    construction + compilation + execution (before)")
+    print("cached:  execution of the precompiled statement (after)")
+    helpers.teardown_db()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
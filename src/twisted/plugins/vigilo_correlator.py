@@ -12,6 +12,15 @@ from twisted.application import service
 
 from vigilo.connector import options as base_options
 
+class CorrelatorOptions(base_options.make_options('vigilo.correlator')):
+    """
+    Command-line options for the correlator.
+    """
+    optFlags = [
+        ["profile-startup", None, "Print the time spent importing each "
+                                  "module and in each startup phase."],
+    ]
+
 class CorrelatorServiceMaker(object):
     """
     Creates a service that wraps everything the correlator needs.
@@ -19,9 +28,13 @@ class CorrelatorServiceMaker(object):
     implements(service.IServiceMaker, IPlugin)
     tapname = "vigilo-correlator"
     description = "Vigilo correlator"
-    options = base_options.make_options('vigilo.correlator')
+    options = CorrelatorOptions
 
     def makeService(self, options):
+        if options.get("profile-startup"):
+            # Must be started before any other module gets imported.
+            from vigilo.correlator import profiling
+            profiling.start()
         from vigilo.correlator import makeService
         return makeService(options)
 
@@ -8,6 +8,7 @@ Corrélateur de Vigilo.
 import threading
 import os
 import signal
+import functools
 
 
 
@@ -18,10 +19,25 @@ def log_debug_info(*_args):
     logger.debug('threads: %s', threading.enumerate())
 
 
-def sighup_handler(*_args):
+def load_caches(database):
+    """
+    Charge (ou recharge) les caches en mémoire du corrélateur
+    à partir de la base de données.
+
+    @param database: Objet qui encapsule les échanges avec la base de données.
+    @type database: L{DatabaseWrapper}
+    @return: Deferred appelé une fois les caches chargés.
+    @rtype: L{defer.Deferred}
+    """
+    from vigilo.correlator.warmup import WarmUp
+    return WarmUp(database).run()
+
+
+def sighup_handler(database, *_args):
     """
     Definit une routine pour le traitement du signal SIGHUP (rechargement).
     """
+    from twisted.internet import reactor
     from vigilo.correlator.memcached_connection import MemcachedConnection
     from vigilo.common.logging import get_logger
     logger = get_logger(__name__)
@@ -32,8 +48,27 @@ def sighup_handler(*_args):
     conn.delete('vigilo:topology')
     logger.info(_(u"The topology has been reloaded."))
 
+    # Le gestionnaire de signal peut interrompre le réacteur
+    # à n'importe quel moment : le rechargement des caches
+    # est donc différé au prochain tour de boucle.
+    reactor.callFromThread(load_caches, database)
+
+
+def set_supervisor_signal_handlers(supervisor):
+    from vigilo.common.logging import get_logger
+    logger = get_logger(__name__)
+    from vigilo.common.gettext import translate
+    _ = translate(__name__)
+
+    # Le signal SIGHUP est transmis à chacun des processus.
+    try:
+        signal.signal(signal.SIGHUP, lambda *_args: supervisor.reload())
+    except ValueError:
+        logger.error(_(u'Could not set signal handlers. The correlator '
+                        'may not be able to shutdown cleanly'))
 
-def set_signal_handlers():
+
+def set_signal_handlers(database):
     from vigilo.common.logging import get_logger
     logger = get_logger(__name__)
     from vigilo.common.gettext import translate
@@ -48,7 +83,8 @@ def set_signal_handlers():
 
         # Le signal SIGHUP servira à recharger la topologie
         # (utilisé par les scripts d'ini lors d'un reload).
-        signal.signal(signal.SIGHUP, sighup_handler)
+        signal.signal(signal.SIGHUP,
+                      functools.partial(sighup_handler, database))
     except ValueError:
         logger.error(_(u'Could not set signal handlers. The correlator '
                         'may not be able to shutdown cleanly'))
@@ -57,15 +93,43 @@ def set_signal_handlers():
 
 def makeService(options):
     """Crée un service client du bus"""
+    # Profilage du démarrage (option --profile-startup).
+    from vigilo.correlator import profiling
+
     from vigilo.connector.options import getSettings
     settings = getSettings(options, __name__)
+    profiling.phase("settings")
 
     from twisted.internet import reactor
     from twisted.application import service
+    reactor.callWhenRunning(profiling.phase, "reactor started")
+
+    # Exécution sous la forme de plusieurs processus (optionnelle) :
+    # le processus courant se contente alors de les superviser.
+    from vigilo.correlator.supervisor import supervisor_factory, \
+                                             current_worker
+    supervisor = supervisor_factory(settings, options)
+    if supervisor is not None:
+        root_service = service.MultiService()
+        supervisor.setServiceParent(root_service)
+        reactor.addSystemEventTrigger('during', 'startup',
+                                      set_supervisor_signal_handlers,
+                                      supervisor)
+        reactor.callWhenRunning(profiling.report)
+        return root_service
+    worker, workers = current_worker() or (None, 1)
 
     # Configuration de l'accès à la base de données.
     from vigilo.correlator.db_thread import DatabaseWrapper
     database = DatabaseWrapper(settings['database'])
+    profiling.phase("database")
+
+    # Préchargement des caches (noms d'états, agrégats ouverts, etc.).
+    # Les messages ne seront consommés qu'une fois celui-ci terminé.
+    from vigilo.correlator.warmup import warmup_factory
+    warmup = warmup_factory(settings, database)
+    warmup.run()
+    profiling.phase("warm-up started")
 
     from vigilo.common.conf import setup_plugins_path
     from vigilo.connector.client import client_factory
@@ -75,27 +139,67 @@ def makeService(options):
     # À LAISSER ABSOLUMENT.
     from vigilo.correlator.registry import get_registry
     get_registry()
+    profiling.phase("rules registry")
 
     setup_plugins_path(settings["correlator"].get("pluginsdir",
                        "/etc/vigilo/correlator/plugins"))
 
-    reactor.addSystemEventTrigger('during', 'startup', set_signal_handlers)
-    reactor.addSystemEventTrigger('before', 'shutdown', database.shutdown)
+    reactor.addSystemEventTrigger('during', 'startup',
+                                  set_signal_handlers, database)
+    # Écriture différée de l'historique (optionnelle).
+    from vigilo.correlator.history_writer import historywriter_factory
+    history_writer = historywriter_factory(settings, database.engine)
+
+    def shutdown_database():
+        # Les opérations encore en attente dans le thread de la base
+        # de données peuvent produire de l'historique : le tampon
+        # d'écriture n'est vidé qu'une fois ce thread arrêté.
+        d = database.shutdown()
+        if history_writer is not None:
+            d.addBoth(lambda _res: history_writer.shutdown())
+        return d
+    reactor.addSystemEventTrigger('before', 'shutdown', shutdown_database)
 
     root_service = service.MultiService()
 
     # Client du bus
     client = client_factory(settings)
     client.setServiceParent(root_service)
+    profiling.phase("bus client")
 
     # Réceptionneur de messages
-    msg_handler = ruledispatcher_factory(settings, database, client)
+    msg_handler = ruledispatcher_factory(settings, database, client,
+                                         worker, workers, warmup.ready)
+    profiling.phase("rule dispatcher")
+
+    # Canal de communication avec le superviseur.
+    stats_provider = msg_handler
+    if worker is not None:
+        from twisted.internet import stdio
+        from vigilo.correlator.supervisor import WorkerChannel, STATUS_FD
+        channel = WorkerChannel(msg_handler)
+        reactor.callWhenRunning(stdio.StandardIO, channel,
+                                stdin=0, stdout=STATUS_FD)
+        # Les métriques publiées sont celles de l'ensemble des processus.
+        stats_provider = channel
 
     # Statistiques
     # Seule la première instance du corrélateur est permanente.
+    # Lorsqu'elle s'exécute sous la forme de plusieurs processus,
+    # seul le premier d'entre eux publie l'état du corrélateur.
     idinstance = str(settings.get("instance", "") or 1)
-    if idinstance == "1":
+    if idinstance == "1" and worker in (None, 1):
         from vigilo.connector.status import statuspublisher_factory
-        statuspublisher_factory(settings, client, providers=(msg_handler,))
+        statuspublisher_factory(settings, client, providers=(stats_provider,))
+
+    # Exposition des durées de chaque étape du traitement (optionnelle).
+    from vigilo.correlator.http_metrics import metrics_service_factory
+    metrics_service = metrics_service_factory(settings, worker)
+    if metrics_service is not None:
+        metrics_service.setServiceParent(root_service)
+
+    # Le rapport de profilage est affiché une fois
+    # le corrélateur prêt à consommer les messages.
+    warmup.ready.addCallback(profiling.report)
 
     return root_service
@@ -12,6 +12,7 @@ from vigilo.common.gettext import translate
 
 from vigilo.correlator.registry import get_registry
 from vigilo.correlator.actors import rule_runner
+from vigilo.correlator.metrics import Histogram, get_stage_metrics
 
 LOGGER = get_logger(__name__)
 _ = translate(__name__)
@@ -21,27 +22,20 @@ class Executor(object):
     Construit un arbre d'exécution à base de L{Deferred}s,
     en suivant la hiérarchie des règles de corrélation.
 
-    La variable d'instance C{_stats} contient les temps d'exécution des règles.
-    Elle est de la forme suivante::
+    La variable d'instance C{_stats} contient, pour chaque règle,
+    l'histogramme des temps d'exécution depuis le dernier appel à
+    L{getStats}(), qui les utilise pour publier des moyennes d'exécution
+    donnant lieu à de la métrologie. Les temps d'exécution sont également
+    enregistrés dans les histogrammes (jamais remis à zéro) de l'étape
+    C{rule-<nom de la règle>} (cf. L{get_stage_metrics}).
 
-        {"NomRegle1": [duree1, duree2, duree3, duree4, ...,
-         "NomRegle2": [duree1, duree2, duree3, duree4, ...,
-         "NomRegle3": [duree1, duree2, duree3, duree4, ...,
-        }
-
-    La fonction L{getStats}() utilise ensuite ces valeurs pour publier des
-    moyennes d'exécution donnant lieu à de la métrologie.
-
-    @ivar _stats: statistiques d'exécution, au format ci-dessus
+    @ivar _stats: histogrammes des temps d'exécution, par règle
     @type _stats: C{dict}
-    @ivar _stats_tmp: stockage temporaire des timestamps d'exécution
-    @type _stats_tmp: C{dict}
     """
 
     def __init__(self, dispatcher):
         self.__dispatcher = dispatcher
         self._stats = {}
-        self._stats_tmp = {}
         self._runners = {}
         reg = get_registry()
         for rule_name in reg.rules.keys():
@@ -89,16 +83,26 @@ class Executor(object):
                 })
             return failure
 
+        # L'arbre d'exécution est construit pour chaque message :
+        # les dates de début des règles sont donc propres au message traité.
+        started = {}
+
         def before_work(result, rule):
             LOGGER.debug('Executing correlation rule "%s"', rule)
-            self._stats_tmp[rule] = time.time()
+            started[rule] = time.time()
             return result
 
         def after_work(result, rule):
-            time_spent = time.time() - self._stats_tmp[rule]
+            if rule not in started:
+                return result # la règle n'a pas été exécutée
+            time_spent = time.time() - started.pop(rule)
             LOGGER.debug('Done executing correlation rule "%(rule)s" (%(time).4fs)',
                          {"rule": rule, "time": time_spent})
-            self._stats.setdefault(rule, []).append(time_spent)
+            histogram = self._stats.get(rule)
+            if histogram is None:
+                histogram = self._stats[rule] = Histogram()
+            histogram.observe(time_spent)
+            get_stage_metrics().observe("rule-%s" % rule, time_spent)
             return result
 
         # L'exécution de la règle échoue si au moins une de ses dépendances
@@ -140,11 +144,10 @@ class Executor(object):
     def getStats(self):
         prefix = "rule-"
         stats = {}
-        for rulename, durations in self._stats.iteritems():
-            if not durations:
+        for rulename, histogram in self._stats.iteritems():
+            if not histogram.count:
                 continue # pas de messages depuis la dernière fois
-            average = sum(durations) / len(durations)
-            stats[prefix + rulename] = round(average, 5)
+            stats[prefix + rulename] = round(histogram.mean(), 5)
             # et on ré-initialise
-            self._stats[rulename] = []
+            histogram.reset()
         return stats
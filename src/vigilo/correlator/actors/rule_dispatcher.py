@@ -22,6 +22,7 @@ except ImportError:
 
 import transaction
 from sqlalchemy import exc
+from configobj import ConfigObj
 
 from twisted.internet import defer, reactor, error
 from twisted.python import threadpool
@@ -29,19 +30,28 @@ from twisted.python import threadpool
 from vigilo.common.logging import get_logger, get_error_message
 from vigilo.common.gettext import translate
 
-from vigilo.models.tables import SupItem, Version
+from vigilo.models.tables import Version
 
 from vigilo.connector.options import parseSubscriptions, parsePublications
 from vigilo.connector.handlers import MessageHandler
 from vigilo.correlator.correvent import CorrEventBuilder
 from vigilo.correlator.publish_messages import MessagePublisher
+from vigilo.correlator.computation_orders import coalescer_factory
+from vigilo.correlator.partitioning import partitioner_factory, \
+                                           PartitionReceiver
 
 from vigilo.correlator.actors import executor
 from vigilo.correlator.context import Context
 from vigilo.correlator.handle_ticket import handle_ticket
 from vigilo.correlator.db_insertion import insert_event, insert_state, \
         insert_hls_history, OldStateReceived
+from vigilo.correlator.history_writer import get_history_writer
+from vigilo.correlator.completions import call_from_thread, \
+                                            get_completion_buffer
 from vigilo.correlator import registry
+from vigilo.correlator import hlsnames
+from vigilo.correlator import supitems
+from vigilo.correlator.metrics import Histogram, get_stage_metrics, timed
 
 LOGGER = get_logger(__name__)
 _ = translate(__name__)
@@ -69,8 +79,14 @@ class RuleDispatcher(MessageHandler):
         self._executor = executor.Executor(self)
         self.bus_publisher = None
         self.correvent_builder = None
-        self._tmp_correl_time = None
-        self._correl_times = []
+        self.computation_orders = None
+        self.partitioner = None
+        self.membership = None
+        self._correl_time = Histogram()
+        # Sérialise le traitement des messages reçus sur les différentes
+        # files (file principale et file des messages transmis par les
+        # autres instances, cf. processForwardedMessage).
+        self._pipeline = defer.DeferredLock()
 
 
     def check_database_connectivity(self):
@@ -101,17 +117,26 @@ class RuleDispatcher(MessageHandler):
 
     def startService(self):
         LOGGER.debug("Starting rule runners")
+        if self.membership is not None:
+            self.membership.start()
         return self.rrp.start()
 
     def stopService(self):
-        return self.rrp.stop()
+        d = defer.maybeDeferred(self.rrp.stop)
+        if self.membership is not None:
+            d.addBoth(lambda _res: self.membership.stop())
+        if self.computation_orders is not None:
+            d.addBoth(lambda _res: self.computation_orders.flush())
+        if self.bus_publisher is not None:
+            d.addBoth(lambda _res: self.bus_publisher.flush())
+        return d
 
 
     def _putResultInDeferred(self, deferred, f, args, kwargs):
         d = defer.maybeDeferred(f, *args, **kwargs)
         d.addCallbacks(
-            lambda res: reactor.callFromThread(deferred.callback, res),
-            lambda fail: reactor.callFromThread(deferred.errback, fail),
+            lambda res: call_from_thread(deferred.callback, res),
+            lambda fail: call_from_thread(deferred.errback, fail),
         )
 
 
@@ -125,7 +150,9 @@ class RuleDispatcher(MessageHandler):
 
 
     def write(self, msg):
+        start = time.time()
         content = json.loads(msg.content.body)
+        get_stage_metrics().observe("decode", time.time() - start)
         msgid = msg.fields[1]
         if msgid is None:
             LOGGER.error(_("Received invalid item ID (None)"))
@@ -135,7 +162,15 @@ class RuleDispatcher(MessageHandler):
         d.addCallbacks(self.processingSucceeded, self.processingFailed,
                        callbackArgs=(msg, ))
         if self.keepProducing:
-            d.addBoth(lambda _x: self.producer.resumeProducing())
+            if content.get("type") == "computation-order" and \
+                    self.computation_orders is not None:
+                # L'ordre de calcul n'est acquitté qu'une fois le calcul
+                # regroupé effectué, mais les messages suivants (dont
+                # les ordres qui peuvent lui être fusionnés) sont
+                # consommés sans attendre.
+                self.producer.resumeProducing()
+            else:
+                d.addBoth(lambda _x: self.producer.resumeProducing())
         return d
 
 
@@ -147,7 +182,33 @@ class RuleDispatcher(MessageHandler):
 
 
     def processMessage(self, msg):
-        res = defer.maybeDeferred(self._processMessage, msg)
+        # En mode partitionné, les événements dont l'instance courante
+        # n'est pas propriétaire sont transmis à leur propriétaire.
+        if self.partitioner is not None:
+            res = self.partitioner.route(msg)
+            if res is not None:
+                res.addErrback(self._processException)
+                return res
+        return self.processForwardedMessage(msg)
+
+
+    def processForwardedMessage(self, msg):
+        """
+        Traite un message sans chercher à le transmettre à une autre
+        instance (cf. L{vigilo.correlator.partitioning}).
+
+        Les messages reçus sur la file principale et sur la file des
+        messages transmis sont traités un par un : le traitement d'un
+        événement ouvre une transaction sur le thread de la base de
+        données (cf. L{_send_result}) qu'aucune autre opération ne doit
+        interrompre.
+        """
+        if msg["type"] == "computation-order":
+            # Seul le calcul lui-même est sérialisé
+            # (cf. L{_serialized_compute_hls}).
+            res = defer.maybeDeferred(self._processMessage, msg)
+        else:
+            res = self._pipeline.run(self._processMessage, msg)
         res.addErrback(self._processException)
         return res
 
@@ -175,13 +236,23 @@ class RuleDispatcher(MessageHandler):
         if msg["type"] != "event":
             return defer.succeed(None)
 
-        idsupitem = self._do_in_transaction(
-            _("Error while retrieving supervised item ID"),
-            [exc.OperationalError],
-            SupItem.get_supitem,
-            info_dictionary['host'],
-            info_dictionary['service']
-        )
+        # L'identifiant de l'élément supervisé est généralement
+        # présent dans le cache (cf. vigilo.correlator.supitems).
+        start = time.time()
+        idsupitem = supitems.lookup(info_dictionary['host'],
+                                    info_dictionary['service'])
+        if idsupitem is not None:
+            get_stage_metrics().observe("supitem", time.time() - start)
+            idsupitem = defer.succeed(idsupitem)
+        else:
+            idsupitem = timed("supitem", self._do_in_transaction(
+                _("Error while retrieving supervised item ID"),
+                [exc.OperationalError],
+                supitems.get_supitem,
+                info_dictionary['host'],
+                info_dictionary['service'],
+                readonly=True
+            ), start)
         idsupitem.addCallback(self._finalizeInfo, info_dictionary)
         return idsupitem
 
@@ -195,6 +266,44 @@ class RuleDispatcher(MessageHandler):
                             "be handled properly."))
             return defer.succeed(None)
 
+        hls_names = set()
+        for servicename in msg["hls"]: # TODO: adapter l'envoi
+            if not isinstance(servicename, unicode):
+                servicename = servicename.decode('utf-8')
+            hls_names.add(servicename)
+
+        # Les ordres de calcul reçus pendant une courte fenêtre
+        # peuvent être fusionnés (cf. ComputationOrderCoalescer).
+        # Le résultat n'est disponible (et l'ordre acquitté)
+        # qu'une fois le calcul regroupé effectué.
+        if self.computation_orders is not None:
+            return self.computation_orders.add(msg["id"], hls_names)
+        return self._serialized_compute_hls(msg["id"], list(hls_names))
+
+
+    def _serialized_compute_hls(self, msgid, hls_names):
+        """
+        Déclenche le calcul de l'état des services de haut niveau donnés
+        une fois le traitement du message en cours terminé, afin de ne pas
+        interférer avec la transaction ouverte par celui-ci.
+
+        @param msgid: Identifiant de l'ordre de calcul.
+        @type msgid: C{str}
+        @param hls_names: Noms des services de haut niveau.
+        @type hls_names: C{list} of C{unicode}
+        """
+        return self._pipeline.run(self._compute_hls, msgid, hls_names)
+
+
+    def _compute_hls(self, msgid, hls_names):
+        """
+        Déclenche le calcul de l'état des services de haut niveau donnés.
+
+        @param msgid: Identifiant de l'ordre de calcul.
+        @type msgid: C{str}
+        @param hls_names: Noms des services de haut niveau.
+        @type hls_names: C{list} of C{unicode}
+        """
         rule = registry.get_registry().rules.lookup('HighLevelServiceDepsRule')
 
         def eb(failure):
@@ -205,23 +314,34 @@ class RuleDispatcher(MessageHandler):
             LOGGER.warning(failure.getErrorMessage())
             return None # on passe au suivant
 
-        ctx = self._context_factory(msg["id"])
+        ctx = self._context_factory(msgid)
 
-        hls_names = set()
-        for servicename in msg["hls"]: # TODO: adapter l'envoi
-            if not isinstance(servicename, unicode):
-                servicename = servicename.decode('utf-8')
-            hls_names.add(servicename)
-
-        hls_names = list(hls_names)
-        d = ctx.set('impacted_hls', hls_names)
+        # Les noms sont validés à l'aide du cache des services de haut
+        # niveau : seuls les noms absents du cache sont recherchés
+        # (en une seule requête) dans la base de données.
+        missing = hlsnames.lookup_ids(hls_names)[1]
+        if missing:
+            d = self._database.run(hlsnames.get_ids, missing,
+                                   transaction=False, readonly=True)
+        else:
+            d = defer.succeed({})
+
+        def drop_unknown(known):
+            unknown = [name for name in missing if name not in known]
+            if unknown:
+                LOGGER.warning(_("Ignoring unknown high-level services: "
+                                 "%s"), u", ".join(unknown))
+                hls_names[:] = [name for name in hls_names
+                                if name not in unknown]
+        d.addCallback(drop_unknown)
+        d.addCallback(lambda _dummy: ctx.set('impacted_hls', hls_names))
         d.addCallback(lambda _dummy: ctx.set('hostname', None))
         d.addCallback(lambda _dummy: ctx.set('servicename', None))
         d.addErrback(eb)
         d.addCallback(lambda _dummy: \
             self.doWork(
                 rule.compute_hls_states,
-                self, msg["id"],
+                self, msgid,
                 None, None,
                 hls_names
             )
@@ -309,9 +429,10 @@ class RuleDispatcher(MessageHandler):
         d = self._do_in_transaction(
             _("Error while saving state"),
             [exc.OperationalError],
-            insert_state, info_dictionary
+            insert_state, info_dictionary,
+            affinity=info_dictionary['idsupitem']
         )
-        return d
+        return timed("insert_state", d)
 
 
     def _insert_history(self, previous_state, info_dictionary, ctx):
@@ -331,15 +452,19 @@ class RuleDispatcher(MessageHandler):
             d = self._do_in_transaction(
                 _("Error while adding an entry in the HLS history"),
                 [exc.OperationalError],
-                insert_hls_history, info_dictionary
+                insert_hls_history, info_dictionary,
+                affinity=info_dictionary['idsupitem']
             )
+            timed("insert_hls_history", d)
         else:
             LOGGER.debug(_('Inserting an entry in the history'))
             d = self._do_in_transaction(
                 _("Error while adding an entry in the history"),
                 [exc.OperationalError],
-                insert_event, info_dictionary
+                insert_event, info_dictionary,
+                affinity=info_dictionary['idsupitem']
             )
+            timed("insert_event", d)
 
         d.addCallback(self._do_correl, previous_state, info_dictionary, ctx)
         d.addCallback(self._commit)
@@ -359,6 +484,9 @@ class RuleDispatcher(MessageHandler):
         if raw_event_id:
             d.addCallback(lambda _result: ctx.set('raw_event_id', raw_event_id))
 
+        # Date de début de la corrélation (propre au message traité).
+        started = []
+
         def start_correl(_ignored, defs):
             tree_start, self.tree_end = defs
 
@@ -376,14 +504,15 @@ class RuleDispatcher(MessageHandler):
             )
 
             # On lance le processus de corrélation.
-            self._tmp_correl_time = time.time()
+            started.append(time.time())
             tree_start.callback(info_dictionary["id"])
             return self.tree_end
         d.addCallback(start_correl, self._executor.build_execution_tree())
 
         def end(result):
-            duration = time.time() - self._tmp_correl_time
-            self._correl_times.append(duration)
+            duration = time.time() - started[0]
+            self._correl_time.observe(duration)
+            get_stage_metrics().observe("rule-total", duration)
             LOGGER.debug(_('Correlation process ended (%.4fs)'), duration)
             return result
         d.addCallback(end)
@@ -414,7 +543,8 @@ class RuleDispatcher(MessageHandler):
 
         def cb(_result, *args, **kwargs):
             assert self.correvent_builder is not None
-            return self.correvent_builder.make_correvent(*args, **kwargs)
+            return timed("make_correvent", defer.maybeDeferred(
+                self.correvent_builder.make_correvent, *args, **kwargs))
         def eb(failure):
             try:
                 error_message = unicode(failure)
@@ -427,12 +557,18 @@ class RuleDispatcher(MessageHandler):
                 error_message
             )
             return failure
-        d.addCallback(lambda res: self._database.run(
+        # La transaction doit être ouverte et validée par le thread
+        # de la base de données qui crée l'événement corrélé.
+        database = self._database.pinned(info_dictionary.get('idsupitem'))
+        d.addCallback(lambda res: database.run(
             transaction.begin, transaction=False))
         d.addCallback(cb, info_dictionary)
-        d.addCallback(lambda res: self._database.run(
+        d.addCallback(lambda res: database.run(
             transaction.commit, transaction=False))
         d.addErrback(eb)
+        # Les messages produits sont regroupés par l'expéditeur
+        # (cf. MessagePublisher) jusqu'à l'expiration de la fenêtre
+        # de regroupement ou jusqu'à ce que son tampon soit plein.
 
         d.callback(None)
         return d
@@ -522,6 +658,7 @@ class RuleDispatcher(MessageHandler):
             p_stats_d = self.bus_publisher.getStats()
             def update(p_stats):
                 stats["sent"] = p_stats["sent"]
+                stats["coalesced"] = p_stats.get("coalesced", 0)
                 return stats
             p_stats_d.addCallback(update)
             return p_stats_d
@@ -535,17 +672,37 @@ class RuleDispatcher(MessageHandler):
             ))
             # On met à jour le dictionnaire avec les vraies stats d'exécution.
             rule_stats.update(self._executor.getStats())
+            # Certaines règles fournissent des métriques complémentaires.
+            rules = registry.get_registry().rules
+            for rule_name in rules.keys():
+                rule_obj = rules.lookup(rule_name)
+                if hasattr(rule_obj, 'getStats'):
+                    rule_stats.update(rule_obj.getStats())
             stats.update(rule_stats)
-            if self._correl_times:
-                stats["rule-total"] = round(sum(self._correl_times) /
-                                            len(self._correl_times), 5)
-                self._correl_times = []
+            if self._correl_time.count:
+                stats["rule-total"] = round(self._correl_time.mean(), 5)
+                self._correl_time.reset()
             else:
                 stats["rule-total"] = 0.0
             return stats
+        def add_history_stats(stats):
+            writer = get_history_writer()
+            if writer is not None:
+                stats.update(writer.getStats())
+            return stats
+        def add_database_stats(stats):
+            stats.update(self._database.getStats())
+            stats.update(get_completion_buffer().getStats())
+            if self.computation_orders is not None:
+                stats.update(self.computation_orders.getStats())
+            if self.partitioner is not None:
+                stats.update(self.partitioner.getStats())
+            return stats
         d = super(RuleDispatcher, self).getStats()
         d.addCallback(add_publisher_stats)
         d.addCallback(add_exec_stats)
+        d.addCallback(add_history_stats)
+        d.addCallback(add_database_stats)
         return d
 
 
@@ -559,8 +716,24 @@ class RuleDispatcher(MessageHandler):
             return self.bus_publisher.write(msg)
 
 
+    def sendItems(self, msgs):
+        """
+        Envoi de plusieurs résultats sur le bus.
+
+        Depuis les règles de corrélation, un seul aller-retour avec le
+        thread principal est alors nécessaire pour l'ensemble des messages.
+
+        @param msgs: Messages à envoyer.
+        @type msgs: C{list} of C{dict}
+        """
+        return defer.gatherResults([
+            defer.maybeDeferred(self.sendItem, msg) for msg in msgs
+        ])
+
+
 
-def ruledispatcher_factory(settings, database, client):
+def ruledispatcher_factory(settings, database, client, worker=None,
+                           workers=1, ready=None):
     timeout = settings['correlator'].as_int('rules_timeout')
     if timeout <= 0:
         timeout = None
@@ -583,11 +756,25 @@ def ruledispatcher_factory(settings, database, client):
     subs = parseSubscriptions(settings)
     queue = settings["bus"]["queue"]
     queue_message_ttl = int(settings['bus'].get('queue_messages_ttl', 0))
-    msg_handler.subscribe(queue, queue_message_ttl, subs)
+
+    # Les messages ne sont consommés qu'une fois le corrélateur
+    # prêt (par exemple, après le préchargement des caches).
+    if ready is None:
+        ready = defer.succeed(None)
+    ready.addCallback(lambda _res: msg_handler.subscribe(
+        queue, queue_message_ttl, subs))
 
     # Expéditeur de messages
     publications = parsePublications(settings.get('publications', {}).copy())
-    publisher = MessagePublisher(publications)
+    try:
+        window = settings['correlator'].as_float('publish_coalescing_window')
+    except KeyError:
+        window = 0
+    try:
+        max_pending = settings['correlator'].as_int('publish_max_pending')
+    except KeyError:
+        max_pending = 1000
+    publisher = MessagePublisher(publications, window, max_pending)
     publisher.setClient(client)
     msg_handler.bus_publisher = publisher
 
@@ -595,4 +782,26 @@ def ruledispatcher_factory(settings, database, client):
     correvent_builder = CorrEventBuilder(publisher, database)
     msg_handler.correvent_builder = correvent_builder
 
+    # Regroupement des ordres de calcul des services de haut niveau
+    msg_handler.computation_orders = coalescer_factory(
+        settings, msg_handler._serialized_compute_hls)
+
+    # Mode partitionné : chaque instance (ou chaque processus d'une
+    # instance) reçoit en plus, sur une file qui lui est propre,
+    # les événements dont elle est propriétaire.
+    partitioner, membership = partitioner_factory(
+        settings, instance, publisher, worker, workers)
+    if partitioner is not None:
+        msg_handler.partitioner = partitioner
+        msg_handler.membership = membership
+        receiver = PartitionReceiver(msg_handler)
+        receiver.setClient(client)
+        ready.addCallback(lambda _res: receiver.subscribe(
+            "%s-%s" % (queue, partitioner.instance), queue_message_ttl,
+            parseSubscriptions(ConfigObj({
+                "bus": {"subscriptions": [
+                    "correlator-%s" % partitioner.instance,
+                ]},
+            }))))
+
     return msg_handler
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Transmission groupée de résultats depuis des threads vers le réacteur.
+
+Chaque appel à C{reactor.callFromThread} réveille le réacteur (écriture
+dans un tube puis passage dans la boucle d'événements). Lorsque les
+threads de la base de données ou les règles de corrélation produisent
+de nombreux résultats, ces réveils finissent par saturer le thread du
+réacteur.
+
+Les résultats sont donc accumulés dans un tampon : le premier résultat
+déposé dans un tampon vide programme une vidange de celui-ci par le
+réacteur, et tous les résultats déposés avant que cette vidange n'ait
+lieu sont transmis lors du même réveil.
+
+Le tampon ne nécessite aucun verrou : il repose sur les opérations
+atomiques de C{collections.deque}. Dans le pire des cas, une vidange
+inutile (tampon déjà vide) est programmée.
+"""
+
+import collections
+
+from twisted.internet import reactor
+from twisted.python import log
+
+__all__ = (
+    'CompletionBuffer',
+    'call_from_thread',
+    'get_completion_buffer',
+)
+
+
+class CompletionBuffer(object):
+    """
+    Tampon de résultats à transmettre au réacteur.
+    """
+
+    def __init__(self, reactor_=None):
+        """
+        @param reactor_: Réacteur destinataire des résultats
+            (par défaut, le réacteur global de Twisted).
+        """
+        if reactor_ is None:
+            reactor_ = reactor
+        self._reactor = reactor_
+        self._pending = collections.deque()
+        self._scheduled = False
+        self.wakeups = 0
+        self.delivered = 0
+
+    def call_from_thread(self, func, *args):
+        """
+        Programme l'appel de C{func} par le réacteur,
+        lors de la prochaine vidange du tampon.
+
+        @param func: Fonction à appeler depuis le réacteur.
+        @type func: C{callable}
+        @note: Les arguments supplémentaires sont transmis à C{func}.
+        """
+        self._pending.append((func, args))
+        if not self._scheduled:
+            self._scheduled = True
+            self._reactor.callFromThread(self._drain)
+
+    def _drain(self):
+        """
+        Vide le tampon depuis le réacteur.
+        """
+        # Le drapeau est levé avant la vidange : un résultat déposé
+        # pendant celle-ci est soit transmis maintenant, soit à
+        # l'occasion d'une nouvelle vidange.
+        self._scheduled = False
+        self.wakeups += 1
+        pending = self._pending
+        while True:
+            try:
+                func, args = pending.popleft()
+            except IndexError:
+                break
+            self.delivered += 1
+            try:
+                func(*args)
+            except Exception:
+                log.err()
+
+    def getStats(self):
+        """
+        Retourne le nombre de réveils du réacteur et le nombre
+        de résultats transmis depuis le dernier appel.
+
+        @rtype: C{dict}
+        """
+        wakeups, self.wakeups = self.wakeups, 0
+        delivered, self.delivered = self.delivered, 0
+        return {
+            "reactor-wakeups": wakeups,
+            "reactor-completions": delivered,
+        }
+
+
+_buffer = None
+
+def get_completion_buffer():
+    """
+    Retourne le tampon utilisé par défaut dans le processus.
+
+    @rtype: L{CompletionBuffer}
+    """
+    global _buffer # pylint: disable-msg=W0603
+    if _buffer is None:
+        _buffer = CompletionBuffer()
+    return _buffer
+
+def call_from_thread(func, *args):
+    """
+    Équivalent groupé de C{reactor.callFromThread}
+    (cf. L{CompletionBuffer.call_from_thread}).
+    """
+    get_completion_buffer().call_from_thread(func, *args)
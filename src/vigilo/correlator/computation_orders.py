@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Regroupement des ordres de calcul de l'état des services de haut niveau.
+
+Lors d'une tempête d'alertes, Nagios émet de nombreux ordres de calcul
+("computation-order") portant sur des ensembles de services de haut niveau
+qui se recouvrent largement. Les ordres reçus pendant une courte fenêtre
+sont fusionnés en un unique ensemble (sans doublons) de services de haut
+niveau, dont l'état n'est alors calculé qu'une seule fois.
+"""
+
+from twisted.internet import defer
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'ComputationOrderCoalescer',
+    'coalescer_factory',
+)
+
+
+class ComputationOrderCoalescer(object):
+    """
+    Fusionne les ordres de calcul reçus pendant une fenêtre glissante.
+
+    Le calcul est déclenché lorsqu'aucun nouvel ordre n'a été reçu
+    depuis C{window} secondes, et au plus tard C{max_latency} secondes
+    après la réception du premier ordre en attente.
+    """
+
+    def __init__(self, compute, window=0.5, max_latency=2.0, clock=None):
+        """
+        @param compute: Fonction réalisant le calcul. Elle reçoit
+            l'identifiant du dernier ordre fusionné et la liste
+            des noms des services de haut niveau à calculer.
+        @type compute: C{callable}
+        @param window: Durée (en secondes) pendant laquelle
+            les ordres de calcul sont fusionnés.
+        @type window: C{float}
+        @param max_latency: Délai maximum (en secondes) entre la réception
+            d'un ordre de calcul et le déclenchement du calcul.
+        @type max_latency: C{float}
+        @param clock: Horloge utilisée pour planifier les calculs
+            (le reactor de Twisted par défaut).
+        @type clock: C{twisted.internet.interfaces.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._compute = compute
+        self.window = window
+        self.max_latency = max(window, max_latency)
+        self._clock = clock
+        self._timer = None
+        self._reset()
+        self._received = 0
+        self._merged = 0
+        self._saved = 0
+
+
+    def _reset(self):
+        self._names = set()
+        self._requested = 0
+        self._waiting = []
+        self._msgid = None
+        self._deadline = None
+
+
+    def add(self, msgid, hls_names):
+        """
+        Ajoute un ordre de calcul à l'ensemble en attente.
+
+        @param msgid: Identifiant de l'ordre de calcul.
+        @type msgid: C{str}
+        @param hls_names: Noms des services de haut niveau à calculer.
+        @type hls_names: C{iterable} of C{unicode}
+        @return: Deferred appelé une fois le calcul (regroupé) réalisé.
+        @rtype: L{defer.Deferred}
+        """
+        hls_names = set(hls_names)
+        self._received += 1
+        if self._waiting:
+            self._merged += 1
+        self._requested += len(hls_names)
+        self._names.update(hls_names)
+        self._msgid = msgid
+        d = defer.Deferred()
+        self._waiting.append(d)
+
+        now = self._clock.seconds()
+        if self._deadline is None:
+            self._deadline = now + self.max_latency
+        delay = max(0, min(self.window, self._deadline - now))
+        if self._timer is not None and self._timer.active():
+            self._timer.reset(delay)
+        else:
+            self._timer = self._clock.callLater(delay, self.flush)
+        return d
+
+
+    def flush(self):
+        """
+        Déclenche immédiatement le calcul des services de haut niveau
+        en attente.
+
+        @return: Deferred appelé une fois le calcul réalisé.
+        @rtype: L{defer.Deferred}
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        if not self._waiting:
+            return defer.succeed(None)
+
+        names = sorted(self._names)
+        waiting = self._waiting
+        msgid = self._msgid
+        self._saved += self._requested - len(names)
+        self._reset()
+
+        LOGGER.debug(_('Computing the state of %(hls)d high-level services '
+                       'for %(orders)d computation orders'), {
+                            'hls': len(names),
+                            'orders': len(waiting),
+                        })
+        d = defer.maybeDeferred(self._compute, msgid, names)
+        def done(result):
+            for waiter in waiting:
+                waiter.callback(result)
+            return None
+        def failed(failure):
+            for waiter in waiting:
+                waiter.errback(failure)
+            return None
+        d.addCallbacks(done, failed)
+        return d
+
+
+    def getStats(self):
+        """
+        Récupère les métriques de regroupement depuis le dernier appel.
+
+        @rtype: C{dict}
+        """
+        stats = {
+            "computation-orders": self._received,
+            "computation-orders-merged": self._merged,
+            "hls-computations-saved": self._saved,
+        }
+        self._received = self._merged = self._saved = 0
+        return stats
+
+
+
+def coalescer_factory(settings, compute):
+    """
+    Crée l'objet de regroupement des ordres de calcul
+    si celui-ci est activé dans la configuration.
+
+    @param settings: Configuration du corrélateur.
+    @param compute: Fonction réalisant le calcul
+        (cf. L{ComputationOrderCoalescer}).
+    @type compute: C{callable}
+    @return: Objet de regroupement, ou C{None} s'il est désactivé.
+    @rtype: L{ComputationOrderCoalescer}
+    """
+    options = settings['correlator']
+
+    def _get(name, default, conv):
+        try:
+            return conv(options[name])
+        except KeyError:
+            return default
+
+    window = _get('computation_order_window', 0, float)
+    if window <= 0:
+        return None
+    return ComputationOrderCoalescer(
+        compute,
+        window=window,
+        max_latency=_get('computation_order_max_latency', 2.0, float),
+    )
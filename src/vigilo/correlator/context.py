@@ -7,6 +7,8 @@ Context objects.
 """
 __all__ = ( 'Context', )
 
+from twisted.internet import defer
+
 from vigilo.common.conf import settings
 from vigilo.common.logging import get_logger
 from vigilo.common.gettext import translate
@@ -86,6 +88,24 @@ class Context(object):
         key = 'vigilo:%s:%s' % (prop, self._id)
         return self._connection.get(key, self._transaction)
 
+    def getMulti(self, props):
+        """
+        Récupération en une seule fois de plusieurs attributs du contexte.
+
+        @param props: Noms des attributs (cf. L{Context.get}).
+        @type props: C{iterable} of C{str}
+        @return: Deferred donnant le dictionnaire des valeurs
+            des attributs, indexées par leur nom.
+        @rtype: L{defer.Deferred}
+        """
+        keys = dict(('vigilo:%s:%s' % (prop, self._id), prop)
+                    for prop in props)
+        d = defer.maybeDeferred(self._connection.get_multi,
+                                keys.keys(), self._transaction)
+        d.addCallback(lambda values: dict(
+            (keys[key], value) for (key, value) in values.iteritems()))
+        return d
+
     def set(self, prop, value, timeout=NoTimeoutOverride):
         """
         Modification dynamique d'un des attributs du contexte.
@@ -158,6 +178,28 @@ class Context(object):
             self._transaction,
             time=timeout)
 
+    def setSharedMulti(self, values, timeout=NoTimeoutOverride):
+        """
+        Modification en une seule fois de plusieurs attributs
+        partagés du contexte.
+
+        @param values: Dictionnaire des valeurs à donner aux attributs
+            partagés, indexées par le nom de l'attribut. Les valeurs
+            doivent être sérialisables à l'aide du module C{pickle}.
+        @type values: C{dict}
+        @param timeout: Durée de rétention (en secondes) des données.
+            Si omis, la durée de rétention globale associée au contexte
+            est utilisée.
+        @type timeout: C{float}
+        """
+        if timeout is NoTimeoutOverride:
+            timeout = self._timeout
+        return self._connection.set_multi(
+            dict(('shared:%s' % prop, value)
+                 for (prop, value) in values.iteritems()),
+            self._transaction,
+            time=timeout)
+
     def deleteShared(self, prop):
         """
         Suppression dynamique d'un attribut partagé du contexte.
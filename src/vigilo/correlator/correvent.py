@@ -7,22 +7,23 @@
 Création des événements corrélés dans la BDD et transmission au bus.
 """
 
-from sqlalchemy import not_ , and_
-from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.orm import aliased
 import logging
+import copy
 
 from twisted.internet import defer
 
 from vigilo.correlator.context import Context
-from vigilo.correlator.db_insertion import add_to_aggregate, merge_aggregates, \
-                                            remove_from_all_aggregates
+from vigilo.correlator import queries
+from vigilo.correlator import hlsnames
+from vigilo.correlator import priorities
+from vigilo.correlator.db_insertion import insert_aggregate_entries, \
+                                            insert_correvents, \
+                                            merge_aggregate_entries, \
+                                            remove_aggregate_entries, \
+                                            detach_events, empty_aggregate
 
 from vigilo.models.session import DBSession
-from vigilo.models.tables import CorrEvent, Event, EventHistory
-from vigilo.models.tables import SupItem, HighLevelService, StateName
-from vigilo.models.tables import DependencyGroup, Dependency
-from vigilo.models.tables.eventsaggregate import EventsAggregate
+from vigilo.models.tables import CorrEvent, EventHistory
 
 from vigilo.common.logging import get_logger
 from vigilo.common.gettext import translate
@@ -33,6 +34,107 @@ LOGGER = get_logger(__name__)
 
 __all__ = ('make_correvent', )
 
+# Attributs du contexte de corrélation utilisés
+# pour la création de l'événement corrélé.
+CONTEXT_ATTRIBUTES = (
+    'raw_event_id',
+    'no_alert',
+    'idsupitem',
+    'predecessors_aggregates',
+    'successors_aggregates',
+    'priority',
+    'occurrences_count',
+    'impacted_hls',
+)
+
+
+class BuildOutcome(object):
+    """
+    Résultat du traitement d'un événement par le thread de la base
+    de données : effets à appliquer ensuite depuis le réacteur.
+
+    @ivar correvent: Événement corrélé créé ou mis à jour, ou C{None}.
+    @type correvent: L{CorrEvent} ou L{CorrEventRow}
+    @ivar shared: Nouvelles valeurs des attributs partagés du contexte.
+    @type shared: C{dict}
+    @ivar actions: Appels à effectuer (dans l'ordre) pour publier
+        les messages sur le bus.
+    @type actions: C{list} of C{tuple}
+    """
+
+    def __init__(self):
+        self.correvent = None
+        self.shared = {}
+        self.actions = []
+
+    def set_open_aggr(self, idsupitem, idcorrevent):
+        """
+        Enregistre l'agrégat ouvert associé à un élément supervisé.
+
+        @param idsupitem: Identifiant de l'élément supervisé.
+        @type idsupitem: C{int}
+        @param idcorrevent: Identifiant de l'agrégat (0 si aucun).
+        @type idcorrevent: C{int}
+        """
+        self.shared['open_aggr:%d' % idsupitem] = idcorrevent
+
+    def publish(self, func, *args):
+        """
+        Programme un appel à effectuer depuis le réacteur.
+
+        @param func: Fonction à appeler.
+        @type func: C{callable}
+        @note: Les arguments supplémentaires sont transmis à C{func}.
+        """
+        self.actions.append((func, args))
+
+
+class CorrEventRow(object):
+    """
+    Événement corrélé existant, tel que retourné par la requête
+    L{queries.OPEN_CORREVENT}.
+
+    Contrairement à une instance de L{CorrEvent}, cet objet n'est pas
+    rattaché à la session de l'ORM : les modifications apportées à ses
+    attributs sont enregistrées à l'aide d'une seule requête de mise
+    à jour (cf. L{CorrEventRow.changes}).
+    """
+
+    __slots__ = (
+        'idcorrevent',
+        'idcause',
+        'priority',
+        'ack',
+        'occurrence',
+        'trouble_ticket',
+        'timestamp_active',
+        '_original',
+    )
+
+    # Attributs susceptibles d'être modifiés par CorrEventBuilder.
+    MUTABLE = ('priority', 'ack', 'occurrence', 'timestamp_active')
+
+    def __init__(self, row):
+        """
+        @param row: Ligne retournée par L{queries.OPEN_CORREVENT}.
+        """
+        for name in self.__slots__[:-1]:
+            setattr(self, name, getattr(row, name))
+        self._original = tuple(getattr(self, name) for name in self.MUTABLE)
+
+    def changes(self):
+        """
+        Retourne les attributs modifiés depuis le chargement de la ligne.
+
+        @return: Nouvelles valeurs des attributs, indexées par leur nom.
+        @rtype: C{dict}
+        """
+        return dict(
+            (name, getattr(self, name))
+            for (name, value) in zip(self.MUTABLE, self._original)
+            if getattr(self, name) != value
+        )
+
 
 class CorrEventBuilder(object):
     """
@@ -66,87 +168,223 @@ class CorrEventBuilder(object):
             self.data_logger = None
 
 
-    @defer.inlineCallbacks
-    def _get_update_id(self, item_id):
+    def _get_updated_correvent(self, item_id, timestamp):
         """
-        Retourne l'identifiant de l'événement corrélé ouvert
-        pour l'identifiant d'objet donné.
+        Retourne l'événement corrélé ouvert concernant
+        l'élément supervisé donné, s'il doit être mis à jour.
 
         @param item_id: Identifiant de l'objet supervisé.
         @type item_id: C{int}
-        @return: Identifiant de l'événement corrélé encore ouvert
-            concernant cet objet ou C{None} s'il n'en existe aucun.
-        @rtype: C{int}
-        """
-        state_ok = yield self.database.run(
-            StateName.statename_to_value,
-            u'OK',
-            transaction=False
-        )
-        state_up = yield self.database.run(
-            StateName.statename_to_value,
-            u'UP',
-            transaction=False
+        @param timestamp: Horodatage de l'événement en cours de traitement.
+        @type timestamp: C{datetime.DateTime}
+        @return: Événement corrélé à mettre à jour, ou C{None}
+            si un nouvel événement doit être créé.
+        @rtype: L{CorrEventRow}
+        """
+        row = queries.fetch_first(
+            queries.OPEN_CORREVENT,
+            idsupitem=item_id,
+            **queries.state_params()
         )
+        if row is None:
+            priorities.set_after_commit(item_id, None, None)
+            return None
+        priorities.set_after_commit(item_id, row.idcorrevent, row.priority)
+
+        if row.timestamp_active > timestamp:
+            LOGGER.info(_('Ignoring request to update correlated event %r: '
+                          'a more recent update already exists in the '
+                          'database'), row.idcorrevent)
+            return None
+
+        LOGGER.debug(_('Updating existing correlated event (%r)'),
+                       row.idcorrevent)
+        return CorrEventRow(row)
+
+    def _save_correvent(self, correvent):
+        """
+        Enregistre un événement corrélé dans la base de données.
 
-        update_id = yield self.database.run(
-            DBSession.query(
-                CorrEvent.idcorrevent
-            ).join(
-                (Event, CorrEvent.idcause == Event.idevent),
-                (SupItem, SupItem.idsupitem == Event.idsupitem),
-            ).filter(SupItem.idsupitem == item_id
-            ).filter(
-                not_(and_(
-                    Event.current_state.in_([state_ok, state_up]),
-                    CorrEvent.ack == CorrEvent.ACK_CLOSED
-                ))
-            ).first,
-            transaction=False
-        )
-        if update_id:
-            res = update_id.idcorrevent
+        @param correvent: Événement corrélé à enregistrer.
+        @type correvent: L{CorrEvent} ou L{CorrEventRow}
+        """
+        if not isinstance(correvent, CorrEventRow):
+            DBSession.add(correvent)
+            DBSession.flush()
+            return
+
+        changes = correvent.changes()
+        if changes:
+            # La synchronisation met également à jour l'éventuelle
+            # instance de l'ORM déjà présente dans la session.
+            DBSession.query(CorrEvent).filter(
+                CorrEvent.idcorrevent == correvent.idcorrevent
+            ).update(changes, synchronize_session='evaluate')
+
+    def _add_to_aggregate(self, outcome, idevent, idcorrevent,
+                          idsupitem, merging):
+        """
+        Ajoute un événement brut à un événement corrélé
+        (cf. L{vigilo.correlator.db_insertion.add_to_aggregate}).
+
+        @param outcome: Résultat du traitement en cours.
+        @type outcome: L{BuildOutcome}
+        @param idevent: Identifiant de l'événement brut à ajouter.
+        @type idevent: C{int}
+        @param idcorrevent: Identifiant de l'agrégat.
+        @type idcorrevent: C{int}
+        @param idsupitem: Identifiant de l'élément supervisé
+            sur lequel porte l'événement brut.
+        @type idsupitem: C{int}
+        @param merging: Indique si l'ajout a lieu au cours d'une fusion.
+        @type merging: C{bool}
+        """
+        LOGGER.debug(_('Adding event #%(event)d (supitem #%(supitem)d) '
+                        'to aggregate #%(aggregate)d'), {
+                        'event': idevent,
+                        'supitem': idsupitem,
+                        'aggregate': idcorrevent,
+                    })
+        if not insert_aggregate_entries([(idevent, idcorrevent)]):
+            LOGGER.debug(_('Event #%(event)d already belongs to aggregate '
+                            '#%(aggregate)d, refusing to add it twice'), {
+                            'event': idevent,
+                            'aggregate': idcorrevent,
+                        })
+            return
+
+        # Lors d'une fusion, l'événement brut n'est pas la cause
+        # de l'agrégat et n'a donc plus d'agrégat ouvert associé.
+        if merging:
+            outcome.set_open_aggr(idsupitem, 0)
         else:
-            res = None
-        defer.returnValue(res)
+            outcome.set_open_aggr(idsupitem, idcorrevent)
 
-    @defer.inlineCallbacks
-    def _get_updated_correvent(self, update_id, timestamp):
+    def _merge_aggregates(self, outcome, source_ids, destination_id):
         """
-        Retourne l'instance de l'événement corrélé
-        devant être mise à jour.
-
-        @param update_id: Identifiant de l'événement corrélé à retourner.
-        @type update_id: C{int}
-        @param timestamp: Horodatage de l'événement en cours de traitement.
-        @type timestamp: C{datetime.DateTime}
-        @return: Deferred avec l'instance de l'événement corrélé
-            à mettre à jour, ou C{None} si un nouvel événement
-            doit être créé.
-        @rtype: L{CorrEvent}
-        """
-        correvent = yield self.database.run(
-            DBSession.query(
-                CorrEvent
-            ).filter(CorrEvent.idcorrevent == update_id
-            ).one,
-            transaction=False
-        )
-
-        if correvent:
-            if correvent.timestamp_active > timestamp:
-                LOGGER.info(_('Ignoring request to update correlated event %r: '
-                              'a more recent update already exists in the '
-                              'database'), update_id)
-                defer.returnValue(None)
+        Fusionne un ou plusieurs agrégats dans un agrégat destination
+        (cf. L{vigilo.correlator.db_insertion.merge_aggregates}).
+
+        @param outcome: Résultat du traitement en cours.
+        @type outcome: L{BuildOutcome}
+        @param source_ids: Identifiants des agrégats sources.
+        @type source_ids: C{list} of C{int}
+        @param destination_id: Identifiant de l'agrégat destination.
+        @type destination_id: C{int}
+        @return: Identifiants des alertes brutes déplacées.
+        @rtype: C{list} of C{int}
+        """
+        source_ids = [int(source_id) for source_id in source_ids]
+        destination_id = int(destination_id)
+        LOGGER.debug(_('Merging aggregates %(src)r into aggregate #%(dest)d'), {
+                        'src': source_ids,
+                        'dest': destination_id,
+                    })
+        source = merge_aggregate_entries(source_ids, destination_id)
+        priorities.forget_correvents_after_commit(
+            [source_id for source_id in source_ids
+             if source_id != destination_id])
+        if source is None:
+            LOGGER.warning(_('Got a reference to a nonexistent aggregate, '
+                            'aborting'))
+            return []
+
+        for event in source:
+            outcome.set_open_aggr(event.idsupitem, 0)
+        return [event.idevent for event in source]
+
+    def _aggregate_in_db(self, outcome, idcorrevent, raw_event_id, item_id,
+                         predecessing_aggregates_id, succeeding_aggregates_id):
+        """
+        Procède à une première passe d'agrégation topologique,
+        basée sur les agrégats prédécesseurs de l'alerte courante.
 
-            LOGGER.debug(_('Updating existing correlated event (%r)'),
-                           update_id)
-        else:
-            LOGGER.error(_('Got a reference to a non-existent '
-                           'correlated event (%r), adding as new'),
-                           update_id)
-        defer.returnValue(correvent)
+        Le nombre de requêtes ne dépend pas du nombre d'agrégats
+        prédécesseurs et successeurs : l'existence des prédécesseurs
+        est vérifiée en une seule requête, l'alerte est rattachée
+        à tous les prédécesseurs en une seule insertion et les
+        successeurs sont fusionnés en une seule opération.
+
+        @note: Cette méthode doit être exécutée dans le thread
+            dédié à la base de données.
+        @param outcome: Résultat du traitement en cours.
+        @type outcome: L{BuildOutcome}
+        @param idcorrevent: Identifiant de l'événement corrélé courant
+            ou C{None} s'il n'existe pas encore.
+        @type idcorrevent: C{int}
+        @param raw_event_id: Identifiant de l'événement brut.
+        @type raw_event_id: C{int}
+        @param item_id: Identifiant de l'objet supervisé concerné.
+        @type item_id: C{int}
+        @param predecessing_aggregates_id: Agrégats prédécesseurs.
+        @type predecessing_aggregates_id: C{list} of C{int}
+        @param succeeding_aggregates_id: Agrégats successeurs.
+        @type succeeding_aggregates_id: C{list} of C{int}
+        @return: Indique si l'événement corrélé a été agrégé
+            dans un autre (C{True}) ou non (C{False}).
+        @rtype: L{bool}
+        """
+        if not predecessing_aggregates_id:
+            return False
+
+        requested = [int(aggregate_id)
+                     for aggregate_id in predecessing_aggregates_id]
+        found = set(row.idcorrevent for row in
+                    DBSession.query(CorrEvent.idcorrevent).filter(
+                        CorrEvent.idcorrevent.in_(set(requested))).all())
+        predecessors = []
+        for aggregate_id in requested:
+            if aggregate_id not in found:
+                LOGGER.error(_('Got a reference to a nonexistent '
+                        'correlated event (%r), skipping this aggregate'),
+                        aggregate_id)
+            elif aggregate_id not in predecessors:
+                predecessors.append(aggregate_id)
+
+        if not predecessors:
+            return False
+
+        # D'abord on rattache l'alerte courante
+        # à tous ces agrégats dans la BDD.
+        LOGGER.debug(_('Adding event #%(event)d (supitem #%(supitem)d) '
+                        'to aggregates %(aggregates)r'), {
+                        'event': raw_event_id,
+                        'supitem': item_id,
+                        'aggregates': predecessors,
+                    })
+        if insert_aggregate_entries([(raw_event_id, aggregate_id)
+                                     for aggregate_id in predecessors]):
+            # L'alerte n'est pas la cause de ces agrégats.
+            outcome.set_open_aggr(item_id, 0)
+
+        # Ensuite on fusionne les éventuels agrégats dépendant de l'alerte
+        # courante avec le premier de ces agrégats (ils n'existent plus
+        # ensuite pour les autres prédécesseurs).
+        dependent_event_list = []
+        if succeeding_aggregates_id:
+            dependent_event_list = self._merge_aggregates(
+                outcome, succeeding_aggregates_id, predecessors[0])
+
+        # On rattache sur le bus l'alerte courante et les alertes
+        # brutes qui en dépendent aux agrégats prédécesseurs.
+        outcome.publish(self.publisher.publish_aggregate, predecessors,
+                        [raw_event_id] + list(set(dependent_event_list)))
+
+        # Enfin on supprime du bus les agrégats qui dépendaient de l'alerte
+        # courante, ainsi que l'agrégat courant (fusionné dans ses
+        # prédécesseurs).
+        obsolete = list(succeeding_aggregates_id or [])
+        if idcorrevent:
+            LOGGER.debug('Deleting obsolete aggregate #%d', idcorrevent)
+            DBSession.query(CorrEvent).filter(
+                CorrEvent.idcorrevent == idcorrevent).delete()
+            obsolete.append(idcorrevent)
+        if obsolete:
+            outcome.publish(self.publisher.delete_published_aggregates,
+                            obsolete)
+
+        DBSession.flush()
+        return True
 
     @defer.inlineCallbacks
     def _aggregate_topologically(self, ctx, correvent, raw_event_id, item_id):
@@ -156,6 +394,8 @@ class CorrEventBuilder(object):
 
         @param ctx: Contexte de corrélation.
         @type ctx: L{Context}
+        @param correvent: Événement corrélé courant ou C{None}.
+        @type correvent: L{CorrEvent} ou L{CorrEventRow}
         @param raw_event_id: Identifiant de l'événement brut.
         @type raw_event_id: C{int}
         @param item_id: Identifiant de l'objet supervisé concerné.
@@ -164,129 +404,61 @@ class CorrEventBuilder(object):
             dans un autre (C{True}) ou non (C{False}).
         @rtype: L{bool}
         """
-        # Ajoute l'alerte aux agrégats prédécesseurs dont elle dépend.
-        predecessing_aggregates_id = yield ctx.get('predecessors_aggregates')
-        if not predecessing_aggregates_id:
-            defer.returnValue(False)
-
-        succeeding_aggregates_id = yield ctx.get('successors_aggregates')
-        dependent_event_list = set()
-        is_built_dependent_event_list = False
-        predecessors_count = 0
-
-        # Pour chaque agrégat dont l'alerte dépend,
-        for predecessing_aggregate_id in predecessing_aggregates_id:
-            predecessing_aggregate_id = int(predecessing_aggregate_id)
-            try:
-                yield self.database.run(
-                    DBSession.query(CorrEvent).filter(
-                        CorrEvent.idcorrevent == predecessing_aggregate_id
-                    ).one,
-                    transaction=False,
-                )
-                predecessors_count += 1
-            except NoResultFound:
-                LOGGER.error(_('Got a reference to a nonexistent '
-                        'correlated event (%r), skipping this aggregate'),
-                        int(predecessing_aggregate_id))
-
-            else:
-                # D'abord on rattache l'alerte
-                # courante à cet agrégat dans la BDD.
-                yield add_to_aggregate(
-                    raw_event_id,
-                    predecessing_aggregate_id,
-                    self.database,
-                    ctx,
-                    item_id,
-                    merging=True
-                )
-
-                # Ensuite on fusionne les éventuels agrégats
-                # dépendant de l'alerte courante avec cet agrégat.
-                if succeeding_aggregates_id:
-                    for succeeding_aggregate_id in succeeding_aggregates_id:
-                        events = yield merge_aggregates(
-                            int(succeeding_aggregate_id),
-                            predecessing_aggregate_id,
-                            self.database,
-                            ctx
-                        )
-                        if not is_built_dependent_event_list:
-                            dependent_event_list.update(events)
-                            is_built_dependent_event_list = True
-
-        # On rattache l'alerte courante aux agrégats sur le bus.
-        yield self.publisher.publish_aggregate(
-                          predecessing_aggregates_id, [raw_event_id])
-
-        if succeeding_aggregates_id:
-            # On publie également sur le bus la
-            # liste des alertes brutes (dépendantes de
-            # l'alerte courante) à rattacher à ces agrégats.
-            yield self.publisher.publish_aggregate(
-                predecessing_aggregates_id,
-                list(dependent_event_list))
-            # Enfin on supprime du bus les agrégats
-            # qui dépendaient de l'alerte courante.
-            yield self.publisher.delete_published_aggregates(succeeding_aggregates_id)
-
-        if correvent:
-            # On supprime l'agrégat courant (fusionné dans ses prédécesseurs).
-            LOGGER.debug('Deleting obsolete aggregate #%d', correvent.idcorrevent)
-            yield self.database.run(
-                DBSession.query(CorrEvent).filter(
-                    CorrEvent.idcorrevent == correvent.idcorrevent).delete,
-                transaction=False
-            )
-            yield self.publisher.delete_published_aggregates(correvent.idcorrevent)
-
-        yield self.database.run(DBSession.flush, transaction=False)
-        defer.returnValue(predecessors_count != 0)
+        data = yield ctx.getMulti(('predecessors_aggregates',
+                                   'successors_aggregates'))
+        outcome = BuildOutcome()
+        aggregated = yield self.database.run(
+            self._aggregate_in_db,
+            outcome,
+            correvent and correvent.idcorrevent,
+            raw_event_id,
+            item_id,
+            data['predecessors_aggregates'],
+            data['successors_aggregates'],
+            transaction=False,
+        )
+        yield self._publish(ctx, outcome)
+        defer.returnValue(aggregated)
 
-    @defer.inlineCallbacks
-    def _fill_with_context(self, ctx, info_dictionary, correvent, timestamp):
+    def _fill_with_context(self, data, info_dictionary, correvent, timestamp):
         """
         Renseigne les champs d'un événement corrélé et ceux
         du dictionnaire d'information à partir des données
         du contexte de corrélation.
 
-        @param ctx: Contexte de corrélation.
-        @type ctx: L{Context}
+        @param data: Attributs du contexte de corrélation.
+        @type data: C{dict}
         @param info_dictionary: Dictionnaire d'information sur l'événement
             en cours de traitement.
         @type info_dictionary: C{dict}
         @param correvent: Événement corrélé à alimenter.
-        @type correvent: L{CorrEvent}
+        @type correvent: L{CorrEvent} ou L{CorrEventRow}
         @param timestamp: Horodatage de l'événement.
         @type timestamp: C{datetime.DateTime}
         """
         # Priorité de l'incident.
-        priority = yield ctx.get('priority')
+        priority = data.get('priority')
         if priority is None:
             priority = settings['correlator'].as_int('unknown_priority_value')
         correvent.priority = priority
         info_dictionary["priority"] = priority
 
         # Nombre d'occurrences du problème.
-        occurrences = yield ctx.get('occurrences_count')
+        occurrences = data.get('occurrences_count')
         if not occurrences is None:
             correvent.occurrence = occurrences
             info_dictionary["occurrence"] = occurrences
 
         # Stockage des services de haut niveau impactés.
-        impacted_hls = yield ctx.get('impacted_hls')
+        impacted_hls = data.get('impacted_hls')
         info_dictionary["highlevel"] = []
         if impacted_hls:
+            # Les noms sont lus depuis le cache ; les services
+            # absents du cache sont recherchés en une seule requête.
+            names = hlsnames.get_names(impacted_hls)
             for hls in impacted_hls:
-                service = yield self.database.run(
-                    DBSession.query(HighLevelService.servicename
-                    ).filter(HighLevelService.idservice == hls
-                    ).first,
-                    transaction=False
-                )
-                if service:
-                    info_dictionary["highlevel"].append(service.servicename)
+                if hls in names:
+                    info_dictionary["highlevel"].append(names[hls])
                 else:
                     LOGGER.debug('Could not find impacted HLS with id #%d', hls)
 
@@ -294,16 +466,16 @@ class CorrEventBuilder(object):
         if correvent.timestamp_active is None:
             correvent.timestamp_active = timestamp
 
-    @defer.inlineCallbacks
-    def _handle_closed_correvent(self, ctx, correvent, state, timestamp, item_id):
+    def _handle_closed_correvent(self, outcome, correvent, state,
+                                 timestamp, item_id):
         """
         Traite un événement corrélé dont l'état d'acquittement
         vaut "Acquitté" ou "Acquitté et clos".
 
-        @param ctx: Contexte de corrélation.
-        @type ctx: L{Context}
+        @param outcome: Résultat du traitement en cours.
+        @type outcome: L{BuildOutcome}
         @param correvent: Evénement corrélé sur lequel on opère.
-        @type correvent: L{CorrEvent}
+        @type correvent: L{CorrEvent} ou L{CorrEventRow}
         @param state: État de l'événement.
         @type state: C{str}
         @param timestamp: Horodatage de l'événement.
@@ -326,146 +498,99 @@ class CorrEventBuilder(object):
                 timestamp=timestamp,
                 username=None,
             )
-            yield self.database.run(DBSession.add, history, transaction=False)
+            DBSession.add(history)
             correvent.ack = CorrEvent.ACK_NONE
 
         # Si l'événement a été marqué comme traité et que le nouveau état
         # indique la résolution effective du problème, l'événement corrélé
         # doit être fermé.
         else:
-            yield ctx.setShared('open_aggr:%d' % item_id, 0)
+            outcome.set_open_aggr(item_id, 0)
 
-    @defer.inlineCallbacks
-    def _disaggregate(self, ctx, correvent, update_id, timestamp):
+    def _disaggregate(self, outcome, correvent, update_id, timestamp):
         """
         Procède à la désagrégation de l'événement corrélé courant.
 
-        @param ctx: Contexte de corrélation.
-        @type ctx: L{Context}
+        La désagrégation est réalisée à l'aide d'opérations ensemblistes
+        dont le nombre ne dépend pas de la taille de l'agrégat : création
+        en une fois des nouveaux événements corrélés, puis réaffectation
+        en une fois des événements bruts de l'agrégat initial.
+
+        @param outcome: Résultat du traitement en cours.
+        @type outcome: L{BuildOutcome}
         @param correvent: Événement corrélé en cours de modification.
-        @type correvent: L{CorrEvent}
+        @type correvent: L{CorrEventRow}
         @param update_id: Identifiant de l'événement corrélé courant.
         @type update_id: C{int}
         @param timestamp: Horodatage de l'événement.
         @type timestamp: C{datetime.DateTime}
         """
-        cause = aliased(Event)
-        others = aliased(Event)
         # On détermine les causes des nouveaux événements corrélés
         # (ceux obtenus par désagrégation de l'événement courant).
-        new_causes = yield self.database.run(
-            DBSession.query(
-                EventsAggregate.idevent,
-                DependencyGroup.iddependent,
-            ).join(
-                (CorrEvent,
-                    CorrEvent.idcorrevent == EventsAggregate.idcorrevent),
-                (others, others.idevent == EventsAggregate.idevent),
-                (DependencyGroup,
-                    DependencyGroup.iddependent == others.idsupitem),
-                (Dependency, Dependency.idgroup == DependencyGroup.idgroup),
-                (cause, cause.idevent == CorrEvent.idcause),
-            ).filter(EventsAggregate.idevent != CorrEvent.idcause
-            ).filter(Dependency.idsupitem == cause.idsupitem
-            ).filter(Dependency.distance == 1
-            ).filter(DependencyGroup.role == u'topology'
-            ).filter(CorrEvent.idcorrevent == update_id).all,
-            transaction=False
-        )
-
-        # Pour chacune des nouvelles causes, on crée
-        # le nouvel événement corrélé.
-        for new_cause in new_causes:
-            LOGGER.debug(_('Creating new aggregate with cause #%(cause)d '
-                           '(#%(supitem)d) from aggregate #%(original)d'),
-                           {
-                                'original': update_id,
-                                'cause': new_cause.idevent,
-                                'supitem': new_cause.iddependent,
-                            })
+        new_causes = []
+        cause_ids = set()
+        for new_cause in queries.fetch_all(
+                queries.DISAGGREGATION_CAUSES, idcorrevent=update_id):
+            if new_cause.idevent not in cause_ids:
+                cause_ids.add(new_cause.idevent)
+                new_causes.append(new_cause)
+
+        if new_causes:
+            # Retrait des événements bruts causes des autres agrégats.
             # Inutile d'appeler remove_from_all_aggregates() ici
             # car on désagrège déjà manuellement l'agrégat initial.
-            new_correvent = CorrEvent(
-                idcause=new_cause.idevent,
-                priority=settings['correlator'].as_int(
-                            'unknown_priority_value'),
-                # On ne recopie pas le ticket d'incident
-                # et on place l'événement corrélé dans
-                # l'état d'acquittement initial.
-                ack=CorrEvent.ACK_NONE,
-                occurrence=1,
-                timestamp_active=timestamp, # @XXX: ou datetime.utcnow() ?
-            )
-            yield self.database.run(
-                DBSession.add, new_correvent,
-                transaction=False,
-            )
-
-            # Retrait de l'événement brut cause des autres agrégats.
-            yield self.database.run(
-                DBSession.query(
-                    EventsAggregate
-                ).filter(EventsAggregate.idevent == new_cause.idevent,
-                ).filter(EventsAggregate.idcorrevent != update_id
-                ).delete,
-                transaction=False,
-            )
-
-            yield self.database.run(
-                DBSession.flush,
-                transaction=False,
-            )
-
-            # On ajoute à cet agrégat les événements bruts
-            # qui s'y rapportent (cf. topologie réseau).
-            raw_events = yield self.database.run(
-                DBSession.query(
-                    Event.idevent,
-                    Event.idsupitem,
-                ).join(
-                    (DependencyGroup,
-                        DependencyGroup.iddependent == Event.idsupitem),
-                    (Dependency, Dependency.idgroup == DependencyGroup.idgroup),
-                    (EventsAggregate, EventsAggregate.idevent == Event.idevent),
-                ).filter(Dependency.idsupitem == new_cause.iddependent
-                ).filter(DependencyGroup.role == u'topology'
-                ).filter(EventsAggregate.idcorrevent == update_id).all,
-                transaction=False,
+            detach_events(cause_ids, update_id)
+
+            # Création des nouveaux événements corrélés. On ne recopie
+            # pas le ticket d'incident et on les place dans l'état
+            # d'acquittement initial.
+            created = insert_correvents(
+                [new_cause.idevent for new_cause in new_causes],
+                settings['correlator'].as_int('unknown_priority_value'),
+                timestamp, # @XXX: ou datetime.utcnow() ?
             )
-            for raw_event in raw_events:
-                yield add_to_aggregate(
-                    raw_event.idevent,
-                    new_correvent.idcorrevent,
-                    self.database,
-                    ctx,
-                    raw_event.idsupitem,
-                    merging=False
-                )
-
-            # Association de l'événement brut cause dans le nouvel agrégat.
-            yield add_to_aggregate(
-                new_cause.idevent,
-                new_correvent.idcorrevent,
-                self.database,
-                ctx,
-                new_cause.iddependent,
-                merging=False
-            )
-            # @XXX: redemander l'état de l'équipement à Nagios ?
 
-        # Prise en compte des modifications précédentes.
-        yield self.database.run(DBSession.flush, transaction=False)
+            # Événements bruts de l'agrégat initial, indexés par
+            # les éléments supervisés dont ils dépendent (cf. topologie).
+            dependents = {}
+            for raw_event in queries.fetch_all(
+                    queries.DISAGGREGATION_EVENTS, idcorrevent=update_id):
+                # Une cause est uniquement rattachée à son propre agrégat.
+                if raw_event.idevent in cause_ids:
+                    continue
+                dependents.setdefault(raw_event.idancestor, []).append(
+                    (raw_event.idevent, raw_event.idsupitem))
+
+            # On ajoute à chaque agrégat les événements bruts qui s'y
+            # rapportent, puis son événement brut cause.
+            entries = []
+            for new_cause in new_causes:
+                new_id = created[new_cause.idevent]
+                LOGGER.debug(_('Creating new aggregate with cause #%(cause)d '
+                               '(#%(supitem)d) from aggregate #%(original)d'),
+                               {
+                                    'original': update_id,
+                                    'cause': new_cause.idevent,
+                                    'supitem': new_cause.iddependent,
+                                })
+                for idevent, idsupitem in dependents.get(
+                        new_cause.iddependent, ()):
+                    entries.append((idevent, new_id, idsupitem))
+                entries.append((new_cause.idevent, new_id,
+                                new_cause.iddependent))
+                priorities.set_after_commit(new_cause.iddependent, new_id,
+                    settings['correlator'].as_int('unknown_priority_value'))
+                # @XXX: redemander l'état de l'équipement à Nagios ?
+
+            inserted = set(insert_aggregate_entries(
+                [(idevent, new_id) for (idevent, new_id, _i) in entries]))
+            for idevent, new_id, idsupitem in entries:
+                if (idevent, new_id) in inserted:
+                    outcome.set_open_aggr(idsupitem, new_id)
 
         # Suppression de l'association entre l'ancien agrégat
         # et les événements bruts qu'il contenait (sauf pour sa cause).
-        yield self.database.run(
-            DBSession.query(EventsAggregate
-                ).filter(EventsAggregate.idcorrevent == update_id
-                ).filter(EventsAggregate.idevent != correvent.idcause
-                ).delete,
-            transaction=False,
-        )
-        yield self.database.run(DBSession.flush, transaction=False)
+        empty_aggregate(update_id, correvent.idcause)
 
     def _log_correvent(self, info_dictionary):
         """
@@ -489,45 +614,61 @@ class CorrEventBuilder(object):
                         info_dictionary.get('message', ''),
                     )
 
-    @defer.inlineCallbacks
-    def _aggregate_successors(self, ctx, idcorrevent):
+    def _aggregate_successors(self, outcome, idcorrevent, aggregates_id):
         """
         Procède à l'agrégation des successeurs de l'événement
         corrélé courant.
 
-        @param ctx: Contexte de corrélation.
-        @type ctx: L{Context}
+        @param outcome: Résultat du traitement en cours.
+        @type outcome: L{BuildOutcome}
         @param idcorrevent: Identifiant de l'événement corrélé courant.
         @type idcorrevent: C{int}
+        @param aggregates_id: Agrégats successeurs à rattacher.
+        @type aggregates_id: C{list} of C{int}
         """
         # Si un ou plusieurs agrégats dépendant de l'alerte sont
         # spécifiés dans le contexte par la règle de corrélation
         # topologique des services de bas niveau (lls_dep), alors
         # on rattache ces agrégats à l'agrégat nouvellement créé.
-        aggregates_id = yield ctx.get('successors_aggregates')
         if aggregates_id:
-            event_id_list = []
-            for aggregate_id in aggregates_id:
-                events_id = yield merge_aggregates(
-                    int(aggregate_id),
-                    idcorrevent,
-                    self.database,
-                    ctx
-                )
-                if events_id:
-                    event_id_list.extend(events_id)
+            event_id_list = self._merge_aggregates(
+                outcome, aggregates_id, idcorrevent)
             # On publie sur le bus la liste des alertes brutes
             # à rattacher à l'événement corrélé nouvellement créé.
-            yield self.publisher.publish_aggregate([idcorrevent], event_id_list)
-            yield self.publisher.delete_published_aggregates(aggregates_id)
+            outcome.publish(self.publisher.publish_aggregate,
+                            [idcorrevent], event_id_list)
+            outcome.publish(self.publisher.delete_published_aggregates,
+                            aggregates_id)
 
     @defer.inlineCallbacks
+    def _publish(self, ctx, outcome):
+        """
+        Applique les effets d'un traitement réalisé dans le thread
+        de la base de données : mise à jour du cache des agrégats
+        ouverts puis publication des messages sur le bus.
+
+        @param ctx: Contexte de corrélation.
+        @type ctx: L{Context}
+        @param outcome: Résultat du traitement.
+        @type outcome: L{BuildOutcome}
+        """
+        if outcome.shared:
+            yield ctx.setSharedMulti(outcome.shared)
+        for func, args in outcome.actions:
+            yield func(*args)
+
     def make_correvent(self, info_dictionary):
         """
         Récupère dans le contexte les informations transmises par
         les règles, crée les événements corrélés (agrégats d'événements)
         nécessaires dans la base de données et les transmet au bus.
 
+        Le traitement se déroule en trois étapes :
+            -   lecture en une seule requête des attributs du contexte,
+            -   opérations sur la base de données, réalisées en une seule
+                fois par le thread de la base de données (cf. L{_build}),
+            -   mise à jour du cache et publication des messages sur le bus.
+
         Permet de satisfaire les exigences suivantes :
             - VIGILO_EXIG_VIGILO_COR_0040,
 
@@ -537,10 +678,26 @@ class CorrEventBuilder(object):
         @return: Instance de l'événement corrélé créé ou mis à jour
             ou C{None} si le traitement n'a pas engendré la création
             ni la mise à jour d'un événement corrélé.
-        @rtype: L{CorrEvent}
+        @rtype: L{CorrEvent} ou L{CorrEventRow}
+        """
+        # Toutes les opérations sur la base de données liées à cet
+        # événement sont exécutées par le même thread, dans la même
+        # transaction (cf. RuleDispatcher._send_result).
+        item_id = info_dictionary.get('idsupitem')
+        if item_id is None:
+            return self._make_correvent(info_dictionary)
+        builder = copy.copy(self)
+        builder.database = self.database.pinned(item_id)
+        return builder._make_correvent(info_dictionary)
+
+    @defer.inlineCallbacks
+    def _make_correvent(self, info_dictionary):
+        """
+        Voir L{CorrEventBuilder.make_correvent}.
         """
         ctx = self.context_factory(info_dictionary["id"], transaction=False)
-        raw_event_id = yield ctx.get('raw_event_id')
+        data = yield ctx.getMulti(CONTEXT_ATTRIBUTES)
+        raw_event_id = data['raw_event_id']
 
         # Il peut y avoir plusieurs raisons à l'absence d'un ID brut :
         # - l'alerte brute portait sur un HLS; dans ce cas il ne s'agit pas
@@ -555,13 +712,9 @@ class CorrEventBuilder(object):
         if raw_event_id is None:
             defer.returnValue(None)
 
-        state = info_dictionary['state']
-        timestamp = info_dictionary['timestamp']
-
         # Si une règle ou un callback demande explicitement qu'aucune
         # alerte ne soit générée pour cet événement, on lui obéit ici.
-        stop = yield ctx.get('no_alert')
-        if stop:
+        if data['no_alert']:
             hostname = info_dictionary['host']
             servicename = info_dictionary['service']
             LOGGER.info(_(
@@ -573,38 +726,75 @@ class CorrEventBuilder(object):
             })
             defer.returnValue(None)
 
-        item_id = yield ctx.get('idsupitem')
+        outcome = yield self.database.run(
+            self._build,
+            info_dictionary,
+            data,
+            transaction=False,
+        )
+        yield self._publish(ctx, outcome)
+        defer.returnValue(outcome.correvent)
+
+    def _build(self, info_dictionary, data):
+        """
+        Réalise l'ensemble des opérations sur la base de données
+        nécessaires au traitement de l'événement courant.
+
+        Les effets qui ne concernent pas la base de données
+        (cache des agrégats ouverts, messages à publier) sont
+        consignés dans le résultat retourné, afin d'être appliqués
+        ensuite par le réacteur.
 
-        # Identifiant de l'événement corrélé à mettre à jour.
-        update_id = yield self._get_update_id(item_id)
+        @note: Cette méthode doit être exécutée dans le thread
+            dédié à la base de données.
+        @param info_dictionary: Dictionnaire contenant les informations
+            concernant l'événement en cours de trairement.
+        @type info_dictionary: C{dict}
+        @param data: Attributs du contexte de corrélation.
+        @type data: C{dict}
+        @return: Résultat du traitement.
+        @rtype: L{BuildOutcome}
+        """
+        outcome = BuildOutcome()
+        raw_event_id = data['raw_event_id']
+        item_id = data['idsupitem']
+        state = info_dictionary['state']
+        timestamp = info_dictionary['timestamp']
 
-        correvent = None
-        if update_id is not None:
-            # On récupère l'événement corrélé existant pour mise à jour.
-            correvent = yield self._get_updated_correvent(update_id, timestamp)
+        # On récupère l'événement corrélé existant pour mise à jour.
+        correvent = self._get_updated_correvent(item_id, timestamp)
 
-        # Il s'agit d'une création ou bien l'événement corrélé
-        # indiqué n'existe pas.
+        # Il s'agit d'une création.
         if correvent is None:
             update_id = None
 
             # Si l'état de l'alerte brute est 'OK' ou 'UP', on ne fait rien.
             if state in ("OK", "UP"):
                 LOGGER.info(_('Raw event ignored. Reason: status = %r'), state)
-                defer.returnValue(None)
+                return outcome
+        else:
+            update_id = correvent.idcorrevent
 
-        aggregated = yield self._aggregate_topologically(ctx, correvent, raw_event_id,
-                                                             item_id)
+        aggregated = self._aggregate_in_db(
+            outcome,
+            correvent and correvent.idcorrevent,
+            raw_event_id,
+            item_id,
+            data['predecessors_aggregates'],
+            data['successors_aggregates'],
+        )
         if aggregated:
-           LOGGER.debug("Event #%d masked due to topological aggregation",
-                        raw_event_id)
-           defer.returnValue(None)
+            LOGGER.debug("Event #%d masked due to topological aggregation",
+                         raw_event_id)
+            # L'éventuel événement corrélé de l'élément a été supprimé.
+            priorities.set_after_commit(item_id, None, None)
+            return outcome
 
         if correvent is None:
             # Lorsqu'un nouvel agrégat doit être créé, il se peut que la cause
             # ait anciennement fait partie d'autres agrégats désormais OK/UP.
             # On doit supprimer ces associations avant de continuer (cf. #1027).
-            yield remove_from_all_aggregates(raw_event_id, self.database)
+            remove_aggregate_entries(raw_event_id)
 
             # Création du nouvel agrégat à partir de son événement cause.
             LOGGER.debug(_('Creating a new correlated event'))
@@ -613,36 +803,24 @@ class CorrEventBuilder(object):
 
         # On remplit l'événement corrélé et le dictionnaire d'infos
         # à partir du contexte de corrélation.
-        yield self._fill_with_context(ctx, info_dictionary,
-                                      correvent, timestamp)
+        self._fill_with_context(data, info_dictionary, correvent, timestamp)
 
         if correvent.ack == CorrEvent.ACK_CLOSED:
-            yield self._handle_closed_correvent(ctx, correvent, state,
-                                                timestamp, item_id)
+            self._handle_closed_correvent(outcome, correvent, state,
+                                          timestamp, item_id)
 
         # On sauvegarde l'événement corrélé dans la base de données.
-        yield self.database.run(DBSession.add, correvent, transaction=False)
-        yield self.database.run(DBSession.flush, transaction=False)
-
-        # Récupération de l'identifiant de l'agrégat pour plus tard.
-        # Doit être fait via db_thread. En pratique, cela signifie qu'on
-        # doit faire un merge() pour fetcher à nouveau tous les attributs
-        # avant de pouvoir y accéder depuis le thread principal.
-        correvent = yield self.database.run(
-            DBSession.merge,
-            correvent,
-            transaction=False)
+        self._save_correvent(correvent)
         idcorrevent = correvent.idcorrevent
+        if state in ('OK', 'UP') and correvent.ack == CorrEvent.ACK_CLOSED:
+            priorities.set_after_commit(item_id, None, None)
+        else:
+            priorities.set_after_commit(item_id, idcorrevent,
+                                        correvent.priority)
 
         # Ajout de l'alerte brute dans l'agrégat.
-        yield add_to_aggregate(
-            raw_event_id,
-            idcorrevent,
-            self.database,
-            ctx,
-            item_id,
-            merging=False
-        )
+        self._add_to_aggregate(outcome, raw_event_id, idcorrevent,
+                               item_id, merging=False)
 
         if update_id is None:
             info_dictionary['update'] = False
@@ -656,13 +834,15 @@ class CorrEventBuilder(object):
             if state in ('OK', 'UP'):
                 # La cause de l'événement corrélé n'est plus en panne,
                 # on tente de désagréger les événements bruts associés.
-                yield self._disaggregate(ctx, correvent, update_id, timestamp)
+                self._disaggregate(outcome, correvent, update_id, timestamp)
 
         # On envoie le message correvent correspondant sur le bus
         # et on enregistre une trace dans les logs.
-        yield self.publisher.sendMessage(info_dictionary)
-        self._log_correvent(info_dictionary)
-
-        yield self._aggregate_successors(ctx, idcorrevent)
-        yield self.database.run(DBSession.flush, transaction=False)
-        defer.returnValue(correvent)
+        outcome.publish(self.publisher.publish_correvent, info_dictionary)
+        outcome.publish(self._log_correvent, info_dictionary)
+
+        self._aggregate_successors(outcome, idcorrevent,
+                                   data['successors_aggregates'])
+        DBSession.flush()
+        outcome.correvent = correvent
+        return outcome
@@ -6,20 +6,22 @@
 Traite l'insertion en base de données.
 """
 
-from sqlalchemy import not_, and_, or_
-from sqlalchemy.orm import aliased
-from sqlalchemy.sql import literal
+from sqlalchemy import not_
+from sqlalchemy.sql import text, select
 
 from twisted.internet import defer
 from datetime import datetime
 
 from vigilo.common.logging import get_logger
 from vigilo.models.session import DBSession
-from vigilo.models.tables import StateName, State, HLSHistory
+from vigilo.models.tables import State, HLSHistory
 from vigilo.models.tables import Event, EventHistory, CorrEvent
 from vigilo.models.tables.secondary_tables import EVENTSAGGREGATE_TABLE
 from vigilo.models.tables.eventsaggregate import EventsAggregate
 from vigilo.common.gettext import translate
+from vigilo.correlator import statenames
+from vigilo.correlator import queries
+from vigilo.correlator.history_writer import get_history_writer
 
 _ = translate(__name__)
 LOGGER = get_logger(__name__)
@@ -27,17 +29,113 @@ LOGGER = get_logger(__name__)
 __all__ = (
     'insert_event',
     'insert_state',
+    'insert_states',
     'insert_hls_history',
     'add_to_aggregate',
-    'merge_aggregates'
+    'insert_aggregate_entries',
+    'insert_correvents',
+    'remove_aggregate_entries',
+    'detach_events',
+    'empty_aggregate',
+    'merge_aggregates',
+    'merge_aggregate_entries',
 )
 
 
+# Nombre maximum de lignes envoyées dans une même requête
+# d'insertion multiple (limite le nombre de paramètres liés).
+BULK_CHUNK_SIZE = 1000
+
+
 class OldStateReceived(object):
     def __init__(self, current, received):
         self.current = current
         self.received = received
 
+
+def _supports_upsert(table):
+    """
+    Indique si la base de données associée à la table donnée
+    supporte la syntaxe C{INSERT ... ON CONFLICT} (PostgreSQL >= 9.5).
+
+    @param table: Table sur laquelle porte la requête.
+    @type table: C{sqlalchemy.Table}
+    @rtype: C{bool}
+    """
+    bind = DBSession.get_bind(clause=table)
+    if bind.dialect.name != 'postgresql':
+        return False
+    version = bind.dialect.server_version_info
+    return version is not None and version >= (9, 5)
+
+
+def _values_clause(rows, keys):
+    """
+    Construit la clause C{VALUES} d'une requête d'insertion multiple
+    ainsi que les paramètres liés correspondants.
+
+    @param rows: Lignes à insérer.
+    @type rows: C{list} of C{dict}
+    @param keys: Noms des colonnes, dans l'ordre de la requête.
+    @type keys: C{tuple} of C{str}
+    @return: Le texte de la clause et le dictionnaire des paramètres.
+    @rtype: C{tuple}
+    """
+    params = {}
+    values = []
+    for index, row in enumerate(rows):
+        names = []
+        for key in keys:
+            name = '%s_%d' % (key, index)
+            names.append(':' + name)
+            params[name] = row[key]
+        values.append('(%s)' % ', '.join(names))
+    return ', '.join(values), params
+
+def _flush_session():
+    """
+    Envoie les éventuelles modifications en attente dans la session
+    de l'ORM, avant l'exécution de requêtes qui contournent celle-ci
+    (à la manière de L{vigilo.correlator.queries.execute}).
+    """
+    DBSession.flush()
+
+def _refresh_aggregates(idcorrevents, deleted=()):
+    """
+    Signale à l'ORM que la composition des agrégats donnés a été modifiée
+    par une requête qui contourne la session.
+
+    Seule la relation C{events} des agrégats est invalidée, afin que les
+    autres attributs restent accessibles depuis les autres threads sans
+    provoquer de nouvelle requête. Les agrégats supprimés sont retirés
+    de la session.
+
+    @param idcorrevents: Identifiants des agrégats modifiés.
+    @type idcorrevents: C{set} of C{int}
+    @param deleted: Identifiants des agrégats supprimés.
+    @type deleted: C{iterable} of C{int}
+    """
+    deleted = set(deleted)
+    if not idcorrevents and not deleted:
+        return
+    for obj in DBSession.identity_map.values():
+        if isinstance(obj, CorrEvent) and obj.idcorrevent in deleted:
+            DBSession.expunge(obj)
+        elif isinstance(obj, CorrEvent) and obj.idcorrevent in idcorrevents:
+            DBSession.expire(obj, ['events'])
+        elif isinstance(obj, EventsAggregate) and \
+            obj.idcorrevent in idcorrevents:
+            DBSession.expunge(obj)
+
+def _chunks(items, size=None):
+    """
+    Découpe une liste en tranches d'au plus C{size} éléments.
+    """
+    if size is None:
+        size = BULK_CHUNK_SIZE
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
 def insert_event(info_dictionary):
     """
     Insère un événement dans la BDD.
@@ -79,71 +177,17 @@ def insert_event(info_dictionary):
                        })
         return None
 
-    # On recherche en priorité un événement brut qui cause un événement
-    # corrélé encore actif et qui porte sur l'objet supervisé indiqué.
-    event1 = DBSession.query(
-            Event,
-            literal(1).label("rank"),
-        ).join(
-            (CorrEvent, CorrEvent.idcause == Event.idevent),
-        ).filter(Event.idsupitem == info_dictionary['idsupitem']
-        ).filter(
-            not_(
-                and_(
-                    Event.current_state.in_([
-                        StateName.statename_to_value(u'OK'),
-                        StateName.statename_to_value(u'UP')
-                    ]),
-                    CorrEvent.ack == CorrEvent.ACK_CLOSED
-                )
-            )
-        )
-
-    # En second choix, on recherche un événement brut qui appartient
-    # à l'agrégat d'un événement corrélé encore actif.
-    cause_event = aliased(Event)
-    found_event = aliased(Event)
-    event2 = DBSession.query(
-            found_event,
-            literal(2).label("rank"),
-        ).join(
-            (EVENTSAGGREGATE_TABLE,
-                EVENTSAGGREGATE_TABLE.c.idevent == found_event.idevent),
-            (CorrEvent,
-                CorrEvent.idcorrevent == EVENTSAGGREGATE_TABLE.c.idcorrevent),
-            (cause_event, cause_event.idevent == CorrEvent.idcause),
-        ).filter(found_event.idsupitem == info_dictionary['idsupitem']
-        ).filter(
-            not_(
-                and_(
-                    cause_event.current_state.in_([
-                        StateName.statename_to_value(u'OK'),
-                        StateName.statename_to_value(u'UP')
-                    ]),
-                    CorrEvent.ack == CorrEvent.ACK_CLOSED
-                )
-            )
-        )
-
-    # En troisième choix, on se rabat sur un événement brut qui n'appartient
-    # à aucun agrégat et qui n'est la cause d'aucun événement corrélé
-    # (situation anormale, mais qu'on ne veut pas aggraver, cf. #908).
-    event3 = DBSession.query(
-            Event,
-            literal(3).label("rank"),
-        ).filter(Event.idsupitem == info_dictionary['idsupitem']
-        ).filter(~Event.idsupitem.in_(
-            DBSession.query(EVENTSAGGREGATE_TABLE.c.idevent))
-        ).filter(~Event.idsupitem.in_(
-            DBSession.query(CorrEvent.idcause)))
-
-    # Retourne 2 des événements trouvés, triés par préférence (rank).
-    # La limite permet de détecter les situations anormales (doublons).
-    event = event1.union_all(event2, event3).order_by("rank", Event.idevent
-                ).distinct("rank", Event.idevent).limit(2).all()
+    # On recherche l'événement brut à mettre à jour, par ordre de
+    # préférence (cf. queries.RAW_EVENT_CANDIDATES pour les critères).
+    candidates = queries.fetch_entities(
+        Event,
+        queries.RAW_EVENT_CANDIDATES,
+        idsupitem=info_dictionary['idsupitem'],
+        **queries.state_params()
+    )
 
     # Si aucun événement correpondant à cet item ne figure dans la base
-    if not event:
+    if not candidates:
         # Si l'état de cette alerte est 'OK', on l'ignore
         if info_dictionary["state"] == "OK" or \
             info_dictionary["state"] == "UP":
@@ -158,19 +202,19 @@ def insert_event(info_dictionary):
 
     # Si plusieurs événements ont été trouvés
     else:
-        event_ids = set(e[0].idevent for e in event)
+        event_ids = set(candidate.idevent for candidate in candidates)
         if len(event_ids) > 1:
             # Ce n'est pas vraiment normal, mais on fait de notre mieux
             # pour ne pas faire empirer la situation.
             LOGGER.warning(_('Multiple raw events found (%s), '
                              'using the first one available.') %
-                            ', '.join(sorted(event_ids)))
-        # On prend le premier Event parmi la liste des tuples (Event, rank).
-        event = event[0][0]
+                            ', '.join(str(i) for i in sorted(event_ids)))
+        # On prend le premier Event parmi ceux trouvés (triés par rang).
+        event = candidates[0]
         LOGGER.debug(_('Updating event %r'), event.idevent)
 
     # Nouvel état.
-    new_state_value = StateName.statename_to_value(info_dictionary['state'])
+    new_state_value = statenames.statename_to_value(info_dictionary['state'])
     is_new_event = event.idevent is None
 
     # S'agit-il d'un événement important ?
@@ -191,20 +235,15 @@ def insert_event(info_dictionary):
 
     # Les événements importants donnent lieu à l'ajout
     # d'une entrée dans l'historique.
-    if info_dictionary['important']:
+    writer = get_history_writer()
+    if info_dictionary['important'] and writer is None:
         history = EventHistory()
 
         history.type_action = is_new_event and \
                                 u'New occurrence' or \
                                 u'Nagios update state'
 
-        try:
-            history.state = \
-                StateName.statename_to_value(info_dictionary['state'])
-        except KeyError:
-            # Si le nom d'état n'est pas reconnu, on ne fait rien.
-            pass
-
+        history.state = new_state_value
         history.value = info_dictionary['state']
         history.text = info_dictionary['message']
         history.timestamp = info_dictionary['timestamp']
@@ -213,6 +252,21 @@ def insert_event(info_dictionary):
         DBSession.add(history)
 
     DBSession.flush()
+
+    # L'historique est écrit de manière différée,
+    # une fois la transaction courante validée.
+    if info_dictionary['important'] and writer is not None:
+        writer.add_after_commit(EventHistory.__table__, {
+            'type_action': is_new_event and \
+                            u'New occurrence' or \
+                            u'Nagios update state',
+            'idevent': event.idevent,
+            'state': new_state_value,
+            'value': info_dictionary['state'],
+            'text': info_dictionary['message'],
+            'timestamp': info_dictionary['timestamp'],
+            'username': None,
+        })
     return event.idevent
 
 def insert_hls_history(info_dictionary):
@@ -232,14 +286,20 @@ def insert_hls_history(info_dictionary):
                         })
         return None
 
-    history = HLSHistory()
-    history.idhls = info_dictionary['idsupitem']
     # On enregistre l'heure à laquelle le message a
     # été traité plutôt que le timestamp du message.
-    history.timestamp = datetime.utcnow()
-    history.idstatename = StateName.statename_to_value(
-                            info_dictionary['state'])
-    DBSession.add(history)
+    values = {
+        'idhls': info_dictionary['idsupitem'],
+        'timestamp': datetime.utcnow(),
+        'idstatename': statenames.statename_to_value(
+                            info_dictionary['state']),
+    }
+
+    writer = get_history_writer()
+    if writer is not None:
+        writer.add_after_commit(HLSHistory.__table__, values)
+    else:
+        DBSession.add(HLSHistory(**values))
 
 def insert_state(info_dictionary):
     """
@@ -275,12 +335,259 @@ def insert_state(info_dictionary):
     # On met à jour l'état dans la BDD
     state.message = info_dictionary["message"]
     state.timestamp = info_dictionary["timestamp"]
-    state.state = StateName.statename_to_value(info_dictionary["state"])
+    state.state = statenames.statename_to_value(info_dictionary["state"])
 
     DBSession.add(state)
     return previous_state
 
 
+def insert_states(states):
+    """
+    Insère ou met à jour en une seule fois les états de plusieurs
+    éléments supervisés.
+
+    Comme pour L{insert_state}, un état plus ancien que celui déjà
+    enregistré dans la BDD pour un élément est ignoré.
+
+    Sous PostgreSQL, l'opération est réalisée à l'aide d'une seule
+    requête C{INSERT ... ON CONFLICT DO UPDATE}. Pour les autres bases
+    de données (SQLite dans les tests unitaires), les états existants
+    sont récupérés en une requête puis mis à jour via l'ORM.
+
+    @param states: Liste de dictionnaires au même format que celui
+        attendu par L{insert_state}.
+    @type states: C{list} of C{dict}
+    @return: Liste des identifiants des éléments supervisés
+        dont l'état a effectivement été mis à jour.
+    @rtype: C{list} of C{int}
+    """
+    rows = {}
+    for info_dictionary in states:
+        if not info_dictionary['idsupitem']:
+            LOGGER.error(_('Got a reference to a non configured item '
+                           '(%(host)r, %(service)r), skipping state'), {
+                                "host": info_dictionary["host"],
+                                "service": info_dictionary["service"],
+                            })
+            continue
+        # En cas de doublons, seul l'état le plus récent est conservé.
+        previous = rows.get(info_dictionary['idsupitem'])
+        if previous is not None and \
+            previous['timestamp'] > info_dictionary['timestamp']:
+            continue
+        rows[info_dictionary['idsupitem']] = {
+            'idsupitem': info_dictionary['idsupitem'],
+            'state': statenames.statename_to_value(info_dictionary['state']),
+            'message': info_dictionary['message'],
+            'timestamp': info_dictionary['timestamp'],
+        }
+
+    if not rows:
+        return []
+
+    rows = rows.values()
+    if _supports_upsert(State.__table__):
+        return _upsert_states(rows)
+    return _merge_states(rows)
+
+def _upsert_states(rows):
+    """
+    Insère ou met à jour les états à l'aide de la syntaxe
+    C{INSERT ... ON CONFLICT DO UPDATE} de PostgreSQL.
+
+    @param rows: Valeurs des colonnes de la table des états.
+    @type rows: C{list} of C{dict}
+    @return: Identifiants des éléments supervisés mis à jour.
+    @rtype: C{list} of C{int}
+    """
+    table = State.__table__
+    c = table.c
+    _flush_session()
+
+    updated = []
+    for chunk in _chunks(rows):
+        values, params = _values_clause(
+            chunk, ('idsupitem', 'state', 'message', 'timestamp'))
+        query = text(
+            'INSERT INTO %(table)s (%(id)s, %(state)s, %(msg)s, %(ts)s) '
+            'VALUES %(values)s '
+            'ON CONFLICT (%(id)s) DO UPDATE SET '
+            '%(state)s = EXCLUDED.%(state)s, '
+            '%(msg)s = EXCLUDED.%(msg)s, '
+            '%(ts)s = EXCLUDED.%(ts)s '
+            'WHERE %(table)s.%(ts)s <= EXCLUDED.%(ts)s '
+            'RETURNING %(id)s' % {
+                'table': table.name,
+                'id': c.idsupitem.name,
+                'state': c.state.name,
+                'msg': c.message.name,
+                'ts': c.timestamp.name,
+                'values': values,
+            })
+        updated.extend(r[0] for r in DBSession.execute(query, params))
+
+    # Les instances déjà chargées par l'ORM sont désormais obsolètes.
+    updated_ids = set(updated)
+    for obj in DBSession.identity_map.values():
+        if isinstance(obj, State) and obj.idsupitem in updated_ids:
+            DBSession.expire(obj)
+    return updated
+
+def _merge_states(rows):
+    """
+    Insère ou met à jour les états au travers de l'ORM.
+    Les états existants sont récupérés en une seule requête.
+
+    @param rows: Valeurs des colonnes de la table des états.
+    @type rows: C{list} of C{dict}
+    @return: Identifiants des éléments supervisés mis à jour.
+    @rtype: C{list} of C{int}
+    """
+    existing = {}
+    for chunk in _chunks([row['idsupitem'] for row in rows]):
+        for state in DBSession.query(State).filter(
+                State.idsupitem.in_(chunk)).all():
+            existing[state.idsupitem] = state
+
+    updated = []
+    for row in rows:
+        state = existing.get(row['idsupitem'])
+        if state is None:
+            state = State(idsupitem=row['idsupitem'])
+        elif state.timestamp > row['timestamp']:
+            continue
+        state.state = row['state']
+        state.message = row['message']
+        state.timestamp = row['timestamp']
+        DBSession.add(state)
+        updated.append(row['idsupitem'])
+    DBSession.flush()
+    return updated
+
+
+def insert_aggregate_entries(entries):
+    """
+    Rattache des événements bruts à des agrégats, en ignorant
+    les associations qui existent déjà.
+
+    Sous PostgreSQL, l'opération est réalisée à l'aide d'une seule
+    requête C{INSERT ... ON CONFLICT DO NOTHING}. Pour les autres
+    bases de données (SQLite dans les tests unitaires), les associations
+    existantes sont d'abord recherchées en une requête.
+
+    @note: Cette fonction doit être exécutée dans le thread
+        dédié à la base de données.
+    @param entries: Couples (identifiant de l'événement brut,
+        identifiant de l'agrégat).
+    @type entries: C{iterable} of C{tuple}
+    @return: Couples effectivement ajoutés.
+    @rtype: C{list} of C{tuple}
+    """
+    entries = list(set((int(idevent), int(idcorrevent))
+                       for (idevent, idcorrevent) in entries))
+    if not entries:
+        return []
+
+    table = EVENTSAGGREGATE_TABLE
+    c = table.c
+    _flush_session()
+
+    inserted = []
+    if _supports_upsert(table):
+        for chunk in _chunks(entries):
+            values, params = _values_clause(
+                [{'idevent': e, 'idcorrevent': a} for (e, a) in chunk],
+                ('idevent', 'idcorrevent'))
+            query = text(
+                'INSERT INTO %(table)s (%(event)s, %(aggr)s) '
+                'VALUES %(values)s '
+                'ON CONFLICT DO NOTHING '
+                'RETURNING %(event)s, %(aggr)s' % {
+                    'table': table.name,
+                    'event': c.idevent.name,
+                    'aggr': c.idcorrevent.name,
+                    'values': values,
+                })
+            inserted.extend((r[0], r[1])
+                            for r in DBSession.execute(query, params))
+    else:
+        for chunk in _chunks(entries):
+            existing = set(
+                (r.idevent, r.idcorrevent) for r in
+                DBSession.query(c.idevent, c.idcorrevent
+                    ).filter(c.idevent.in_(set(e for (e, a) in chunk))
+                    ).filter(c.idcorrevent.in_(set(a for (e, a) in chunk))
+                    ).all()
+            )
+            missing = [entry for entry in chunk if entry not in existing]
+            if missing:
+                DBSession.execute(table.insert(), [
+                    {'idevent': e, 'idcorrevent': a} for (e, a) in missing
+                ])
+            inserted.extend(missing)
+
+    _refresh_aggregates(set(a for (e, a) in inserted))
+    return inserted
+
+def insert_correvents(causes, priority, timestamp):
+    """
+    Crée en une seule fois plusieurs événements corrélés, dans l'état
+    d'acquittement initial, à partir de leurs événements bruts causes.
+
+    Sous PostgreSQL, les événements corrélés sont créés à l'aide d'une
+    seule requête C{INSERT ... RETURNING}. Pour les autres bases de
+    données (SQLite dans les tests unitaires), l'ORM est utilisé.
+
+    @note: Cette fonction doit être exécutée dans le thread
+        dédié à la base de données.
+    @param causes: Identifiants des événements bruts causes.
+    @type causes: C{list} of C{int}
+    @param priority: Priorité des nouveaux événements corrélés.
+    @type priority: C{int}
+    @param timestamp: Horodatage des nouveaux événements corrélés.
+    @type timestamp: C{datetime.DateTime}
+    @return: Identifiants des événements corrélés créés,
+        indexés par l'identifiant de leur cause.
+    @rtype: C{dict}
+    """
+    rows = [{
+        'idcause': idcause,
+        'priority': priority,
+        'ack': CorrEvent.ACK_NONE,
+        'occurrence': 1,
+        'timestamp_active': timestamp,
+    } for idcause in causes]
+    if not rows:
+        return {}
+
+    table = CorrEvent.__table__
+    c = table.c
+    _flush_session()
+
+    if DBSession.get_bind(clause=table).dialect.name != 'postgresql':
+        correvents = [CorrEvent(**row) for row in rows]
+        DBSession.add_all(correvents)
+        DBSession.flush()
+        return dict((correvent.idcause, correvent.idcorrevent)
+                    for correvent in correvents)
+
+    keys = ('idcause', 'priority', 'ack', 'occurrence', 'timestamp_active')
+    created = {}
+    for chunk in _chunks(rows):
+        values, params = _values_clause(chunk, keys)
+        query = text(
+            'INSERT INTO %(table)s (%(columns)s) '
+            'VALUES %(values)s '
+            'RETURNING %(id)s, %(cause)s' % {
+                'table': table.name,
+                'columns': ', '.join(c[key].name for key in keys),
+                'values': values,
+                'id': c.idcorrevent.name,
+                'cause': c.idcause.name,
+            })
+        created.update((r[1], r[0]) for r in DBSession.execute(query, params))
+    return created
+
 def add_to_aggregate(idevent, idcorrevent, database, ctx, idsupitem, merging):
     """
     Ajoute un événement brut à un événement corrélé.
@@ -304,20 +611,26 @@ def add_to_aggregate(idevent, idcorrevent, database, ctx, idsupitem, merging):
         ajouté à l'agrégat.
     @rtype: C{Deferred}
     """
-    entry = database.run(
-        DBSession.query(
-            EVENTSAGGREGATE_TABLE
-        ).filter(EVENTSAGGREGATE_TABLE.c.idevent == idevent
-        ).filter(EVENTSAGGREGATE_TABLE.c.idcorrevent == idcorrevent
-        ).first,
-        transaction=False
-    )
+    LOGGER.debug(_('Adding event #%(event)d (supitem #%(supitem)d) '
+                    'to aggregate #%(aggregate)d'), {
+                    'event': idevent,
+                    'supitem': idsupitem,
+                    'aggregate': idcorrevent,
+                })
 
-    def _update_cache(_result):
+    def _update_cache(inserted):
         """
         Met à jour l'entrée dans memcached qui indique l'événement corrélé
         ouvert qui impacte cet élément supervisé.
         """
+        if not inserted:
+            LOGGER.debug(_('Event #%(event)d already belongs to aggregate '
+                            '#%(aggregate)d, refusing to add it twice'), {
+                            'event': idevent,
+                            'aggregate': idcorrevent,
+                        })
+            return
+
         if merging:
             # Si on est en train de fusionner l'événement brut dans un événement
             # correlé ouvert plus général, alors il n'est pas la cause de cet
@@ -328,36 +641,15 @@ def add_to_aggregate(idevent, idcorrevent, database, ctx, idsupitem, merging):
             new_idcorrevent = idcorrevent
         return ctx.setShared('open_aggr:%d' % idsupitem, new_idcorrevent)
 
-    def _insert():
-        LOGGER.debug(_('Adding event #%(event)d (supitem #%(supitem)d) '
-                        'to aggregate #%(aggregate)d'), {
-                        'event': idevent,
-                        'supitem': idsupitem,
-                        'aggregate': idcorrevent,
-                    })
-
-        DBSession.add(EventsAggregate(idevent=idevent, idcorrevent=idcorrevent))
-        DBSession.flush()
-
-    def _add_if_absent(has_entry):
-        """
-        Ajoute l'association entre l'événement brut et l'événement corrélé
-        si aucune association de ce type n'existe pour le moment.
-        """
-        if has_entry:
-            LOGGER.debug(_('Event #%(event)d already belongs to aggregate '
-                            '#%(aggregate)d, refusing to add it twice'), {
-                            'event': idevent,
-                            'aggregate': idcorrevent,
-                        })
-            return
-
-        d = database.run(_insert, transaction=False)
-        d.addCallback(_update_cache)
-        return d
-
-    entry.addCallback(_add_if_absent)
-    return entry
+    # L'association n'est créée que si elle n'existe pas déjà,
+    # en une seule opération sur la base de données.
+    d = database.run(
+        insert_aggregate_entries,
+        [(idevent, idcorrevent)],
+        transaction=False
+    )
+    d.addCallback(_update_cache)
+    return d
 
 def remove_from_all_aggregates(idevent, database):
     """
@@ -368,14 +660,64 @@ def remove_from_all_aggregates(idevent, database):
     @param database: Objet qui encapsule les échanges avec la base de données.
     @type database: L{DatabaseWrapper}
     """
-    # Ici, on n'utilise pas la forme ORM de delete() car EVENTSAGGREGATE_TABLE
-    # n'est pas une table définie déclarativement.
-    entry = database.run(
-        EVENTSAGGREGATE_TABLE.delete(EVENTSAGGREGATE_TABLE.c.idevent == idevent
-            ).execute,
+    return database.run(
+        remove_aggregate_entries,
+        idevent,
         transaction=False
     )
-    return entry
+
+def remove_aggregate_entries(idevent):
+    """
+    Supprime un événement de tous les agrégats où il apparaissait.
+
+    @note: Cette fonction doit être exécutée dans le thread
+        dédié à la base de données.
+    @param idevent: Identifiant de l'événement à supprimer des agrégats.
+    @type idevent: C{int}
+    """
+    _flush_session()
+    # Ici, on n'utilise pas la forme ORM de delete() car EVENTSAGGREGATE_TABLE
+    # n'est pas une table définie déclarativement.
+    DBSession.execute(EVENTSAGGREGATE_TABLE.delete(
+        EVENTSAGGREGATE_TABLE.c.idevent == idevent))
+
+def detach_events(idevents, idcorrevent):
+    """
+    Retire des événements bruts de tous les agrégats auxquels
+    ils appartiennent, à l'exception de l'agrégat donné.
+
+    @note: Cette fonction doit être exécutée dans le thread
+        dédié à la base de données.
+    @param idevents: Identifiants des événements bruts.
+    @type idevents: C{iterable} of C{int}
+    @param idcorrevent: Identifiant de l'agrégat à conserver.
+    @type idcorrevent: C{int}
+    """
+    c = EVENTSAGGREGATE_TABLE.c
+    _flush_session()
+    for chunk in _chunks(list(idevents)):
+        DBSession.execute(EVENTSAGGREGATE_TABLE.delete(
+            ).where(c.idevent.in_(chunk)
+            ).where(c.idcorrevent != idcorrevent))
+
+def empty_aggregate(idcorrevent, idcause):
+    """
+    Retire d'un agrégat tous ses événements bruts, à l'exception
+    de son événement brut cause.
+
+    @note: Cette fonction doit être exécutée dans le thread
+        dédié à la base de données.
+    @param idcorrevent: Identifiant de l'agrégat.
+    @type idcorrevent: C{int}
+    @param idcause: Identifiant de l'événement brut cause de l'agrégat.
+    @type idcause: C{int}
+    """
+    c = EVENTSAGGREGATE_TABLE.c
+    DBSession.flush()
+    DBSession.execute(EVENTSAGGREGATE_TABLE.delete(
+        ).where(c.idcorrevent == idcorrevent
+        ).where(c.idevent != idcause))
+    _refresh_aggregates(set([idcorrevent]))
 
 def merge_aggregates(sourceaggregateid, destinationaggregateid, database, ctx):
     """
@@ -401,104 +743,110 @@ def merge_aggregates(sourceaggregateid, destinationaggregateid, database, ctx):
                     'dest': destinationaggregateid,
                 })
 
-    d = defer.DeferredList(
-        [
-            database.run(
-                DBSession.query(
-                    Event.idsupitem,
-                    EVENTSAGGREGATE_TABLE.c.idevent
-                ).join(
-                    (EVENTSAGGREGATE_TABLE, Event.idevent ==
-                        EVENTSAGGREGATE_TABLE.c.idevent),
-                ).filter(
-                    EVENTSAGGREGATE_TABLE.c.idcorrevent == sourceaggregateid
-                ).all,
-                transaction=False
-            ),
-            database.run(
-                DBSession.query(EVENTSAGGREGATE_TABLE.c.idevent).filter(
-                EVENTSAGGREGATE_TABLE.c.idcorrevent == destinationaggregateid).all,
-                transaction=False
-            ),
-        ],
-        consumeErrors=True,
+    d = database.run(
+        merge_aggregate_entries,
+        [sourceaggregateid],
+        destinationaggregateid,
+        transaction=False
     )
 
-    def _swap():
-        """
-        Déplace les événements bruts autrefois rattachés à l'événement
-        corrélé source vers l'événement corrélé destination.
-
-        Il n'y a pas de doublons possibles (un événement brut ne peut pas
-        appartenir plusieurs fois au même événement corrélé).
-        """
-        # Bascule des événements de l'ancien agrégat vers le nouveau.
-        # On utilise une sous-requête afin d'exclure les événements qui font
-        # déjà partie de l'agrégat destination (pas de doublons possibles:
-        # il y a une contrainte d'unicité).
-        sub_select = DBSession.query(EventsAggregate.idevent).filter(
-            EventsAggregate.idcorrevent == destinationaggregateid)
-
-        DBSession.query(
-                EventsAggregate
-            ).filter(EventsAggregate.idcorrevent == sourceaggregateid
-            ).filter(not_(EventsAggregate.idevent.in_(sub_select))
-            ).update({"idcorrevent": destinationaggregateid},
-                     synchronize_session='fetch')
-        DBSession.flush()
-
-    def _delete(_result):
-        """Supprime l'agrégat source de la base de données."""
-        return database.run(
-            DBSession.query(CorrEvent).filter(
-                CorrEvent.idcorrevent == sourceaggregateid).delete,
-            transaction=False
-        )
-
-    def _merge(result):
+    def _update_cache(source):
         """
-        Effectue la fusion à proprement parler:
-        -   Le cache des agrégats ouverts est mis à jour.
-        -   Les événements rattachés à l'ancien agrégat passent sur le nouveau.
-        -   L'ancien agrégat est supprimé.
+        Met à jour le cache des agrégats ouverts : les éléments supervisés
+        de l'agrégat source ne sont plus la cause d'aucun agrégat.
         """
-        source, dest = result
-
-        # S'il n'y a aucun événement dans l'aggrégat source,
-        # c'est qu'il y a un problème.
-        if not source[0] or not source[1]:
-            LOGGER.warning(_('Got a reference to a nonexistent aggregate, '
-                            'aborting'))
-            return
-        # Idem pour l'agrégat de destination.
-        if not dest[0] or not dest[1]:
+        if source is None:
             LOGGER.warning(_('Got a reference to a nonexistent aggregate, '
                             'aborting'))
             return
 
-        # Déplace les événements depuis l'agrégat source
-        # vers l'agrégat destination.
-        event_id_list = []
-        defs = []
-
-        # Mise à jour de l'agrégat ouvert associé au supitem dans memcached.
-        for event in source[1]:
-            defs.append(ctx.setShared('open_aggr:%d' % event.idsupitem, 0))
-            LOGGER.debug(_("Event #%(event)d (supitem #%(supitem)d) will be "
-                            "merged into aggregate #%(aggregate)d"), {
-                            'event': event.idevent,
-                            'supitem': event.idsupitem,
-                            'aggregate': destinationaggregateid,
-                        })
-            event_id_list.append(event.idevent)
-
-        defs.append(database.run(_swap, transaction=False))
-        d = defer.DeferredList(defs)
-
-        # Suppression de l'ancien agrégat.
-        d.addCallback(_delete)
-        d.addCallback(lambda res: event_id_list)
+        LOGGER.debug(_("%(count)d event(s) merged into aggregate "
+                        "#%(aggregate)d"), {
+                        'count': len(source),
+                        'aggregate': destinationaggregateid,
+                    })
+        event_id_list = [event.idevent for event in source]
+        d = defer.maybeDeferred(ctx.setSharedMulti, dict(
+            ('open_aggr:%d' % event.idsupitem, 0) for event in source
+        ))
+        d.addCallback(lambda _res: event_id_list)
         return d
 
-    d.addCallback(_merge)
+    d.addCallback(_update_cache)
     return d
+
+def merge_aggregate_entries(sourceaggregateids, destinationaggregateid):
+    """
+    Réalise la fusion d'un ou plusieurs agrégats dans un agrégat
+    destination, à l'aide d'opérations ensemblistes.
+
+    @note: Cette fonction doit être exécutée dans le thread
+        dédié à la base de données.
+    @param sourceaggregateids: Identifiants des agrégats sources.
+    @type sourceaggregateids: C{iterable} of C{int}
+    @param destinationaggregateid: Identifiant de l'agrégat destination.
+    @type destinationaggregateid: C{int}
+    @return: Événements bruts des agrégats sources (avec l'identifiant
+        de l'élément supervisé associé) ou C{None} si aucun des agrégats
+        sources ou si l'agrégat destination n'existe pas.
+    @rtype: C{list}
+    """
+    c = EVENTSAGGREGATE_TABLE.c
+    destinationaggregateid = int(destinationaggregateid)
+    sourceaggregateids = sorted(set(int(source)
+                                    for source in sourceaggregateids)
+                                - set([destinationaggregateid]))
+    if not sourceaggregateids:
+        return None
+
+    # La liste complète des événements des agrégats sources (y compris ceux
+    # déjà présents dans l'agrégat destination) est nécessaire pour mettre
+    # à jour le cache des agrégats ouverts.
+    source = DBSession.query(
+            Event.idsupitem,
+            c.idevent,
+        ).join(
+            (EVENTSAGGREGATE_TABLE, Event.idevent == c.idevent),
+        ).filter(c.idcorrevent.in_(sourceaggregateids)
+        ).all()
+
+    # S'il n'y a aucun événement dans l'un des agrégats,
+    # c'est qu'il y a un problème.
+    if not source:
+        return None
+    dest = DBSession.query(c.idevent
+        ).filter(c.idcorrevent == destinationaggregateid
+        ).first()
+    if not dest:
+        return None
+
+    _flush_session()
+
+    # Bascule des événements des anciens agrégats vers le nouveau.
+    # On utilise une sous-requête afin d'exclure les événements qui font
+    # déjà partie de l'agrégat destination (pas de doublons possibles:
+    # il y a une contrainte d'unicité). Une requête est exécutée par
+    # agrégat source, afin qu'un événement présent dans plusieurs
+    # agrégats sources ne soit déplacé qu'une seule fois.
+    existing = EVENTSAGGREGATE_TABLE.alias()
+    for sourceaggregateid in sourceaggregateids:
+        DBSession.execute(
+            EVENTSAGGREGATE_TABLE.update(
+            ).where(c.idcorrevent == sourceaggregateid
+            ).where(not_(c.idevent.in_(
+                select([existing.c.idevent]).where(
+                    existing.c.idcorrevent == destinationaggregateid)
+            ))).values(idcorrevent=destinationaggregateid)
+        )
+
+    # Suppression des anciens agrégats (et par cascade, des associations
+    # restantes avec des événements déjà présents dans la destination).
+    # La session n'est pas synchronisée par l'ORM (ce qui nécessiterait
+    # une requête supplémentaire) : cf. _refresh_aggregates.
+    DBSession.query(CorrEvent).filter(
+        CorrEvent.idcorrevent.in_(sourceaggregateids)
+    ).delete(synchronize_session=False)
+
+    _refresh_aggregates(set(sourceaggregateids + [destinationaggregateid]),
+                        deleted=sourceaggregateids)
+    return source
@@ -12,6 +12,9 @@ fournis par Twisted pour la gestion des processus léger.
 """
 
 import Queue
+import time
+import heapq
+import threading
 
 from twisted.internet import reactor
 from twisted.internet import defer
@@ -20,77 +23,452 @@ from twisted.python.failure import Failure
 
 import transaction
 
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+from vigilo.correlator.metrics import Histogram
+from vigilo.correlator.completions import call_from_thread
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+# Thread de la base de données courant (cf. _current_worker).
+_local = threading.local()
+
+# Clé de la session partagée par les threads qui ne sont pas
+# des threads de la base de données (cf. _current_worker).
+QUERY_SCOPE = 'query'
+
+
+def _current_worker():
+    """
+    Retourne la clé de la session du thread courant.
+
+    Chaque thread de la base de données dispose de sa propre session
+    (et donc de sa propre connexion), identifiée par la clé du thread
+    (cf. L{DatabaseWorker.key}). Les autres threads (réacteur, règles
+    de corrélation) partagent une même session (L{QUERY_SCOPE}), qu'ils
+    utilisent uniquement pour construire des requêtes : celles-ci sont
+    exécutées par les threads de la base de données (cf.
+    L{DatabaseWrapper._bind_to_worker}). Cette session n'est donc
+    jamais liée à une connexion, et le nombre de sessions ne dépend pas
+    du nombre de threads créés au cours de l'exécution.
+
+    @rtype: C{int} or C{tuple} or C{str}
+    """
+    key = getattr(_local, 'worker', None)
+    if key is None:
+        return QUERY_SCOPE
+    return key
+
+
+def _is_replica():
+    """
+    Indique si le thread courant travaille sur le réplica
+    en lecture seule de la base de données.
+
+    @rtype: C{bool}
+    """
+    return getattr(_local, 'replica', False)
+
+
+def add_after_commit_hook(hook, args=(), kws=None):
+    """
+    Enregistre une action à exécuter après la validation (ou l'échec
+    de la validation) de la transaction courante, à la manière de
+    C{transaction.get().addAfterCommitHook}.
+
+    Au sein d'un groupe d'opérations validées ensemble (cf.
+    L{DatabaseWrapper._run_group}), les actions d'une opération
+    ne sont rattachées à la transaction qu'une fois son point de
+    sauvegarde validé : celles d'une opération annulée sont ignorées.
+
+    @param hook: Action à exécuter. Elle reçoit en premier argument
+        un booléen indiquant si la transaction a été validée.
+    @type hook: C{callable}
+    @param args: Arguments positionnels supplémentaires de l'action.
+    @type args: C{tuple}
+    @param kws: Arguments nommés de l'action.
+    @type kws: C{dict}
+    """
+    pending = getattr(_local, 'hooks', None)
+    if pending is not None:
+        pending.append((hook, args, kws))
+    else:
+        transaction.get().addAfterCommitHook(hook, args=args, kws=kws)
+
+
+def _describe(func, args):
+    """
+    Détermine l'étiquette identifiant une opération dans les métriques :
+    nom de la requête pour les requêtes de L{vigilo.correlator.queries},
+    nom de la méthode (préfixé par celui de la classe) ou de la fonction
+    dans les autres cas.
+
+    @param func: Fonction à exécuter.
+    @type func: C{callable}
+    @param args: Arguments positionnels de la fonction.
+    @type args: C{tuple}
+    @rtype: C{str}
+    """
+    if args and getattr(func, '__module__', None) == \
+        'vigilo.correlator.queries':
+        from vigilo.correlator import queries
+        label = queries.get_label(args[0])
+        if label:
+            return label
+
+    name = getattr(func, '__name__', None) or func.__class__.__name__
+    owner = getattr(func, 'im_self', None)
+    if owner is not None:
+        if not isinstance(owner, type):
+            owner = owner.__class__
+        name = '%s.%s' % (owner.__name__, name)
+    return name
+
+
+class DatabaseProfiler(object):
+    """
+    Profil des opérations exécutées par les threads de la base de données :
+    temps d'attente dans la file et temps d'exécution de chaque type
+    d'opération (cf. L{_describe}) et opérations les plus lentes.
+    Les mesures portent sur l'intervalle écoulé depuis le dernier appel
+    à L{DatabaseProfiler.getStats}.
+    """
+
+    def __init__(self, top=5):
+        """
+        @param top: Nombre d'opérations les plus lentes à conserver.
+        @type top: C{int}
+        """
+        self.top = top
+        self._lock = threading.Lock()
+        self._ops = {}
+        self._slowest = []
+
+    def record(self, label, wait, duration):
+        """
+        Enregistre les mesures d'une opération.
+
+        @param label: Étiquette de l'opération.
+        @type label: C{str}
+        @param wait: Temps d'attente dans la file (en secondes).
+        @type wait: C{float}
+        @param duration: Temps d'exécution (en secondes).
+        @type duration: C{float}
+        """
+        self._lock.acquire()
+        try:
+            histograms = self._ops.get(label)
+            if histograms is None:
+                histograms = self._ops[label] = (Histogram(), Histogram())
+            histograms[0].observe(wait)
+            histograms[1].observe(duration)
+            if len(self._slowest) < self.top:
+                heapq.heappush(self._slowest, (duration, label))
+            elif duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, (duration, label))
+        finally:
+            self._lock.release()
+
+    def collect(self):
+        """
+        Retourne les mesures enregistrées depuis le dernier appel.
+
+        @return: Histogrammes (attente, exécution) par étiquette et
+            liste des opérations les plus lentes (durée, étiquette),
+            de la plus lente à la plus rapide.
+        @rtype: C{tuple}
+        """
+        self._lock.acquire()
+        try:
+            ops, self._ops = self._ops, {}
+            slowest, self._slowest = self._slowest, []
+        finally:
+            self._lock.release()
+        return ops, sorted(slowest, reverse=True)
+
+    def getStats(self):
+        """
+        Résume les mesures enregistrées depuis le dernier appel.
+
+        @rtype: C{dict}
+        """
+        ops, slowest = self.collect()
+        stats = {}
+        for label, (wait, execution) in ops.iteritems():
+            prefix = "db-op-%s" % label
+            stats[prefix + "-count"] = execution.count
+            stats[prefix + "-wait"] = round(wait.mean(), 5)
+            stats[prefix + "-wait-p95"] = round(wait.quantile(0.95), 5)
+            stats[prefix + "-exec"] = round(execution.mean(), 5)
+            stats[prefix + "-exec-p95"] = round(execution.quantile(0.95), 5)
+            stats[prefix + "-exec-max"] = round(execution.max, 5)
+        for rank, (duration, label) in enumerate(slowest):
+            stats["db-slowest-%d" % (rank + 1)] = round(duration, 5)
+        if slowest:
+            LOGGER.info(_("Slowest database operations: %s"), ", ".join([
+                "%s (%.4fs)" % (label, duration)
+                for (duration, label) in slowest
+            ]))
+        return stats
+
+
+class DatabaseWorker(object):
+    """
+    Thread dédié à la base de données et sa file d'opérations.
+    """
+
+    def __init__(self, index, replica=False):
+        """
+        @param index: Index du thread parmi ceux du L{DatabaseWrapper}.
+        @type index: C{int}
+        @param replica: Indique si le thread travaille sur le réplica
+            en lecture seule de la base de données.
+        @type replica: C{bool}
+        """
+        self.index = index
+        self.replica = replica
+        if replica:
+            self.key = ('replica', index)
+            self.name = 'replica%d' % index
+        else:
+            self.key = index
+            self.name = 'worker%d' % index
+        self.queue = Queue.Queue()
+        self.defer = None
+        self._lock = threading.Lock()
+        self._busy = 0.0
+        self._since = time.time()
+        # Nombre de groupes d'opérations validés ensemble
+        # et nombre total d'opérations de ces groupes.
+        self._groups = 0
+        self._grouped = 0
+
+    def add_busy_time(self, duration, group=None):
+        """
+        Comptabilise le temps passé à exécuter une opération.
+
+        @param duration: Durée de l'opération (en secondes).
+        @type duration: C{float}
+        @param group: Nombre d'opérations validées ensemble
+            (cf. L{DatabaseWrapper._run_group}), le cas échéant.
+        @type group: C{int}
+        """
+        self._lock.acquire()
+        try:
+            self._busy += duration
+            if group is not None:
+                self._groups += 1
+                self._grouped += group
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        """
+        Retourne la profondeur de la file d'attente, le taux d'occupation
+        (en pourcentage) du thread, ainsi que le nombre de groupes
+        d'opérations validés ensemble et le nombre total d'opérations
+        de ces groupes depuis le dernier appel.
+
+        @rtype: C{tuple}
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            busy, self._busy = self._busy, 0.0
+            elapsed, self._since = now - self._since, now
+            groups, self._groups = self._groups, 0
+            grouped, self._grouped = self._grouped, 0
+        finally:
+            self._lock.release()
+        if elapsed > 0:
+            usage = round(min(100.0, 100.0 * busy / elapsed), 2)
+        else:
+            usage = 0.0
+        return self.queue.qsize(), usage, groups, grouped
+
+
 class DatabaseWrapper(object):
     """
     Cette classe permet de gérer tous les accès à la base de données
-    au travers d'un processus léger (thread) dédié.
+    au travers d'un ou plusieurs processus légers (threads) dédiés.
+
+    Chaque thread dispose de sa propre session et de sa propre connexion.
+    Les opérations sont réparties entre les threads de la manière suivante :
+        -   les opérations portant une clé d'affinité (par exemple,
+            l'identifiant de l'élément supervisé concerné) sont toujours
+            exécutées par le même thread, ce qui garantit leur ordre
+            d'exécution et permet d'enchaîner plusieurs opérations
+            au sein d'une même transaction ;
+        -   les opérations en lecture seule et sans affinité sont confiées
+            au thread dont la file d'attente est la moins chargée ;
+        -   les autres opérations sont exécutées par le premier thread
+            (comportement historique, lorsqu'un seul thread était utilisé).
+
+    Si un réplica en lecture seule de la base de données est configuré,
+    les opérations en lecture seule (y compris celles portant une clé
+    d'affinité) sont confiées à un groupe de threads distinct travaillant
+    sur ce réplica.
     """
 
     def __init__(self, settings):
         """
-        Crée un thread dédié à la gestion de la base de données.
+        Crée les threads dédiés à la gestion de la base de données.
         Cette méthode configure également la session d'accès à
         la base de données pour qu'elle soit partagée entre les
         threads.
 
         @param settings: Options de configuration du corrélateur,
             contenant en particulier les options relatives à la
-            base de données (préfixées par "sqlalchemy_").
+            base de données (préfixées par "sqlalchemy_"), le
+            nombre de threads à utiliser (option "db_workers") et
+            la taille maximale des groupes d'opérations validées
+            ensemble (option "db_group_commit"). Les options préfixées
+            par "replica_sqlalchemy_" décrivent l'accès (optionnel)
+            au réplica en lecture seule, utilisé par "db_replica_workers"
+            threads.
         @type settings: C{dict}
         """
         from vigilo.models.configure import configure_db
         self.engine = configure_db(settings, 'sqlalchemy_')
 
+        from sqlalchemy import engine_from_config
         from sqlalchemy.orm import sessionmaker
+        from sqlalchemy.util import ScopedRegistry
         from zope.sqlalchemy import ZopeTransactionExtension
         from vigilo.models import session
 
-        # On remplace l'objet DBSession par une session partagée
-        # entre les threads. L'idée est que tous les threads peuvent
-        # s'en servir pour générer des Query, mais seul le thread
-        # géré par cette classe peut s'en servir pour exécuter le SQL.
-        session.DBSession = sessionmaker(
-            autoflush=True,
-            autocommit=False,
-            extension=ZopeTransactionExtension()
-        )()
+        factories = {
+            False: sessionmaker(
+                autoflush=True,
+                autocommit=False,
+                extension=ZopeTransactionExtension()
+            ),
+        }
+        self.replica_engine = None
+        if settings.get('replica_sqlalchemy_url'):
+            self.replica_engine = engine_from_config(
+                settings, 'replica_sqlalchemy_')
+            factories[True] = sessionmaker(
+                bind=self.replica_engine,
+                autoflush=True,
+                autocommit=False,
+                extension=ZopeTransactionExtension()
+            )
 
-        self.queue = Queue.Queue()
-        self.defer = threads.deferToThread(self._db_thread)
+        # L'objet DBSession existant (importé directement par de nombreux
+        # modules, dont vigilo.models.tables) est reconfiguré pour fournir
+        # une session propre à chaque thread de la base de données, liée
+        # au réplica pour les threads qui y sont dédiés. Les autres threads
+        # partagent une même session : ils peuvent s'en servir pour générer
+        # des Query, mais seuls les threads gérés par cette classe exécutent
+        # le SQL, avec leur propre session (cf. _bind_to_worker).
+        session.DBSession.remove()
+        session.DBSession.registry = ScopedRegistry(
+            lambda: factories[_is_replica()](),
+            _current_worker
+        )
+        self._session = session
+
+        workers = max(1, int(settings.get('db_workers', 1)))
+        if self.replica_engine is not None:
+            replicas = max(1, int(settings.get('db_replica_workers', workers)))
+        else:
+            replicas = 0
+        # Nombre maximum d'opérations validées ensemble (0 ou 1 : désactivé).
+        self.group_commit = int(settings.get('db_group_commit', 0))
+        self.profiler = DatabaseProfiler(int(settings.get('db_profile_top', 5)))
+        # Chaque thread occupe en permanence un thread du pool de Twisted,
+        # on s'assure qu'il en reste pour les autres utilisateurs du pool.
+        pool = reactor.getThreadPool()
+        if pool.max < workers + replicas + 5:
+            reactor.suggestThreadPoolSize(workers + replicas + 5)
+
+        self.workers = [DatabaseWorker(i) for i in xrange(workers)]
+        self.replicas = [DatabaseWorker(i, True) for i in xrange(replicas)]
+        for worker in self.workers + self.replicas:
+            worker.defer = threads.deferToThread(self._db_thread, worker)
+        self.queue = self.workers[0].queue
+        self.defer = defer.DeferredList(
+            [worker.defer for worker in self.workers + self.replicas])
 
     def __del__(self):
         """
         Cette méthode se contente d'appeler L{DatabaseWrapper.shutdown}
-        lorsque l'objet est détruit afin de s'assurer que le thread créé
-        dans le constructeur est bien arrêté.
+        lorsque l'objet est détruit afin de s'assurer que les threads créés
+        dans le constructeur sont bien arrêtés.
         """
         self.shutdown()
 
-    def _db_thread(self):
+    def _bind_to_worker(self, func):
+        """
+        Rattache à la session du thread courant une requête construite
+        depuis un autre thread (ex : C{DBSession.query(...).all}).
+
+        @param func: Fonction à exécuter.
+        @type func: C{callable}
+        @return: Fonction à exécuter dans le thread courant.
+        @rtype: C{callable}
+        """
+        from sqlalchemy.orm.query import Query
+
+        query = getattr(func, 'im_self', None)
+        if not isinstance(query, Query):
+            return func
+        current = self._session.DBSession()
+        if query.session is current:
+            return func
+        return getattr(query.with_session(current), func.__name__)
+
+    def _db_thread(self, worker):
         """
         Cette méthode est exécutée dans un thread séparé.
         C'est elle qui traite les demandes d'opérations sur la base de données
         et retourne les résultats sous la forme d'un objet C{Deferred}.
 
+        @param worker: Thread de la base de données à faire fonctionner.
+        @type worker: L{DatabaseWorker}
         @note: Cette méthode ne retourne pas tant que la méthode
             L{DatabaseWrapper.shutdown} n'a pas été appelée.
         """
-        from vigilo.common.logging import get_logger
-        from vigilo.common.gettext import translate
-
-        logger = get_logger(__name__)
-        _ = translate(__name__)
+        _local.worker = worker.key
+        _local.replica = worker.replica
+        queue = worker.queue
+        backlog = []
 
         while True:
-            op = self.queue.get()
+            if backlog:
+                op = backlog.pop()
+            else:
+                op = queue.get()
             if op is None:
                 return
-            else:
-                func, args, kwargs, d, txn = op
 
+            # Validation groupée : les opérations transactionnelles
+            # déjà en attente sont exécutées dans la même transaction.
+            if op[4] and self.group_commit > 1:
+                group = [op]
+                while len(group) < self.group_commit:
+                    try:
+                        op = queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if op is None or not op[4]:
+                        backlog.append(op)
+                        break
+                    group.append(op)
+                if len(group) > 1:
+                    self._run_group(worker, group)
+                    continue
+                op = group[0]
+
+            func, args, kwargs, d, txn, label, queued = op
+            start = time.time()
             if txn:
                 transaction.begin()
             try:
+                func = self._bind_to_worker(func)
                 result = d.callback, func(*args, **kwargs)
                 if txn:
                     transaction.commit()
@@ -98,8 +476,114 @@ class DatabaseWrapper(object):
                 if txn:
                     transaction.abort()
                 result = d.errback, Failure()
-            self.queue.task_done()
-            reactor.callFromThread(*result)
+            end = time.time()
+            worker.add_busy_time(end - start)
+            self.profiler.record(label, start - queued, end - start)
+            queue.task_done()
+            call_from_thread(*result)
+
+    def _run_savepoint(self, session, op):
+        """
+        Exécute une opération d'un groupe dans un point de sauvegarde
+        (SAVEPOINT) de la transaction courante.
+
+        @param session: Session du thread courant.
+        @type session: C{sqlalchemy.orm.Session}
+        @param op: Opération à exécuter.
+        @type op: C{tuple}
+        @return: Le Deferred de l'appelant et le résultat
+            de l'opération (ou l'erreur rencontrée).
+        @rtype: C{tuple}
+        """
+        func, args, kwargs, d, _txn, label, queued = op
+        start = time.time()
+        # Les actions prévues après la validation de la transaction
+        # (cf. add_after_commit_hook) ne sont rattachées à celle-ci
+        # qu'une fois le point de sauvegarde de l'opération validé.
+        hooks = _local.hooks = []
+        session.begin_nested()
+        try:
+            try:
+                result = self._bind_to_worker(func)(*args, **kwargs)
+                session.commit()
+            except Exception:
+                result = Failure()
+                # Seule l'opération en erreur est annulée : les autres
+                # opérations du groupe seront validées normalement.
+                session.rollback()
+            else:
+                txn = transaction.get()
+                for hook, hook_args, hook_kws in hooks:
+                    txn.addAfterCommitHook(hook, args=hook_args,
+                                           kws=hook_kws)
+        finally:
+            _local.hooks = None
+        end = time.time()
+        self.profiler.record(label, start - queued, end - start)
+        return d, result
+
+    def _run_group(self, worker, group):
+        """
+        Exécute plusieurs opérations transactionnelles dans une seule
+        transaction, validée une seule fois. Chaque opération est isolée
+        des autres par un point de sauvegarde : une opération en erreur
+        est annulée sans affecter les autres.
+
+        Seules les opérations soumises avec C{transaction=True} sont
+        regroupées. Celles qui gèrent elles-mêmes leur transaction
+        (C{transaction=False}), comme la construction des événements
+        corrélés (cf. L{vigilo.correlator.correvent}), ne le sont jamais :
+        elles interrompent le regroupement et sont exécutées seules.
+
+        @param worker: Thread de la base de données courant.
+        @type worker: L{DatabaseWorker}
+        @param group: Opérations à exécuter.
+        @type group: C{list}
+        """
+        start = time.time()
+        results = []
+        try:
+            transaction.begin()
+            session = self._session.DBSession()
+            for op in group:
+                results.append(self._run_savepoint(session, op))
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            failure = Failure()
+            results = [
+                (d, isinstance(res, Failure) and res or failure)
+                for (d, res) in results
+            ] + [(op[3], failure) for op in group[len(results):]]
+        worker.add_busy_time(time.time() - start, len(group))
+
+        for d, res in results:
+            worker.queue.task_done()
+            if isinstance(res, Failure):
+                call_from_thread(d.errback, res)
+            else:
+                call_from_thread(d.callback, res)
+
+    def _route(self, affinity, readonly):
+        """
+        Choisit le thread qui exécutera une opération.
+
+        @param affinity: Clé d'affinité de l'opération ou C{None}.
+        @type affinity: C{hashable}
+        @param readonly: Indique si l'opération est en lecture seule.
+        @type readonly: C{bool}
+        @rtype: L{DatabaseWorker}
+        """
+        if readonly and self.replicas:
+            return min(self.replicas, key=lambda w: w.queue.qsize())
+        workers = self.workers
+        if len(workers) == 1:
+            return workers[0]
+        if affinity is not None:
+            return workers[hash(affinity) % len(workers)]
+        if readonly:
+            return min(workers, key=lambda w: w.queue.qsize())
+        return workers[0]
 
     def run(self, func, *args, **kwargs):
         """
@@ -114,24 +598,107 @@ class DatabaseWrapper(object):
         @note: Cette méthode accepte également un paramètre nommé
             C{transaction} qui indique si le traitement doit avoir
             lieu dans une transaction ou non.
+        @note: Le paramètre nommé C{affinity} permet d'indiquer une clé
+            d'affinité : toutes les opérations partageant la même clé
+            sont exécutées dans l'ordre, par le même thread.
+        @note: Le paramètre nommé C{readonly} indique que l'opération
+            se contente de lire des données et peut donc être exécutée
+            par n'importe quel thread, y compris sur le réplica (dont les
+            données peuvent être légèrement en retard). Le résultat ne doit
+            alors pas contenir d'objets de l'ORM destinés à être modifiés.
+            Les lectures qui doivent refléter les dernières modifications
+            ne doivent pas utiliser ce paramètre.
+        @note: Le paramètre nommé C{label} permet de choisir l'étiquette
+            identifiant l'opération dans les métriques (par défaut,
+            le nom de la fonction ou de la requête exécutée).
         @return: Un Deferred qui sera appelé avec le résultat de
             l'exécution de la fonction.
         @rtype: L{defer.Deferred}
         """
         result = defer.Deferred()
         txn = kwargs.pop('transaction', True)
-        self.queue.put((func, args, kwargs, result, txn))
+        label = kwargs.pop('label', None) or _describe(func, args)
+        worker = self._route(kwargs.pop('affinity', None),
+                             kwargs.pop('readonly', False))
+        worker.queue.put((func, args, kwargs, result, txn,
+                          label, time.time()))
         return result
 
+    def pinned(self, affinity):
+        """
+        Retourne un objet ayant la même API que cette classe
+        et dont toutes les opérations portent la clé d'affinité donnée.
+
+        @param affinity: Clé d'affinité.
+        @type affinity: C{hashable}
+        @rtype: L{PinnedDatabaseWrapper}
+        """
+        return PinnedDatabaseWrapper(self, affinity)
+
+    def getStats(self):
+        """
+        Récupère des métriques de fonctionnement des threads
+        de la base de données.
+
+        @rtype: C{dict}
+        """
+        stats = {}
+        total = 0
+        groups = 0
+        grouped = 0
+        for worker in self.workers + self.replicas:
+            depth, usage, worker_groups, worker_grouped = worker.getStats()
+            stats["db-%s-queue" % worker.name] = depth
+            stats["db-%s-usage" % worker.name] = usage
+            total += depth
+            groups += worker_groups
+            grouped += worker_grouped
+        stats["db-queue"] = total
+        stats.update(self.profiler.getStats())
+        if self.group_commit > 1:
+            stats["db-commit-groups"] = groups
+            if groups:
+                stats["db-group-size"] = round(
+                    float(grouped) / groups, 2)
+            else:
+                stats["db-group-size"] = 0.0
+        return stats
+
     def shutdown(self):
         """
-        Arrête le thread dédié à la gestion des accès
+        Arrête les threads dédiés à la gestion des accès
         à la base de données.
         """
-        self.queue.put(None)
+        for worker in self.workers + self.replicas:
+            worker.queue.put(None)
         return self.defer
 
 
+class PinnedDatabaseWrapper(object):
+    """
+    Encapsule un L{DatabaseWrapper} afin que toutes les opérations
+    soient exécutées par le même thread (cf. L{DatabaseWrapper.pinned}).
+    """
+
+    def __init__(self, database, affinity):
+        self.database = database
+        self.affinity = affinity
+
+    def run(self, func, *args, **kwargs):
+        """
+        Voir L{DatabaseWrapper.run}. Le paramètre C{affinity} est imposé.
+        Le paramètre C{readonly} n'a d'effet qu'en présence d'un réplica.
+        """
+        kwargs['affinity'] = self.affinity
+        return self.database.run(func, *args, **kwargs)
+
+    def pinned(self, affinity):
+        return self.database.pinned(affinity)
+
+    def __getattr__(self, attr):
+        return getattr(self.database, attr)
+
+
 class DummyDatabaseWrapper(object):
     """
     Une classe ayant la même API que la classe L{DatabaseWrapper}
@@ -197,6 +764,9 @@ class DummyDatabaseWrapper(object):
         logger = get_logger(__name__)
 
         txn = kwargs.pop('transaction', True) and not self.disable_txn
+        kwargs.pop('affinity', None)
+        kwargs.pop('readonly', None)
+        kwargs.pop('label', None)
         if txn:
             transaction.begin()
         try:
@@ -212,6 +782,20 @@ class DummyDatabaseWrapper(object):
             self.logger.error(res)
         return self._return(res)
 
+    def pinned(self, _affinity):
+        """
+        Retourne cet objet : les opérations sont
+        exécutées directement par le thread appelant.
+        """
+        return self
+
+    def getStats(self):
+        """
+        Cette méthode est fournie uniquement
+        pour respecter l'API de la classe L{DatabaseWrapper}.
+        """
+        return {}
+
     def shutdown(self):
         """
         Cette méthode ne fait rien, elle est fournie uniquement
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Écriture différée des entrées d'historique (L{EventHistory}, L{HLSHistory}).
+
+L'historique n'est jamais relu au cours de la corrélation : il n'est donc
+pas nécessaire de l'écrire dans la transaction (critique en termes de
+latence) qui traite l'événement. Les lignes sont accumulées en mémoire
+puis insérées par lots (requêtes d'insertion multiples) depuis un thread
+dédié disposant de sa propre connexion à la base de données.
+
+Les lignes ne sont transmises au tampon qu'une fois la transaction
+d'origine validée, ce qui garantit que l'événement auquel elles se
+rapportent existe bien dans la base de données (et qu'aucun historique
+n'est écrit pour une transaction annulée).
+"""
+
+import time
+import threading
+
+from sqlalchemy import exc
+
+from twisted.internet import threads
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+from vigilo.correlator.db_thread import add_after_commit_hook
+from vigilo.correlator.metrics import Histogram
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'HistoryWriter',
+    'get_history_writer',
+    'set_history_writer',
+    'historywriter_factory',
+)
+
+
+class HistoryWriter(object):
+    """
+    Tampon d'écriture des lignes d'historique.
+
+    Le tampon est vidé dès que C{batch_size} lignes sont en attente
+    ou au plus tard toutes les C{flush_interval} secondes. La mémoire
+    utilisée est bornée : lorsque C{max_pending} lignes sont en attente
+    d'écriture, les appels à L{HistoryWriter.add} bloquent jusqu'à ce
+    que de la place se libère.
+    """
+
+    def __init__(self, engine, batch_size=500, flush_interval=1.0,
+                 max_pending=20000):
+        """
+        @param engine: Moteur SQLAlchemy à partir duquel la connexion
+            dédiée à l'écriture de l'historique est ouverte.
+        @type engine: C{sqlalchemy.engine.Engine}
+        @param batch_size: Nombre de lignes déclenchant l'écriture.
+        @type batch_size: C{int}
+        @param flush_interval: Délai maximum (en secondes) avant
+            l'écriture des lignes en attente.
+        @type flush_interval: C{float}
+        @param max_pending: Nombre maximum de lignes en attente.
+        @type max_pending: C{int}
+        """
+        self.engine = engine
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_pending = max(self.batch_size, max_pending)
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._in_flight = 0
+        self._stopping = False
+        # Métriques depuis le dernier appel à getStats
+        # (protégées par self._cond).
+        self._flush_times = Histogram()
+        self._flushed = 0
+        self._errors = 0
+        self.defer = None
+
+    def start(self):
+        """Démarre le thread d'écriture."""
+        self.defer = threads.deferToThread(self._writer_thread)
+        return self.defer
+
+    def add(self, table, row):
+        """
+        Ajoute immédiatement une ligne au tampon.
+
+        @param table: Table dans laquelle la ligne doit être insérée.
+        @type table: C{sqlalchemy.Table}
+        @param row: Valeurs des colonnes de la ligne.
+        @type row: C{dict}
+        """
+        self._cond.acquire()
+        try:
+            while len(self._pending) + self._in_flight >= self.max_pending \
+                and not self._stopping:
+                self._cond.wait()
+            self._pending.append((table, row))
+            if len(self._pending) >= self.batch_size:
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def add_after_commit(self, table, row):
+        """
+        Ajoute une ligne au tampon une fois la transaction
+        courante validée. La ligne est ignorée si la transaction
+        est annulée.
+
+        @param table: Table dans laquelle la ligne doit être insérée.
+        @type table: C{sqlalchemy.Table}
+        @param row: Valeurs des colonnes de la ligne.
+        @type row: C{dict}
+        """
+        add_after_commit_hook(self._after_commit, args=(table, row))
+
+    def _after_commit(self, status, table, row):
+        if status:
+            self.add(table, row)
+
+    def _take_batch(self):
+        """
+        Attend que des lignes soient prêtes à être écrites
+        et les retire du tampon.
+
+        @return: Lignes à écrire, ou C{None} si le thread doit s'arrêter.
+        @rtype: C{list}
+        """
+        self._cond.acquire()
+        try:
+            deadline = time.time() + self.flush_interval
+            while len(self._pending) < self.batch_size and \
+                not self._stopping:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if not self._pending and self._stopping:
+                return None
+            batch = self._pending
+            self._pending = []
+            self._in_flight = len(batch)
+            return batch
+        finally:
+            self._cond.release()
+
+    def _release(self, batch, requeue=None, duration=None):
+        """
+        Termine le traitement d'un lot de lignes.
+
+        @param batch: Lignes du lot.
+        @type batch: C{list}
+        @param requeue: Lignes à écrire de nouveau.
+        @type requeue: C{list}
+        @param duration: Durée de l'écriture du lot,
+            ou C{None} si celle-ci a échoué.
+        @type duration: C{float}
+        """
+        self._cond.acquire()
+        try:
+            if requeue:
+                self._pending[0:0] = requeue
+            self._in_flight = 0
+            if duration is None:
+                self._errors += 1
+            else:
+                self._flush_times.observe(duration)
+                self._flushed += len(batch)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _write(self, connection, batch):
+        """
+        Écrit un lot de lignes, à raison d'une requête
+        d'insertion multiple par table.
+        """
+        by_table = {}
+        for table, row in batch:
+            by_table.setdefault(table, []).append(row)
+        txn = connection.begin()
+        try:
+            for table, rows in by_table.iteritems():
+                connection.execute(table.insert(), rows)
+            txn.commit()
+        except:
+            txn.rollback()
+            raise
+
+    def _writer_thread(self):
+        """
+        Boucle principale du thread d'écriture.
+
+        @note: Cette méthode ne retourne pas tant que la méthode
+            L{HistoryWriter.shutdown} n'a pas été appelée.
+        """
+        connection = None
+        # Lors de l'arrêt, l'écriture n'est retentée qu'une seule fois.
+        retried = False
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                break
+            if not batch:
+                continue
+
+            requeue = None
+            duration = None
+            start = time.time()
+            try:
+                if connection is None:
+                    connection = self.engine.connect()
+                self._write(connection, batch)
+            except exc.OperationalError as e:
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                if self._stopping and retried:
+                    LOGGER.error(_('Could not write %(count)d history '
+                                   'entries while stopping, dropping them: '
+                                   '%(error)s'), {
+                                        'count': len(batch),
+                                        'error': e,
+                                    })
+                else:
+                    # Problème de connexion : les lignes seront de
+                    # nouveau écrites lors du prochain passage
+                    # (avec une nouvelle connexion).
+                    LOGGER.warning(_('Could not write %(count)d history '
+                                     'entries, will retry: %(error)s'), {
+                                        'count': len(batch),
+                                        'error': e,
+                                    })
+                    requeue = batch
+                    if self._stopping:
+                        retried = True
+                    else:
+                        time.sleep(min(self.flush_interval, 1.0))
+            except Exception as e:
+                LOGGER.error(_('Dropping %(count)d history entries: '
+                               '%(error)s'), {
+                                    'count': len(batch),
+                                    'error': e,
+                                })
+            else:
+                duration = time.time() - start
+            self._release(batch, requeue, duration)
+
+        if connection is not None:
+            connection.close()
+
+    def shutdown(self):
+        """
+        Écrit les lignes encore en attente puis arrête le thread.
+
+        @return: Deferred appelé une fois le thread arrêté.
+        @rtype: L{defer.Deferred}
+        """
+        self._cond.acquire()
+        try:
+            self._stopping = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        return self.defer
+
+    def getStats(self):
+        """
+        Récupère les métriques d'écriture de l'historique
+        depuis le dernier appel.
+
+        @rtype: C{dict}
+        """
+        self._cond.acquire()
+        try:
+            pending = len(self._pending) + self._in_flight
+            flushes = self._flush_times.count
+            duration = self._flush_times.mean()
+            self._flush_times.reset()
+            flushed, self._flushed = self._flushed, 0
+            errors, self._errors = self._errors, 0
+        finally:
+            self._cond.release()
+        stats = {
+            "history-pending": pending,
+            "history-flushes": flushes,
+            "history-errors": errors,
+            "history-flush-time": round(duration, 5),
+        }
+        if flushes:
+            stats["history-flush-size"] = round(
+                float(flushed) / flushes, 2)
+        else:
+            stats["history-flush-size"] = 0.0
+        return stats
+
+
+_writer = None
+
+def get_history_writer():
+    """
+    Retourne l'instance de L{HistoryWriter} utilisée par le processus,
+    ou C{None} si l'historique est écrit de manière synchrone.
+
+    @rtype: L{HistoryWriter}
+    """
+    return _writer
+
+def set_history_writer(writer):
+    """
+    Définit l'instance de L{HistoryWriter} utilisée par le processus.
+
+    @param writer: Nouvelle instance, ou C{None} pour revenir
+        à une écriture synchrone de l'historique.
+    @type writer: L{HistoryWriter}
+    """
+    global _writer # pylint: disable-msg=W0603
+    _writer = writer
+
+
+def historywriter_factory(settings, engine):
+    """
+    Crée et démarre le tampon d'écriture de l'historique
+    si celui-ci est activé dans la configuration.
+
+    @param settings: Configuration du corrélateur.
+    @param engine: Moteur SQLAlchemy de la base de données.
+    @type engine: C{sqlalchemy.engine.Engine}
+    @return: Le tampon d'écriture, ou C{None} s'il est désactivé.
+    @rtype: L{HistoryWriter}
+    """
+    options = settings['correlator']
+    try:
+        enabled = options.as_bool('async_history')
+    except KeyError:
+        enabled = False
+    if not enabled:
+        return None
+
+    def _get(name, default, conv):
+        try:
+            return conv(options[name])
+        except KeyError:
+            return default
+
+    writer = HistoryWriter(
+        engine,
+        batch_size=_get('history_batch_size', 500, int),
+        flush_interval=_get('history_flush_interval', 1.0, float),
+        max_pending=_get('history_max_pending', 20000, int),
+    )
+    writer.start()
+    set_history_writer(writer)
+    return writer
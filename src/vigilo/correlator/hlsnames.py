@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Cache des noms des services de haut niveau (L{HighLevelService})
+partagé par tout le processus.
+
+La correspondance entre les identifiants des services de haut niveau
+et leurs noms est chargée en une seule requête au démarrage du
+corrélateur (puis à chaque réception du signal SIGHUP). Les services
+absents du cache (créés depuis le dernier chargement) sont recherchés
+en une seule requête C{IN (...)}, puis ajoutés au cache.
+
+Comme pour L{vigilo.correlator.statenames}, la table de correspondance
+est immuable et son remplacement se fait par simple affectation, ce qui
+permet de la consulter sans verrou depuis n'importe quel thread.
+"""
+
+from vigilo.models.session import DBSession
+from vigilo.models.tables import HighLevelService
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'HighLevelServiceMap',
+    'load',
+    'reset',
+    'get_names',
+    'get_ids',
+    'lookup_ids',
+)
+
+
+class HighLevelServiceMap(object):
+    """
+    Table de correspondance bidirectionnelle et immuable entre
+    les identifiants des services de haut niveau et leurs noms.
+    """
+
+    __slots__ = ('_by_id', '_by_name')
+
+    def __init__(self, pairs, base=None):
+        """
+        Construit la table de correspondance.
+
+        @param pairs: Couples (identifiant du service, nom du service).
+        @type pairs: C{iterable} of C{tuple}
+        @param base: Table de correspondance dont le contenu
+            doit être repris dans la nouvelle table.
+        @type base: L{HighLevelServiceMap}
+        """
+        by_id = {}
+        by_name = {}
+        if base is not None:
+            by_id.update(base._by_id)
+            by_name.update(base._by_name)
+        for idservice, servicename in pairs:
+            by_id[idservice] = unicode(servicename)
+            by_name[unicode(servicename)] = idservice
+        object.__setattr__(self, '_by_id', by_id)
+        object.__setattr__(self, '_by_name', by_name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("HighLevelServiceMap objects are read-only")
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def extend(self, pairs):
+        """
+        Retourne une nouvelle table de correspondance
+        complétée par les couples donnés.
+
+        @param pairs: Couples (identifiant du service, nom du service).
+        @type pairs: C{iterable} of C{tuple}
+        @rtype: L{HighLevelServiceMap}
+        """
+        return HighLevelServiceMap(pairs, self)
+
+    def name(self, idservice):
+        """
+        @param idservice: Identifiant du service de haut niveau.
+        @type idservice: C{int}
+        @return: Nom du service ou C{None} s'il est absent du cache.
+        @rtype: C{unicode}
+        """
+        return self._by_id.get(idservice)
+
+    def idservice(self, servicename):
+        """
+        @param servicename: Nom du service de haut niveau.
+        @type servicename: C{unicode}
+        @return: Identifiant du service ou C{None} s'il est absent du cache.
+        @rtype: C{int}
+        """
+        return self._by_name.get(servicename)
+
+
+_current = None
+
+
+def load():
+    """
+    Charge (ou recharge) l'intégralité de la table des services
+    de haut niveau.
+
+    @note: Cette fonction exécute une requête SQL et doit donc être
+        appelée depuis le thread dédié à la base de données
+        (cf. L{DatabaseWrapper.run}).
+    @return: La nouvelle table de correspondance.
+    @rtype: L{HighLevelServiceMap}
+    """
+    global _current # pylint: disable-msg=W0603
+    rows = DBSession.query(
+            HighLevelService.idservice,
+            HighLevelService.servicename,
+        ).all()
+    _current = HighLevelServiceMap(rows)
+    LOGGER.debug(_('Loaded %d high-level service names'), len(_current))
+    return _current
+
+
+def reset():
+    """
+    Oublie la table de correspondance actuellement chargée.
+    Elle sera rechargée lors de sa prochaine utilisation.
+    """
+    global _current # pylint: disable-msg=W0603
+    _current = None
+
+
+def _get_map():
+    """
+    Retourne la table de correspondance courante,
+    en la chargeant si nécessaire.
+
+    @note: Cette fonction doit être appelée depuis
+        le thread dédié à la base de données.
+    @rtype: L{HighLevelServiceMap}
+    """
+    current = _current
+    if current is None:
+        current = load()
+    return current
+
+
+def _complete(current, column, missing):
+    """
+    Recherche en une seule requête les services absents du cache
+    et retourne la table de correspondance complétée.
+    """
+    global _current # pylint: disable-msg=W0603
+    rows = DBSession.query(
+            HighLevelService.idservice,
+            HighLevelService.servicename,
+        ).filter(column.in_(missing)
+        ).all()
+    if rows:
+        current = current.extend(rows)
+        _current = current
+    return current
+
+
+def get_names(idservices):
+    """
+    Retourne les noms des services de haut niveau dont
+    les identifiants sont donnés.
+
+    @note: Cette fonction peut exécuter une requête SQL et doit donc
+        être appelée depuis le thread dédié à la base de données.
+    @param idservices: Identifiants des services de haut niveau.
+    @type idservices: C{iterable} of C{int}
+    @return: Noms des services, indexés par leur identifiant
+        (les services inexistants sont absents du résultat).
+    @rtype: C{dict}
+    """
+    current = _get_map()
+    missing = set(idservice for idservice in idservices
+                  if current.name(idservice) is None)
+    if missing:
+        current = _complete(current, HighLevelService.idservice, missing)
+    return dict((idservice, current.name(idservice))
+                for idservice in idservices
+                if current.name(idservice) is not None)
+
+
+def get_ids(servicenames):
+    """
+    Retourne les identifiants des services de haut niveau
+    dont les noms sont donnés.
+
+    @note: Cette fonction peut exécuter une requête SQL et doit donc
+        être appelée depuis le thread dédié à la base de données.
+    @param servicenames: Noms des services de haut niveau.
+    @type servicenames: C{iterable} of C{unicode}
+    @return: Identifiants des services, indexés par leur nom
+        (les services inexistants sont absents du résultat).
+    @rtype: C{dict}
+    """
+    current = _get_map()
+    missing = set(servicename for servicename in servicenames
+                  if current.idservice(servicename) is None)
+    if missing:
+        current = _complete(current, HighLevelService.servicename, missing)
+    return dict((servicename, current.idservice(servicename))
+                for servicename in servicenames
+                if current.idservice(servicename) is not None)
+
+
+def lookup_ids(servicenames):
+    """
+    Recherche les identifiants de services de haut niveau
+    dans le cache uniquement (aucune requête SQL).
+
+    Cette fonction peut donc être appelée depuis n'importe quel thread.
+
+    @param servicenames: Noms des services de haut niveau.
+    @type servicenames: C{iterable} of C{unicode}
+    @return: Identifiants des services trouvés, indexés par leur nom,
+        et liste des noms absents du cache.
+    @rtype: C{tuple}
+    """
+    current = _current
+    if current is None:
+        return {}, list(servicenames)
+    found = {}
+    missing = []
+    for servicename in servicenames:
+        idservice = current.idservice(servicename)
+        if idservice is None:
+            missing.append(servicename)
+        else:
+            found[servicename] = idservice
+    return found, missing
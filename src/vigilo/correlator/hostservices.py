@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Cache des services de bas niveau (L{LowLevelService}) de chaque hôte,
+partagé par tout le processus.
+
+Les services de l'ensemble des hôtes sont chargés en une seule requête
+au démarrage du corrélateur (puis à chaque réception du signal SIGHUP,
+envoyé notamment lors du déploiement d'une nouvelle configuration).
+Les hôtes absents du cache sont recherchés individuellement puis ajoutés
+au cache.
+
+Pour les parcs de très grande taille, le nombre d'hôtes conservés en
+mémoire peut être limité (option C{services_cache_size} de la section
+[correlator]) : les hôtes les moins récemment utilisés sont alors
+retirés du cache.
+"""
+
+import threading
+from collections import namedtuple, OrderedDict
+
+from sqlalchemy import and_
+
+from vigilo.models.session import DBSession
+from vigilo.models.tables import Host, LowLevelService, ConfItem
+
+from vigilo.common.conf import settings
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'Service',
+    'HostServicesIndex',
+    'load',
+    'reset',
+    'lookup',
+    'get_services',
+)
+
+
+Service = namedtuple('Service', 'idsupitem servicename max_check_attempts')
+
+
+class HostServicesIndex(object):
+    """
+    Index des services de bas niveau de chaque hôte,
+    avec éviction des hôtes les moins récemment utilisés.
+
+    L'index peut être consulté et alimenté depuis n'importe quel thread.
+    """
+
+    def __init__(self, max_hosts=0):
+        """
+        @param max_hosts: Nombre maximum d'hôtes conservés dans l'index.
+            La valeur 0 désactive cette limite.
+        @type max_hosts: C{int}
+        """
+        self.max_hosts = max_hosts
+        self._lock = threading.Lock()
+        self._services = OrderedDict()
+
+    def __len__(self):
+        return len(self._services)
+
+    def get(self, hostname):
+        """
+        @param hostname: Nom de l'hôte.
+        @type hostname: C{unicode}
+        @return: Services de l'hôte ou C{None} s'il est absent de l'index.
+        @rtype: C{tuple} of L{Service}
+        """
+        self._lock.acquire()
+        try:
+            services = self._services.pop(hostname, None)
+            if services is not None:
+                self._services[hostname] = services
+            return services
+        finally:
+            self._lock.release()
+
+    def put(self, hostname, services):
+        """
+        Ajoute (ou remplace) les services d'un hôte dans l'index.
+
+        @param hostname: Nom de l'hôte.
+        @type hostname: C{unicode}
+        @param services: Services de l'hôte.
+        @type services: C{iterable} of L{Service}
+        """
+        self._lock.acquire()
+        try:
+            self._services.pop(hostname, None)
+            self._services[hostname] = tuple(services)
+            if self.max_hosts > 0:
+                while len(self._services) > self.max_hosts:
+                    self._services.popitem(last=False)
+        finally:
+            self._lock.release()
+
+
+_current = None
+
+
+def _max_hosts():
+    try:
+        return settings['correlator'].as_int('services_cache_size')
+    except KeyError:
+        return 0
+
+
+def _query():
+    return DBSession.query(
+            Host.name,
+            LowLevelService.idsupitem,
+            LowLevelService.servicename,
+            ConfItem.value,
+        ).join(
+            (LowLevelService, LowLevelService.idhost == Host.idsupitem)
+        ).outerjoin(
+            (ConfItem, and_(
+                ConfItem.idsupitem == LowLevelService.idsupitem,
+                ConfItem.name == u'max_check_attempts',
+            ))
+        )
+
+
+def load(max_hosts=None):
+    """
+    Charge (ou recharge) les services de l'ensemble des hôtes.
+
+    @note: Cette fonction exécute une requête SQL et doit donc être
+        appelée depuis le thread dédié à la base de données
+        (cf. L{DatabaseWrapper.run}).
+    @param max_hosts: Nombre maximum d'hôtes conservés en mémoire
+        (par défaut, la valeur de l'option C{services_cache_size}).
+    @type max_hosts: C{int}
+    @return: Le nouvel index.
+    @rtype: L{HostServicesIndex}
+    """
+    global _current # pylint: disable-msg=W0603
+    if max_hosts is None:
+        max_hosts = _max_hosts()
+    by_host = OrderedDict()
+    for hostname, idsupitem, servicename, attempts in _query().all():
+        by_host.setdefault(hostname, []).append(
+            Service(idsupitem, servicename, attempts))
+    index = HostServicesIndex(max_hosts)
+    for hostname, services in by_host.iteritems():
+        index.put(hostname, services)
+    _current = index
+    LOGGER.debug(_('Loaded the services of %d hosts'), len(index))
+    return index
+
+
+def reset():
+    """
+    Oublie l'index actuellement chargé.
+    Il sera rechargé lors de sa prochaine utilisation.
+    """
+    global _current # pylint: disable-msg=W0603
+    _current = None
+
+
+def lookup(hostname):
+    """
+    Recherche les services d'un hôte dans le cache uniquement
+    (aucune requête SQL).
+
+    Cette fonction peut donc être appelée depuis n'importe quel thread.
+
+    @param hostname: Nom de l'hôte.
+    @type hostname: C{unicode}
+    @return: Services de l'hôte ou C{None} s'il est absent du cache.
+    @rtype: C{list} of L{Service}
+    """
+    current = _current
+    if current is None:
+        return None
+    services = current.get(unicode(hostname))
+    if services is None:
+        return None
+    return list(services)
+
+
+def get_services(hostname):
+    """
+    Retourne les services d'un hôte, en les recherchant
+    dans la base de données s'ils sont absents du cache.
+
+    @note: Cette fonction peut exécuter une requête SQL et doit donc
+        être appelée depuis le thread dédié à la base de données.
+    @param hostname: Nom de l'hôte.
+    @type hostname: C{unicode}
+    @return: Services de l'hôte.
+    @rtype: C{list} of L{Service}
+    """
+    hostname = unicode(hostname)
+    current = _current
+    if current is None:
+        current = load()
+    services = current.get(hostname)
+    if services is None:
+        services = [
+            Service(idsupitem, servicename, attempts)
+            for _name, idsupitem, servicename, attempts
+            in _query().filter(Host.name == hostname).all()
+        ]
+        current.put(hostname, services)
+    return list(services)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Exposition des durées des étapes du traitement au format texte
+de Prometheus, via un serveur HTTP local.
+
+Pour chaque étape, la page contient l'histogramme complet des durées
+(famille C{vigilo_correlator_stage_duration_seconds}) ainsi qu'une
+estimation des quantiles 0.5, 0.95 et 0.99
+(famille C{vigilo_correlator_stage_latency_seconds}).
+
+Lorsque le corrélateur s'exécute sous la forme de plusieurs processus,
+chacun d'eux écoute sur son propre port : C{metrics_port} pour le
+processus n°1, C{metrics_port + 1} pour le processus n°2, etc.
+"""
+
+from twisted.web import resource, server
+from twisted.application import internet
+
+from vigilo.correlator.metrics import get_stage_metrics
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'MetricsResource',
+    'format_metrics',
+    'metrics_service_factory',
+)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+HISTOGRAM_NAME = "vigilo_correlator_stage_duration_seconds"
+QUANTILES_NAME = "vigilo_correlator_stage_latency_seconds"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_metrics(stage_metrics=None):
+    """
+    Construit la représentation des métriques au format texte
+    de Prometheus.
+
+    @param stage_metrics: Histogrammes des étapes du traitement
+        (ceux du processus par défaut).
+    @type stage_metrics: L{vigilo.correlator.metrics.StageMetrics}
+    @rtype: C{str}
+    """
+    if stage_metrics is None:
+        stage_metrics = get_stage_metrics()
+    stages = [(_escape(stage), histogram)
+              for (stage, histogram) in stage_metrics.stages()]
+
+    lines = [
+        "# HELP %s Duration of each processing stage." % HISTOGRAM_NAME,
+        "# TYPE %s histogram" % HISTOGRAM_NAME,
+    ]
+    for stage, histogram in stages:
+        for bound, count in histogram.cumulative():
+            lines.append('%s_bucket{stage="%s",le="%s"} %d' % (
+                HISTOGRAM_NAME, stage, _number(bound), count))
+        lines.append('%s_sum{stage="%s"} %s' % (
+            HISTOGRAM_NAME, stage, _number(histogram.sum)))
+        lines.append('%s_count{stage="%s"} %d' % (
+            HISTOGRAM_NAME, stage, histogram.count))
+
+    lines.extend([
+        "# HELP %s Estimated quantiles of the duration "
+            "of each processing stage." % QUANTILES_NAME,
+        "# TYPE %s gauge" % QUANTILES_NAME,
+    ])
+    for stage, histogram in stages:
+        for quantile in QUANTILES:
+            lines.append('%s{stage="%s",quantile="%s"} %s' % (
+                QUANTILES_NAME, stage, quantile,
+                _number(histogram.quantile(quantile))))
+    return "\n".join(lines) + "\n"
+
+
+
+class MetricsResource(resource.Resource):
+    """
+    Ressource HTTP présentant les métriques au format de Prometheus.
+    """
+
+    isLeaf = True
+
+    def __init__(self, stage_metrics=None):
+        """
+        @param stage_metrics: Histogrammes des étapes du traitement
+            (ceux du processus par défaut).
+        @type stage_metrics: L{vigilo.correlator.metrics.StageMetrics}
+        """
+        resource.Resource.__init__(self)
+        self._stage_metrics = stage_metrics
+
+
+    def render_GET(self, request):
+        # pylint: disable-msg=C0103
+        # C0103: Invalid name (imposé par Twisted)
+        request.setHeader("Content-Type", CONTENT_TYPE)
+        return format_metrics(self._stage_metrics)
+
+
+
+def metrics_service_factory(settings, worker=None):
+    """
+    Crée le serveur HTTP exposant les métriques.
+
+    @param settings: Configuration du corrélateur.
+    @param worker: Numéro du processus courant (à partir de 1),
+        ou C{None} si le corrélateur s'exécute dans un seul processus.
+    @type worker: C{int}
+    @return: Le service, ou C{None} si l'exposition
+        des métriques est désactivée.
+    @rtype: L{internet.TCPServer}
+    """
+    options = settings['correlator']
+
+    def _get(name, default, conv):
+        try:
+            return conv(options[name])
+        except KeyError:
+            return default
+
+    port = _get('metrics_port', 0, int)
+    if not port:
+        return None
+    if worker is not None:
+        port += worker - 1
+    interface = _get('metrics_interface', '127.0.0.1', str)
+
+    LOGGER.info(_('Exposing metrics on http://%(interface)s:%(port)d/'), {
+        'interface': interface,
+        'port': port,
+    })
+    site = server.Site(MetricsResource())
+    # Les requêtes de collecte, très fréquentes, ne sont pas journalisées.
+    site.noisy = False
+    site.log = lambda _request: None
+    return internet.TCPServer(port, site, interface=interface)
@@ -269,6 +269,89 @@ class MemcachedConnection(object):
         d.addCallback(_check_set)
         return d
 
+    def set_multi(self, values, transaction=True, **kwargs):
+        """
+        Associe plusieurs valeurs à plusieurs clés en une seule fois.
+
+        Les commandes d'enregistrement sont envoyées à la suite sur
+        la même connexion, sans attendre la réponse du serveur
+        entre chaque commande.
+
+        @param values: Dictionnaire des valeurs à enregistrer,
+            indexées par leur clé.
+        @type values: C{dict}
+
+        @return: Deferred appelé une fois toutes les valeurs enregistrées.
+        @rtype: L{defer.Deferred}
+        """
+        d = self._store_multi('set', values, transaction, **kwargs)
+        def _check_set(stored):
+            # Lève une exception si une valeur n'a pas pu être stockée.
+            if stored != len(values):
+                raise Exception
+        d.addCallback(_check_set)
+        return d
+
+    def add_multi(self, values, transaction=True, **kwargs):
+        """
+        Associe plusieurs valeurs à plusieurs clés en une seule fois,
+        uniquement pour les clés qui ne sont pas déjà définies
+        (les valeurs déjà présentes sont conservées).
+
+        @param values: Dictionnaire des valeurs à enregistrer,
+            indexées par leur clé.
+        @type values: C{dict}
+
+        @return: Deferred renvoyant le nombre de valeurs enregistrées.
+        @rtype: L{defer.Deferred}
+        """
+        return self._store_multi('add', values, transaction, **kwargs)
+
+    def _store_multi(self, command, values, transaction=True, **kwargs):
+        if not values:
+            return defer.succeed(0)
+
+        LOGGER.debug(_("Trying to %(command)s %(count)d values "
+                        "(transaction=%(txn)r)."), {
+                        'command': command,
+                        'count': len(values),
+                        'txn': transaction,
+                    })
+
+        exp_time = self.__convert_to_datetime(kwargs.pop('time', None))
+        flags = kwargs.pop('flags', 0)
+        if exp_time is None:
+            exp_time = 0
+        else:
+            exp_time = calendar.timegm(exp_time.utctimetuple())
+
+        items = []
+        for key, value in values.iteritems():
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            items.append((urllib.quote_plus(key), pickle.dumps(value)))
+
+        def _count_stored(results):
+            stored = 0
+            for success, res in results:
+                if not success:
+                    return res
+                if res:
+                    stored += 1
+            return stored
+
+        def _store_all(cache):
+            store = getattr(cache, command)
+            return defer.DeferredList([
+                store(key, pick_value, flags, exp_time)
+                for (key, pick_value) in items
+            ], consumeErrors=True)
+
+        d = self._cache.getInstance()
+        d.addCallback(_store_all)
+        d.addCallback(_count_stored)
+        return d
+
     def get(self, key, transaction=True, flags=0):
         """
         Récupère la valeur associée à la clé 'key'.
@@ -303,6 +386,42 @@ class MemcachedConnection(object):
         d.addCallback(_check_result, key, transaction, flags)
         return d
 
+    def get_multi(self, keys, transaction=True):
+        """
+        Récupère en une seule requête les valeurs associées à plusieurs clés.
+
+        @param keys: Les clés dont les valeurs doivent être récupérées.
+        @type keys: C{iterable} of C{str}
+
+        @return: Dictionnaire des valeurs, indexées par leur clé
+            (None pour les clés qui n'existent pas).
+        @rtype: L{defer.Deferred}
+        """
+        keys = [isinstance(key, unicode) and key.encode('utf-8') or key
+                for key in keys]
+        if not keys:
+            return defer.succeed({})
+
+        LOGGER.debug(_("Trying to get the values of %(count)d keys "
+                        "(transaction=%(txn)r)."), {
+                            'count': len(keys),
+                            'txn': transaction,
+                        })
+
+        quoted = dict((urllib.quote_plus(key), key) for key in keys)
+
+        def _check_results(results):
+            values = dict.fromkeys(keys)
+            for key, result in results.iteritems():
+                if key in quoted and result[-1] is not None:
+                    values[quoted[key]] = pickle.loads(str(result[-1]))
+            return values
+
+        d = self._cache.getInstance()
+        d.addCallback(lambda cache: cache.getMultiple(quoted.keys()))
+        d.addCallback(_check_results)
+        return d
+
     def delete(self, key, transaction=True):
         """
         Supprime la clé 'key' et la valeur qui lui est associée.
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Outils de mesure utilisés pour les métriques de fonctionnement
+du corrélateur.
+
+Les durées des différentes étapes du traitement des messages (décodage,
+recherche de l'élément supervisé, exécution de chaque règle, etc.) sont
+enregistrées dans des histogrammes de taille fixe partagés par tout le
+processus (cf. L{get_stage_metrics}), exposés au format de Prometheus
+(cf. L{vigilo.correlator.http_metrics}).
+"""
+
+import time
+import bisect
+
+__all__ = (
+    'Histogram',
+    'StageMetrics',
+    'get_stage_metrics',
+    'reset',
+    'timed',
+)
+
+
+class Histogram(object):
+    """
+    Histogramme à intervalles fixes.
+
+    Les bornes des intervalles sont exprimées en secondes. Chaque valeur
+    observée est comptabilisée dans le premier intervalle dont la borne
+    supérieure est supérieure ou égale à la valeur (un dernier intervalle
+    non borné recueille les valeurs restantes).
+
+    @note: Cette classe n'est pas protégée contre les accès concurrents.
+    """
+
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                       0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        """
+        @param buckets: Bornes supérieures des intervalles.
+        @type buckets: C{iterable} of C{float}
+        """
+        if buckets is None:
+            buckets = self.DEFAULT_BUCKETS
+        self.buckets = tuple(sorted(buckets))
+        self.reset()
+
+    def reset(self):
+        """Oublie toutes les valeurs observées."""
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """
+        Enregistre une nouvelle valeur.
+
+        @param value: Valeur observée.
+        @type value: C{float}
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        """
+        @return: Moyenne des valeurs observées (0.0 si aucune).
+        @rtype: C{float}
+        """
+        if not self.count:
+            return 0.0
+        return self.sum / self.count
+
+    def quantile(self, q):
+        """
+        Estime un quantile des valeurs observées.
+
+        L'estimation retournée correspond à la borne supérieure de
+        l'intervalle contenant le quantile (ou à la plus grande valeur
+        observée si celle-ci est inférieure).
+
+        @param q: Quantile recherché (entre 0 et 1).
+        @type q: C{float}
+        @rtype: C{float}
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max)
+                break
+        return self.max
+
+    def cumulative(self):
+        """
+        Retourne le nombre cumulé de valeurs observées
+        pour chaque borne (la dernière borne étant infinie).
+
+        @rtype: C{list} of C{tuple}
+        """
+        result = []
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), self.counts):
+            seen += count
+            result.append((bound, seen))
+        return result
+
+
+class StageMetrics(object):
+    """
+    Histogrammes des durées de chacune des étapes du traitement.
+
+    Contrairement aux métriques publiées par L{RuleDispatcher.getStats},
+    ces histogrammes ne sont jamais remis à zéro (à la manière des
+    compteurs de Prometheus) et occupent une quantité de mémoire fixe.
+
+    @note: Les durées doivent être enregistrées depuis le thread
+        du réacteur.
+    """
+
+    def __init__(self, buckets=None):
+        """
+        @param buckets: Bornes supérieures des intervalles
+            des histogrammes (cf. L{Histogram}).
+        @type buckets: C{iterable} of C{float}
+        """
+        self.buckets = buckets
+        self._histograms = {}
+
+    def observe(self, stage, value):
+        """
+        Enregistre la durée d'une étape.
+
+        @param stage: Nom de l'étape.
+        @type stage: C{str}
+        @param value: Durée (en secondes).
+        @type value: C{float}
+        """
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def get(self, stage):
+        """
+        @param stage: Nom de l'étape.
+        @type stage: C{str}
+        @return: Histogramme de l'étape, ou C{None}
+            si aucune durée n'a été enregistrée.
+        @rtype: L{Histogram}
+        """
+        return self._histograms.get(stage)
+
+    def stages(self):
+        """
+        @return: Couples (nom de l'étape, histogramme), triés par nom.
+        @rtype: C{list} of C{tuple}
+        """
+        return sorted(self._histograms.items())
+
+
+_stages = None
+
+
+def get_stage_metrics():
+    """
+    Retourne les histogrammes des étapes du traitement du processus,
+    en les créant si nécessaire.
+
+    @rtype: L{StageMetrics}
+    """
+    global _stages # pylint: disable-msg=W0603
+    stages = _stages
+    if stages is None:
+        stages = _stages = StageMetrics()
+    return stages
+
+
+def reset():
+    """Oublie les durées enregistrées pour toutes les étapes."""
+    global _stages # pylint: disable-msg=W0603
+    _stages = None
+
+
+def timed(stage, d, start=None):
+    """
+    Enregistre la durée d'une opération asynchrone, que celle-ci
+    réussisse ou non.
+
+    @param stage: Nom de l'étape.
+    @type stage: C{str}
+    @param d: Deferred de l'opération.
+    @type d: L{defer.Deferred}
+    @param start: Date de début de l'opération
+        (par défaut, la date courante).
+    @type start: C{float}
+    @return: Le Deferred de l'opération.
+    @rtype: L{defer.Deferred}
+    """
+    if start is None:
+        start = time.time()
+    def record(result):
+        get_stage_metrics().observe(stage, time.time() - start)
+        return result
+    d.addBoth(record)
+    return d
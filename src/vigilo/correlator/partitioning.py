@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Répartition des événements entre plusieurs instances du corrélateur.
+
+Par défaut, les instances consomment la même file d'attente de manière
+concurrente : les événements portant sur un même élément supervisé
+peuvent donc être traités simultanément par des instances différentes.
+
+En mode partitionné, chaque instance est propriétaire d'une partie des
+hôtes, déterminée par hachage cohérent (L{HashRing}) du nom de l'hôte.
+Un hôte et ses services sont ainsi toujours traités par la même instance.
+Une instance qui reçoit un événement dont elle n'est pas propriétaire
+le transmet à l'instance propriétaire (L{Partitioner}), qui le traite
+sans le retransmettre.
+
+Les instances actives sont découvertes à l'aide de memcached : chacune
+y enregistre régulièrement un battement de cœur (L{Membership}).
+Lorsqu'une instance apparaît ou disparaît, seule la part des hôtes
+qui la concerne change de propriétaire.
+"""
+
+import json
+import bisect
+import hashlib
+
+from twisted.internet import defer, task
+
+from vigilo.connector.handlers import MessageHandler
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'HashRing',
+    'partition_key',
+    'Partitioner',
+    'Membership',
+    'BusForwarder',
+    'PartitionReceiver',
+    'partitioner_factory',
+)
+
+
+def _hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Anneau de hachage cohérent.
+
+    Chaque membre est placé à C{replicas} positions sur l'anneau.
+    Une clé appartient au premier membre rencontré après sa propre
+    position.
+    """
+
+    def __init__(self, members=(), replicas=64):
+        """
+        @param members: Membres initiaux de l'anneau.
+        @type members: C{iterable} of C{str}
+        @param replicas: Nombre de positions de chaque membre sur l'anneau.
+        @type replicas: C{int}
+        """
+        self.replicas = replicas
+        self._members = frozenset()
+        self._points = []
+        self._owners = []
+        self.set_members(members)
+
+    @property
+    def members(self):
+        """
+        Membres de l'anneau.
+        @rtype: C{frozenset}
+        """
+        return self._members
+
+    def set_members(self, members):
+        """
+        Remplace les membres de l'anneau.
+
+        @param members: Nouveaux membres.
+        @type members: C{iterable} of C{str}
+        @return: Indique si les membres ont changé.
+        @rtype: C{bool}
+        """
+        members = frozenset(str(member) for member in members)
+        if members == self._members:
+            return False
+        ring = sorted(
+            (_hash("%s-%d" % (member, replica)), member)
+            for member in members
+            for replica in xrange(self.replicas)
+        )
+        # Remplacement atomique de l'anneau.
+        self._points, self._owners, self._members = \
+            [point for point, _member in ring], \
+            [member for _point, member in ring], \
+            members
+        return True
+
+    def owner(self, key):
+        """
+        @param key: Clé dont on recherche le propriétaire.
+        @type key: C{unicode}
+        @return: Membre propriétaire de la clé
+            ou C{None} si l'anneau est vide.
+        @rtype: C{str}
+        """
+        points, owners = self._points, self._owners
+        if not points:
+            return None
+        index = bisect.bisect(points, _hash(key)) % len(points)
+        return owners[index]
+
+
+def partition_key(msg):
+    """
+    Retourne la clé de répartition d'un message.
+
+    Seuls les événements sont répartis, selon le nom de l'hôte concerné :
+    les autres messages sont traités par l'instance qui les reçoit.
+
+    @param msg: Message reçu du bus.
+    @type msg: C{dict}
+    @return: Clé de répartition ou C{None}.
+    @rtype: C{unicode}
+    """
+    if msg.get("type") != "event":
+        return None
+    host = msg.get("host")
+    if not host:
+        return None
+    if not isinstance(host, unicode):
+        host = host.decode('utf-8')
+    return host
+
+
+class Partitioner(object):
+    """
+    Détermine l'instance propriétaire de chaque message
+    et transmet à celle-ci les messages qui ne sont pas
+    destinés à l'instance courante.
+    """
+
+    def __init__(self, instance, ring, forwarder):
+        """
+        @param instance: Identifiant de l'instance courante.
+        @type instance: C{str}
+        @param ring: Anneau de hachage partagé avec L{Membership}.
+        @type ring: L{HashRing}
+        @param forwarder: Objet chargé de la transmission des messages,
+            disposant d'une méthode C{forward(owner, msg)}.
+        """
+        self.instance = str(instance)
+        self.ring = ring
+        self.forwarder = forwarder
+        self._local = 0
+        self._forwarded = 0
+
+    def route(self, msg):
+        """
+        Transmet un message à l'instance qui en est propriétaire.
+
+        @param msg: Message reçu du bus.
+        @type msg: C{dict}
+        @return: Deferred de transmission du message ou C{None}
+            si le message doit être traité par l'instance courante.
+        @rtype: L{defer.Deferred}
+        """
+        key = partition_key(msg)
+        if key is None:
+            return None
+        owner = self.ring.owner(key)
+        if owner is None or owner == self.instance:
+            self._local += 1
+            return None
+        self._forwarded += 1
+        LOGGER.debug(_('Forwarding the event on "%(host)s" to instance '
+                       '%(owner)s'), {'host': key, 'owner': owner})
+        return defer.maybeDeferred(self.forwarder.forward, owner, msg)
+
+    def getStats(self):
+        """
+        Récupère les métriques de répartition depuis le dernier appel.
+
+        @rtype: C{dict}
+        """
+        stats = {
+            "partition-local": self._local,
+            "partition-forwarded": self._forwarded,
+            "partition-members": len(self.ring.members),
+        }
+        self._local = self._forwarded = 0
+        return stats
+
+
+class Membership(object):
+    """
+    Détection des instances actives à l'aide de battements de cœur
+    enregistrés dans memcached.
+
+    Toutes les C{interval} secondes, l'instance courante enregistre son
+    battement de cœur (qui expire au bout de C{3 * interval} secondes),
+    puis lit ceux des autres instances candidates. L'anneau est mis
+    à jour en conséquence.
+    """
+
+    KEY = 'vigilo:partition:%s'
+
+    def __init__(self, instance, candidates, ring, connection,
+                 interval=5.0, clock=None):
+        """
+        @param instance: Identifiant de l'instance courante.
+        @type instance: C{str}
+        @param candidates: Identifiants de toutes les instances
+            susceptibles de participer à la répartition.
+        @type candidates: C{iterable} of C{str}
+        @param ring: Anneau de hachage à mettre à jour.
+        @type ring: L{HashRing}
+        @param connection: Connexion à memcached.
+        @type connection: L{MemcachedConnection}
+        @param interval: Intervalle (en secondes) entre deux battements.
+        @type interval: C{float}
+        """
+        self.instance = str(instance)
+        self.candidates = [str(candidate) for candidate in candidates]
+        if self.instance not in self.candidates:
+            self.candidates.append(self.instance)
+        self.ring = ring
+        self.interval = interval
+        self._connection = connection
+        self._call = task.LoopingCall(self.beat)
+        if clock is not None:
+            self._call.clock = clock
+
+    def start(self):
+        """Démarre l'envoi des battements de cœur."""
+        # L'instance courante est seule propriétaire jusqu'au
+        # premier battement (pas de perte d'événements).
+        if not self.ring.members:
+            self.ring.set_members([self.instance])
+        self._call.start(self.interval, now=True)
+
+    def stop(self):
+        """
+        Arrête l'envoi des battements de cœur et se retire de l'anneau
+        (les autres instances s'en apercevront à l'expiration
+        du dernier battement).
+        """
+        if self._call.running:
+            self._call.stop()
+        return defer.maybeDeferred(self._connection.delete,
+                                   self.KEY % self.instance, False)
+
+    @defer.inlineCallbacks
+    def beat(self):
+        """
+        Enregistre le battement de cœur de l'instance courante
+        et met à jour l'anneau avec les instances actives.
+        """
+        try:
+            yield defer.maybeDeferred(
+                self._connection.set, self.KEY % self.instance, 1,
+                False, time=int(self.interval * 3))
+            keys = [self.KEY % candidate for candidate in self.candidates]
+            values = yield defer.maybeDeferred(
+                self._connection.get_multi, keys, False)
+        except Exception as e: # pylint: disable-msg=W0703
+            LOGGER.warning(_('Could not refresh the partitioning '
+                             'membership: %s'), e)
+            return
+        alive = [candidate for candidate in self.candidates
+                 if values.get(self.KEY % candidate) is not None]
+        alive.append(self.instance)
+        if self.ring.set_members(alive):
+            LOGGER.info(_('Partitioning members changed: %s'),
+                        u", ".join(sorted(self.ring.members)))
+
+
+class BusForwarder(object):
+    """
+    Transmet les messages à leur instance propriétaire via le bus.
+
+    Le message d'origine est encapsulé dans un message dont le type
+    (C{correlator-<instance>}) détermine l'exchange de destination,
+    auquel seule l'instance propriétaire est abonnée
+    (cf. L{PartitionReceiver}).
+    """
+
+    def __init__(self, publisher):
+        """
+        @param publisher: Objet de publication des messages sur le bus.
+        @type publisher: L{vigilo.connector.handlers.BusPublisher}
+        """
+        self.publisher = publisher
+
+    def forward(self, owner, msg):
+        """
+        @param owner: Identifiant de l'instance destinataire.
+        @type owner: C{str}
+        @param msg: Message à transmettre.
+        @type msg: C{dict}
+        """
+        return self.publisher.sendMessage({
+            "type": "correlator-%s" % owner,
+            "message": msg,
+        })
+
+
+class PartitionReceiver(MessageHandler):
+    """
+    Reçoit les messages transmis à l'instance courante par les autres
+    instances et les confie au L{RuleDispatcher}, sans les retransmettre.
+    """
+
+    def __init__(self, dispatcher):
+        """
+        @param dispatcher: Gestionnaire des messages de l'instance.
+        @type dispatcher: L{RuleDispatcher}
+        """
+        super(PartitionReceiver, self).__init__()
+        self.dispatcher = dispatcher
+
+    def write(self, msg):
+        content = json.loads(msg.content.body)
+        d = defer.maybeDeferred(self.processMessage, content)
+        d.addCallbacks(self.processingSucceeded, self.processingFailed,
+                       callbackArgs=(msg, ))
+        if self.keepProducing:
+            d.addBoth(lambda _x: self.producer.resumeProducing())
+        return d
+
+    def processMessage(self, msg):
+        return self.dispatcher.processForwardedMessage(msg["message"])
+
+
+
+def partitioner_factory(settings, instance, publisher, worker=None,
+                        workers=1):
+    """
+    Crée les objets nécessaires au mode partitionné
+    si celui-ci est activé dans la configuration.
+
+    Lorsque le corrélateur s'exécute sous la forme de plusieurs processus
+    (cf. L{vigilo.correlator.supervisor}), chaque processus est un membre
+    à part entière de l'anneau, identifié par C{<instance>.<processus>}.
+    Si aucune autre instance n'est configurée, l'anneau se limite alors
+    aux processus de l'instance courante (sans détection des membres
+    actifs : un processus arrêté est relancé par le superviseur).
+
+    @param settings: Configuration du corrélateur.
+    @param instance: Identifiant de l'instance courante.
+    @type instance: C{str}
+    @param publisher: Objet de publication des messages sur le bus.
+    @type publisher: L{vigilo.connector.handlers.BusPublisher}
+    @param worker: Numéro du processus courant, s'il y a lieu.
+    @type worker: C{int}
+    @param workers: Nombre de processus de l'instance.
+    @type workers: C{int}
+    @return: Objet de répartition et objet de détection des instances
+        actives (C{None} si la détection est inutile),
+        ou C{(None, None)} si le mode partitionné est désactivé.
+    @rtype: C{tuple}
+    """
+    options = settings['correlator']
+    try:
+        candidates = options.as_list('partition_instances')
+    except KeyError:
+        candidates = []
+    candidates = [candidate.strip() for candidate in candidates
+                  if candidate.strip()]
+
+    if worker is not None and workers > 1:
+        def members(instance):
+            return ["%s.%d" % (instance, number)
+                    for number in xrange(1, workers + 1)]
+        if not candidates:
+            ring = HashRing(members(instance))
+            partitioner = Partitioner("%s.%d" % (instance, worker), ring,
+                                      BusForwarder(publisher))
+            return partitioner, None
+        candidates = [member for candidate in candidates
+                      for member in members(candidate)]
+        instance = "%s.%d" % (instance, worker)
+
+    if not candidates:
+        return None, None
+
+    try:
+        interval = options.as_float('partition_heartbeat')
+    except KeyError:
+        interval = 5.0
+
+    from vigilo.correlator.memcached_connection import MemcachedConnection
+    ring = HashRing()
+    partitioner = Partitioner(instance, ring, BusForwarder(publisher))
+    membership = Membership(instance, candidates, ring,
+                            MemcachedConnection(), interval)
+    return partitioner, membership
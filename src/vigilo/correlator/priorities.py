@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Cache des priorités des événements corrélés ouverts, partagé
+par tout le processus.
+
+Pour chaque élément supervisé, le cache conserve l'identifiant de
+l'événement corrélé ouvert dont il est la cause et sa priorité (ou
+l'absence d'un tel événement). Il est tenu à jour par
+L{vigilo.correlator.correvent.CorrEventBuilder} une fois la transaction
+qui modifie l'événement corrélé validée, ce qui permet à la règle
+L{vigilo.correlator.rules.priority_max.PriorityMaxRule} de ne plus
+interroger la base de données.
+
+Les entrées expirent au bout de C{priority_cache_ttl} secondes (option
+de la section [correlator]) afin de prendre en compte les modifications
+réalisées en dehors du corrélateur (par exemple depuis VigiBoard).
+
+En cas d'absence du cache, la priorité lue dans la base de données n'est
+enregistrée (cf. L{PriorityCache.fill}) que si l'entrée n'a pas été
+modifiée entre-temps par la validation d'une transaction : une lecture
+concurrente ne peut ainsi pas remplacer une valeur plus récente.
+
+Le cache n'est fiable que si les événements d'un élément supervisé sont
+toujours traités par le même processus, c'est-à-dire en mode partitionné
+(option C{partition_instances}) ou lorsque l'instance s'exécute sous la
+forme de plusieurs processus (option C{workers}). Dans le cas contraire,
+plusieurs instances peuvent consommer la même file et modifier le même
+événement corrélé : le cache n'est alors pas utilisé
+(cf. L{PriorityCache.exclusive}).
+"""
+
+import time
+import threading
+
+from vigilo.common.conf import settings
+
+from vigilo.correlator.metrics import Histogram
+from vigilo.correlator.db_thread import add_after_commit_hook
+
+__all__ = (
+    'PriorityCache',
+    'get_cache',
+    'reset',
+    'set_after_commit',
+    'forget_correvents_after_commit',
+)
+
+
+class PriorityCache(object):
+    """
+    Cache associant à chaque élément supervisé son événement
+    corrélé ouvert et la priorité de celui-ci.
+
+    Le cache peut être consulté et alimenté depuis n'importe quel thread.
+    """
+
+    def __init__(self, ttl=60, exclusive=True):
+        """
+        @param ttl: Durée de validité (en secondes) des entrées.
+        @type ttl: C{float}
+        @param exclusive: Indique si les événements d'un élément supervisé
+            sont toujours traités par le processus courant, auquel cas
+            seulement le cache peut être utilisé.
+        @type exclusive: C{bool}
+        """
+        self.ttl = ttl
+        self.exclusive = exclusive
+        self._lock = threading.Lock()
+        # idsupitem -> (idcorrevent, priorité, date d'expiration)
+        self._entries = {}
+        # idcorrevent -> idsupitem
+        self._supitems = {}
+        # idsupitem -> nombre de modifications (cf. fill)
+        self._versions = {}
+        self._hits = 0
+        self._misses = 0
+        self._durations = Histogram()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, idsupitem):
+        """
+        Recherche l'événement corrélé ouvert d'un élément supervisé.
+
+        @param idsupitem: Identifiant de l'élément supervisé.
+        @type idsupitem: C{int}
+        @return: Couple (identifiant de l'événement corrélé, priorité),
+            les deux valeurs valant C{None} s'il n'y a aucun événement
+            corrélé ouvert, ou C{None} si l'élément est absent du cache.
+        @rtype: C{tuple}
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(idsupitem)
+            if entry is None or entry[2] < time.time():
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry[:2]
+        finally:
+            self._lock.release()
+
+    def version(self, idsupitem):
+        """
+        Retourne la version de l'entrée d'un élément supervisé,
+        à relever avant de rechercher sa priorité dans la base
+        de données (cf. L{PriorityCache.fill}).
+
+        @param idsupitem: Identifiant de l'élément supervisé.
+        @type idsupitem: C{int}
+        @rtype: C{int}
+        """
+        self._lock.acquire()
+        try:
+            return self._versions.get(idsupitem, 0)
+        finally:
+            self._lock.release()
+
+    def fill(self, idsupitem, idcorrevent, priority, version):
+        """
+        Enregistre l'événement corrélé ouvert d'un élément supervisé
+        lu dans la base de données, à moins que l'entrée n'ait été
+        modifiée depuis la lecture.
+
+        @param idsupitem: Identifiant de l'élément supervisé.
+        @type idsupitem: C{int}
+        @param idcorrevent: Identifiant de l'événement corrélé ouvert.
+        @type idcorrevent: C{int}
+        @param priority: Priorité de l'événement corrélé.
+        @type priority: C{int}
+        @param version: Version de l'entrée relevée avant la lecture
+            (cf. L{PriorityCache.version}).
+        @type version: C{int}
+        @return: Indique si l'entrée a été enregistrée.
+        @rtype: C{bool}
+        """
+        self._lock.acquire()
+        try:
+            if self._versions.get(idsupitem, 0) != version:
+                return False
+            self._set(idsupitem, idcorrevent, priority)
+            return True
+        finally:
+            self._lock.release()
+
+    def set(self, idsupitem, idcorrevent, priority):
+        """
+        Enregistre l'événement corrélé ouvert d'un élément supervisé.
+
+        @param idsupitem: Identifiant de l'élément supervisé.
+        @type idsupitem: C{int}
+        @param idcorrevent: Identifiant de l'événement corrélé ouvert,
+            ou C{None} s'il n'y en a aucun.
+        @type idcorrevent: C{int}
+        @param priority: Priorité de l'événement corrélé.
+        @type priority: C{int}
+        """
+        self._lock.acquire()
+        try:
+            self._versions[idsupitem] = self._versions.get(idsupitem, 0) + 1
+            self._set(idsupitem, idcorrevent, priority)
+        finally:
+            self._lock.release()
+
+    def _set(self, idsupitem, idcorrevent, priority):
+        previous = self._entries.get(idsupitem)
+        if previous is not None and previous[0] is not None:
+            self._supitems.pop(previous[0], None)
+        self._entries[idsupitem] = (idcorrevent, priority,
+                                    time.time() + self.ttl)
+        if idcorrevent is not None:
+            self._supitems[idcorrevent] = idsupitem
+
+    def forget_correvents(self, idcorrevents):
+        """
+        Retire du cache les événements corrélés donnés
+        (par exemple, lorsqu'ils ont été supprimés).
+
+        @param idcorrevents: Identifiants des événements corrélés.
+        @type idcorrevents: C{iterable} of C{int}
+        """
+        self._lock.acquire()
+        try:
+            for idcorrevent in idcorrevents:
+                idsupitem = self._supitems.pop(idcorrevent, None)
+                if idsupitem is not None:
+                    self._entries.pop(idsupitem, None)
+                    self._versions[idsupitem] = \
+                        self._versions.get(idsupitem, 0) + 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Vide le cache."""
+        self._lock.acquire()
+        try:
+            self._entries = {}
+            self._supitems = {}
+        finally:
+            self._lock.release()
+
+    def add_lookup_time(self, duration):
+        """
+        Enregistre la durée d'une recherche de priorité
+        (que la priorité provienne du cache ou non).
+        """
+        self._lock.acquire()
+        try:
+            self._durations.observe(duration)
+        finally:
+            self._lock.release()
+
+    def getStats(self, prefix):
+        """
+        Récupère les métriques du cache depuis le dernier appel.
+
+        @param prefix: Préfixe des noms des métriques.
+        @type prefix: C{str}
+        @rtype: C{dict}
+        """
+        self._lock.acquire()
+        try:
+            hits, self._hits = self._hits, 0
+            misses, self._misses = self._misses, 0
+            lookup = self._durations.mean()
+            self._durations.reset()
+        finally:
+            self._lock.release()
+        stats = {}
+        if hits + misses:
+            stats[prefix + "-hit-ratio"] = round(
+                float(hits) / (hits + misses), 4)
+        else:
+            stats[prefix + "-hit-ratio"] = 0.0
+        stats[prefix + "-lookup"] = round(lookup, 5)
+        return stats
+
+
+_cache = None
+
+
+def _is_exclusive():
+    """
+    Indique si la configuration garantit que les événements d'un élément
+    supervisé sont toujours traités par le même processus
+    (cf. L{vigilo.correlator.partitioning.partitioner_factory}).
+
+    @rtype: C{bool}
+    """
+    options = settings['correlator']
+    try:
+        if [instance for instance in options.as_list('partition_instances')
+            if instance.strip()]:
+            return True
+    except KeyError:
+        pass
+    try:
+        return options.as_int('workers') > 1
+    except KeyError:
+        return False
+
+
+def get_cache():
+    """
+    Retourne le cache des priorités du processus,
+    en le créant si nécessaire.
+
+    @rtype: L{PriorityCache}
+    """
+    global _cache # pylint: disable-msg=W0603
+    cache = _cache
+    if cache is None:
+        try:
+            ttl = settings['correlator'].as_float('priority_cache_ttl')
+        except KeyError:
+            ttl = 60
+        cache = _cache = PriorityCache(ttl, _is_exclusive())
+    return cache
+
+
+def reset():
+    """Supprime le cache des priorités du processus."""
+    global _cache # pylint: disable-msg=W0603
+    _cache = None
+
+
+def _after_commit(status, func, *args):
+    if status:
+        func(*args)
+
+
+def set_after_commit(idsupitem, idcorrevent, priority):
+    """
+    Enregistre l'événement corrélé ouvert d'un élément supervisé
+    une fois la transaction courante validée (cf. L{PriorityCache.set}).
+    """
+    add_after_commit_hook(
+        _after_commit, args=(get_cache().set, idsupitem, idcorrevent,
+                             priority))
+
+
+def forget_correvents_after_commit(idcorrevents):
+    """
+    Retire du cache les événements corrélés donnés une fois
+    la transaction courante validée
+    (cf. L{PriorityCache.forget_correvents}).
+    """
+    add_after_commit_hook(
+        _after_commit, args=(get_cache().forget_correvents,
+                             list(idcorrevents)))
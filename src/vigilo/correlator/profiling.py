@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Profilage du démarrage du corrélateur (option C{--profile-startup}).
+
+Le profilage mesure la durée d'importation de chaque module (durée
+cumulée, incluant les modules importés par celui-ci, et durée propre)
+ainsi que la durée des différentes phases du démarrage. Le rapport est
+affiché sur la sortie d'erreur une fois le corrélateur prêt à consommer
+les messages du bus.
+
+Ce module ne dépend que de la bibliothèque standard afin de pouvoir être
+chargé avant tout autre module du corrélateur.
+"""
+
+import sys
+import time
+import thread
+import __builtin__
+
+__all__ = (
+    'ImportProfiler',
+    'start',
+    'phase',
+    'report',
+)
+
+
+class ImportProfiler(object):
+    """
+    Mesure la durée d'importation des modules et des phases du démarrage.
+
+    Seules les importations réalisées par le thread ayant installé
+    le profileur sont mesurées.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        # nom du module -> (durée cumulée, durée propre)
+        self.imports = {}
+        self.phases = []
+        self._children = []
+        self._original = None
+        self._thread = None
+
+    def install(self):
+        """Remplace la fonction d'importation de Python."""
+        if self._original is not None:
+            return
+        self._thread = thread.get_ident()
+        self._original = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        """Restaure la fonction d'importation de Python."""
+        if self._original is None:
+            return
+        __builtin__.__import__ = self._original
+        self._original = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=None,
+                level=-1):
+        # pylint: disable-msg=W0622
+        # W0622: Redefining built-in 'globals' and 'locals'
+        original = self._original
+        if thread.get_ident() != self._thread or \
+            (name in sys.modules and not fromlist):
+            return original(name, globals, locals, fromlist, level)
+
+        key = name
+        if name in sys.modules:
+            # Importation de sous-modules ("from package import module").
+            key = "%s.%s" % (name, ",".join(fromlist))
+        loaded = len(sys.modules)
+        self._children.append(0.0)
+        start = time.time()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            children = self._children.pop()
+            if self._children:
+                self._children[-1] += elapsed
+            # Seules les importations ayant réellement chargé
+            # de nouveaux modules sont comptabilisées.
+            if len(sys.modules) > loaded and key not in self.imports:
+                self.imports[key] = (elapsed, elapsed - children)
+
+    def phase(self, name):
+        """
+        Marque la fin d'une phase du démarrage.
+
+        @param name: Nom de la phase.
+        @type name: C{str}
+        """
+        self.phases.append((name, time.time()))
+
+    def format_report(self, limit=30):
+        """
+        Construit le rapport de profilage.
+
+        @param limit: Nombre maximum de modules présentés.
+        @type limit: C{int}
+        @rtype: C{str}
+        """
+        lines = ["Startup phases (seconds since profiling started):"]
+        previous = self.start_time
+        for name, timestamp in self.phases:
+            lines.append("  %8.3f  %+8.3f  %s" % (
+                timestamp - self.start_time, timestamp - previous, name))
+            previous = timestamp
+
+        lines.append("Slowest imports (cumulative / self, in seconds):")
+        ranked = sorted(self.imports.iteritems(),
+                        key=lambda item: item[1][0], reverse=True)
+        for name, (cumulative, own) in ranked[:limit]:
+            lines.append("  %8.3f  %8.3f  %s" % (cumulative, own, name))
+        lines.append("Total: %d imports, %.3fs spent importing modules" % (
+            len(self.imports),
+            sum(own for _cumulative, own in self.imports.itervalues()),
+        ))
+        return "\n".join(lines)
+
+
+_profiler = None
+
+
+def start():
+    """
+    Démarre le profilage du démarrage.
+
+    @return: Le profileur.
+    @rtype: L{ImportProfiler}
+    """
+    global _profiler # pylint: disable-msg=W0603
+    if _profiler is None:
+        _profiler = ImportProfiler()
+        _profiler.install()
+    return _profiler
+
+
+def phase(name):
+    """
+    Marque la fin d'une phase du démarrage
+    (sans effet si le profilage n'est pas actif).
+
+    @param name: Nom de la phase.
+    @type name: C{str}
+    """
+    if _profiler is not None:
+        _profiler.phase(name)
+
+
+def report(*_args):
+    """
+    Termine le profilage et affiche le rapport sur la sortie d'erreur
+    (sans effet si le profilage n'est pas actif).
+    """
+    global _profiler # pylint: disable-msg=W0603
+    profiler = _profiler
+    if profiler is None:
+        return
+    _profiler = None
+    profiler.phase("ready")
+    profiler.uninstall()
+    sys.stderr.write(profiler.format_report() + "\n")
+    sys.stderr.flush()
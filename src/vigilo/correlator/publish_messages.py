@@ -5,22 +5,117 @@
 
 """
 Module de publication de messages divers vers le bus Vigilo.
+
+Lors d'une tempête d'alertes, le traitement d'un même événement peut
+engendrer plusieurs messages qui se complètent ou s'annulent (publication
+d'un agrégat puis suppression de ce même agrégat quelques instants plus
+tard, mises à jour successives d'un même événement corrélé, etc.).
+
+Lorsqu'une fenêtre de regroupement est configurée, les messages sont
+conservés dans un tampon de taille bornée et fusionnés par agrégat :
+les opérations devenues inutiles sont abandonnées et les opérations
+restantes sont émises sous forme de messages portant sur plusieurs
+agrégats à la fois.
 """
 
+from twisted.internet import defer
+
 from vigilo.connector.handlers import BusPublisher
 
+from vigilo.correlator.metrics import timed
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
 
 class MessagePublisher(BusPublisher):
     """
     Classe permettant d'envoyer certains types de messages
     sur le bus d'échange de Vigilo.
+
+    Le tampon de regroupement est vidé à l'expiration de la fenêtre
+    de regroupement, dès qu'il contient C{max_pending} éléments,
+    ou explicitement via L{MessagePublisher.flush} (par exemple
+    à l'arrêt du corrélateur). Les messages produits par le traitement
+    de plusieurs événements successifs sont ainsi regroupés.
     """
 
-    def __init__(self, publications):
+    def __init__(self, publications, coalescing_window=0,
+                 max_pending=1000, clock=None):
         """
         Construit une nouvelle instance de publication des messages.
+
+        @param publications: Configuration des publications.
+        @type publications: C{dict}
+        @param coalescing_window: Durée (en secondes) pendant laquelle
+            les messages sont conservés afin d'être regroupés.
+            La valeur 0 désactive le regroupement (chaque message
+            est alors envoyé immédiatement).
+        @type coalescing_window: C{float}
+        @param max_pending: Nombre maximum d'éléments (agrégats, alertes
+            et événements corrélés) conservés dans le tampon.
+        @type max_pending: C{int}
+        @param clock: Horloge utilisée pour planifier l'envoi
+            (le reactor de Twisted par défaut).
+        @type clock: C{twisted.internet.interfaces.IReactorTime}
         """
         super(MessagePublisher, self).__init__(publications)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.coalescing_window = coalescing_window
+        self.max_pending = max(1, max_pending)
+        self._clock = clock
+        self._timer = None
+        self._reset()
+        self._coalesced = 0
+
+
+    def _reset(self):
+        # Alertes à publier, indexées par identifiant d'agrégat.
+        self._aggregates = {}
+        # Identifiants des agrégats à supprimer.
+        self._deleted = set()
+        # Messages "correvent", indexés par identifiant d'agrégat.
+        self._correvents = {}
+        # Ordre d'arrivée des agrégats et des événements corrélés.
+        self._order = []
+        self._size = 0
+        self._calls = 0
+
+
+    def _buffering(self):
+        return self.coalescing_window > 0
+
+
+    def _touch(self, idcorrevent):
+        if idcorrevent not in self._aggregates and \
+            idcorrevent not in self._correvents:
+            self._order.append(idcorrevent)
+
+
+    def _enqueued(self):
+        """
+        Planifie l'envoi du contenu du tampon, ou l'envoie
+        immédiatement si sa taille maximale est atteinte.
+        """
+        self._calls += 1
+        if self._size >= self.max_pending:
+            return self.flush()
+        if self._timer is None:
+            self._timer = self._clock.callLater(self.coalescing_window,
+                                                self._expired)
+        return defer.succeed(None)
+
+
+    def _expired(self):
+        self._timer = None
+        d = self.flush()
+        d.addErrback(lambda failure: LOGGER.warning(
+            _('Could not publish pending messages: %s'),
+            failure.getErrorMessage()))
 
 
     def publish_aggregate(self, aggregate_id_list, event_id_list):
@@ -35,12 +130,20 @@ class MessagePublisher(BusPublisher):
             à publier.
         @type  event_id_list: Liste de C{int}
         """
-        # Création du message à publier sur le bus
-        msg = { "type": "aggr",
-                "aggregates": aggregate_id_list,
-                "alerts": event_id_list,
-                }
-        return self.sendMessage(msg)
+        if not self._buffering():
+            return self._send_aggregates(aggregate_id_list, event_id_list)
+
+        for idcorrevent in aggregate_id_list:
+            if idcorrevent in self._deleted:
+                # Les identifiants ne sont jamais réutilisés : cette
+                # publication est postérieure à la suppression.
+                continue
+            self._touch(idcorrevent)
+            alerts = self._aggregates.setdefault(idcorrevent, set())
+            size = len(alerts)
+            alerts.update(event_id_list)
+            self._size += len(alerts) - size
+        return self._enqueued()
 
 
     def delete_published_aggregates(self, aggregate_id_list):
@@ -49,10 +152,139 @@ class MessagePublisher(BusPublisher):
         agrégats (alertes corrélées) dont l'identifiant est passé
         en paramètre.
 
+        Les publications en attente concernant ces agrégats
+        sont abandonnées.
+
         @type aggregate_id_list: Liste de C{int}
         """
+        if not self._buffering():
+            return self._send_deletions(aggregate_id_list)
+
+        for idcorrevent in aggregate_id_list:
+            alerts = self._aggregates.pop(idcorrevent, None)
+            if alerts is not None:
+                self._size -= len(alerts)
+            if self._correvents.pop(idcorrevent, None) is not None:
+                self._size -= 1
+            if idcorrevent not in self._deleted:
+                self._deleted.add(idcorrevent)
+                self._size += 1
+        return self._enqueued()
+
+
+    def publish_correvent(self, info_dictionary):
+        """
+        Publie sur le bus le message décrivant un événement corrélé.
+
+        Lorsque plusieurs messages concernant le même événement corrélé
+        sont en attente, seul le plus récent est conservé (tout en
+        indiquant qu'il s'agit d'une création si le premier d'entre
+        eux en était une).
+
+        @param info_dictionary: Informations sur l'événement corrélé.
+        @type  info_dictionary: C{dict}
+        """
+        idcorrevent = info_dictionary.get('idcorrevent')
+        if not self._buffering() or idcorrevent is None:
+            return self.sendMessage(info_dictionary)
+
+        if idcorrevent in self._deleted:
+            self._coalesced += 1
+            return defer.succeed(None)
+        self._touch(idcorrevent)
+        previous = self._correvents.get(idcorrevent)
+        msg = info_dictionary.copy()
+        if previous is None:
+            self._size += 1
+        elif not previous.get('update', True):
+            msg['update'] = False
+        self._correvents[idcorrevent] = msg
+        return self._enqueued()
+
+
+    def flush(self):
+        """
+        Envoie immédiatement le contenu du tampon de regroupement.
+
+        Les messages "correvent" sont envoyés en premier, suivis des
+        publications d'agrégats (les agrégats contenant les mêmes alertes
+        sont regroupés dans un même message), puis d'un unique message
+        de suppression des agrégats.
+
+        @return: Deferred appelé une fois tous les messages envoyés.
+        @rtype: L{defer.Deferred}
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        if not self._size:
+            return defer.succeed(None)
+
+        order = self._order
+        aggregates = self._aggregates
+        correvents = self._correvents
+        deleted = self._deleted
+        calls = self._calls
+        self._reset()
+
+        dl = []
+        batches = {}
+        batches_order = []
+        for idcorrevent in order:
+            msg = correvents.get(idcorrevent)
+            if msg is not None:
+                dl.append(self.sendMessage(msg))
+            alerts = aggregates.get(idcorrevent)
+            if alerts:
+                key = frozenset(alerts)
+                if key not in batches:
+                    batches[key] = []
+                    batches_order.append(key)
+                batches[key].append(idcorrevent)
+        for key in batches_order:
+            dl.append(self._send_aggregates(batches[key], sorted(key)))
+        if deleted:
+            dl.append(self._send_deletions(sorted(deleted)))
+        self._coalesced += max(0, calls - len(dl))
+        return defer.gatherResults(dl)
+
+
+    def sendMessage(self, msg):
+        """
+        Envoie un message sur le bus, en mesurant la durée de l'envoi
+        (étape C{publish}, cf. L{vigilo.correlator.metrics}).
+        """
+        return timed("publish", defer.maybeDeferred(
+            super(MessagePublisher, self).sendMessage, msg))
+
+
+    def _send_aggregates(self, aggregate_id_list, event_id_list):
+        # Création du message à publier sur le bus
+        msg = { "type": "aggr",
+                "aggregates": aggregate_id_list,
+                "alerts": event_id_list,
+                }
+        return self.sendMessage(msg)
+
+
+    def _send_deletions(self, aggregate_id_list):
         # Création du message à publier sur le bus
         msg = { "type": "delaggr",
                 "aggregates": aggregate_id_list,
                 }
         return self.sendMessage(msg)
+
+
+    def getStats(self):
+        """
+        Récupère les métriques d'envoi, complétées par le nombre
+        de messages économisés grâce au regroupement.
+        """
+        d = super(MessagePublisher, self).getStats()
+        def add_coalescing_stats(stats):
+            stats["pending"] = self._size
+            stats["coalesced"] = self._coalesced
+            return stats
+        d.addCallback(add_coalescing_stats)
+        return d
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Requêtes SQL exécutées pour chaque événement traité par le corrélateur.
+
+Ces requêtes sont construites une seule fois, au chargement du module,
+sous la forme de requêtes SQLAlchemy "Core" paramétrées (C{bindparam}).
+Leur exécution passe par un cache de compilation partagé : la génération
+du code SQL n'a donc lieu qu'à la première exécution de chaque requête,
+et non plus à chaque événement.
+
+Les identifiants des états OK/UP sont eux aussi passés en paramètres
+(cf. L{vigilo.correlator.statenames}).
+"""
+
+from sqlalchemy import not_, and_, union_all
+from sqlalchemy.sql import select, bindparam, literal
+
+from vigilo.models.session import DBSession
+from vigilo.models.tables import Event, CorrEvent
+from vigilo.models.tables import Dependency, DependencyGroup
+from vigilo.models.tables.secondary_tables import EVENTSAGGREGATE_TABLE
+
+from vigilo.correlator import statenames
+
+__all__ = (
+    'execute',
+    'fetch_all',
+    'fetch_first',
+    'fetch_scalar',
+    'fetch_entities',
+    'get_label',
+    'OPEN_CORREVENT',
+    'OPEN_AGGREGATE',
+    'OPEN_AGGREGATES',
+    'RAW_EVENT_CANDIDATES',
+    'DISAGGREGATION_CAUSES',
+    'DISAGGREGATION_EVENTS',
+)
+
+_event = Event.__table__
+_correvent = CorrEvent.__table__
+_aggregate = EVENTSAGGREGATE_TABLE
+_dependency = Dependency.__table__
+_depgroup = DependencyGroup.__table__
+
+# Cache des requêtes compilées, partagé par toutes les connexions.
+# Le nombre de requêtes étant fixe, sa taille est bornée.
+_compiled_cache = {}
+
+
+def _closed_ok(state_column, ack_column):
+    """
+    Condition vérifiée par un événement corrélé dans l'état OK/UP
+    et marqué comme "Acquitté et clos".
+    """
+    return and_(
+        state_column.in_([bindparam('state_ok'), bindparam('state_up')]),
+        ack_column == CorrEvent.ACK_CLOSED,
+    )
+
+
+# Événement corrélé encore ouvert dont la cause porte sur l'élément
+# supervisé donné (utilisée par CorrEventBuilder et PriorityMaxRule).
+# Les colonnes retournées sont celles dont CorrEventBuilder a besoin
+# pour mettre à jour l'événement corrélé sans le recharger.
+OPEN_CORREVENT = select(
+        [
+            _correvent.c.idcorrevent,
+            _correvent.c.idcause,
+            _correvent.c.priority,
+            _correvent.c.ack,
+            _correvent.c.occurrence,
+            _correvent.c.trouble_ticket,
+            _correvent.c.timestamp_active,
+        ],
+        from_obj=[_correvent.join(_event,
+                    _correvent.c.idcause == _event.c.idevent)],
+    ).where(_event.c.idsupitem == bindparam('idsupitem')
+    ).where(not_(_closed_ok(_event.c.current_state, _correvent.c.ack))
+    ).limit(1)
+
+# Agrégat ouvert (quel que soit son état d'acquittement) dont la cause
+# porte sur l'élément supervisé donné (cf. topology.get_open_aggregate).
+# On n'agrège jamais une alerte dans un agrégat OK/UP (voir #1027).
+OPEN_AGGREGATE = select(
+        [_correvent.c.idcorrevent],
+        from_obj=[_correvent.join(_event,
+                    _correvent.c.idcause == _event.c.idevent)],
+    ).where(_event.c.idsupitem == bindparam('idsupitem')
+    ).where(not_(_event.c.current_state.in_(
+        [bindparam('state_ok'), bindparam('state_up')])))
+
+# Ensemble des agrégats ouverts, accompagnés de l'élément supervisé
+# à leur origine (utilisée lors du démarrage, cf. le module warmup).
+OPEN_AGGREGATES = select(
+        [_event.c.idsupitem, _correvent.c.idcorrevent],
+        from_obj=[_correvent.join(_event,
+                    _correvent.c.idcause == _event.c.idevent)],
+    ).where(not_(_event.c.current_state.in_(
+        [bindparam('state_ok'), bindparam('state_up')])))
+
+
+def _raw_event_candidates():
+    """
+    Construit la requête de recherche de l'événement brut
+    à mettre à jour (cf. L{db_insertion.insert_event}).
+
+    Les colonnes retournées sont celles de la table des événements
+    (suivies du rang de chaque événement), afin que l'événement retenu
+    puisse être chargé sans requête supplémentaire (cf. L{fetch_entities}).
+    """
+    # On recherche en priorité un événement brut qui cause un événement
+    # corrélé encore actif et qui porte sur l'objet supervisé indiqué.
+    event1 = select(
+            [_event.c.idevent, literal(1).label('rank')],
+            from_obj=[_event.join(_correvent,
+                        _correvent.c.idcause == _event.c.idevent)],
+        ).where(_event.c.idsupitem == bindparam('idsupitem')
+        ).where(not_(_closed_ok(_event.c.current_state, _correvent.c.ack)))
+
+    # En second choix, on recherche un événement brut qui appartient
+    # à l'agrégat d'un événement corrélé encore actif.
+    cause_event = _event.alias('cause_event')
+    found_event = _event.alias('found_event')
+    event2 = select(
+            [found_event.c.idevent, literal(2).label('rank')],
+            from_obj=[found_event.join(_aggregate,
+                        _aggregate.c.idevent == found_event.c.idevent
+                    ).join(_correvent,
+                        _correvent.c.idcorrevent == _aggregate.c.idcorrevent
+                    ).join(cause_event,
+                        cause_event.c.idevent == _correvent.c.idcause)],
+        ).where(found_event.c.idsupitem == bindparam('idsupitem')
+        ).where(not_(_closed_ok(cause_event.c.current_state,
+                                _correvent.c.ack)))
+
+    # En troisième choix, on se rabat sur un événement brut qui n'appartient
+    # à aucun agrégat et qui n'est la cause d'aucun événement corrélé
+    # (situation anormale, mais qu'on ne veut pas aggraver, cf. #908).
+    event3 = select(
+            [_event.c.idevent, literal(3).label('rank')],
+        ).where(_event.c.idsupitem == bindparam('idsupitem')
+        ).where(~_event.c.idsupitem.in_(select([_aggregate.c.idevent]))
+        ).where(~_event.c.idsupitem.in_(select([_correvent.c.idcause])))
+
+    # Retourne 2 des événements trouvés, triés par préférence (rank).
+    # La limite permet de détecter les situations anormales (doublons).
+    candidates = union_all(event1, event2, event3).alias('candidates')
+    ranked = select(
+            [candidates.c.idevent, candidates.c.rank],
+        ).order_by(candidates.c.rank, candidates.c.idevent
+        ).distinct().limit(2).alias('ranked')
+    return select(
+            [_event, ranked.c.rank],
+            from_obj=[ranked.join(_event,
+                        _event.c.idevent == ranked.c.idevent)],
+        ).order_by(ranked.c.rank, ranked.c.idevent)
+
+RAW_EVENT_CANDIDATES = _raw_event_candidates()
+
+
+def _disaggregation_causes():
+    """
+    Construit la requête déterminant les causes des nouveaux événements
+    corrélés obtenus par désagrégation d'un événement corrélé.
+    """
+    cause = _event.alias('cause')
+    others = _event.alias('others')
+    return select(
+            [_aggregate.c.idevent, _depgroup.c.iddependent],
+            from_obj=[_aggregate.join(_correvent,
+                        _correvent.c.idcorrevent == _aggregate.c.idcorrevent
+                    ).join(others, others.c.idevent == _aggregate.c.idevent
+                    ).join(_depgroup,
+                        _depgroup.c.iddependent == others.c.idsupitem
+                    ).join(_dependency,
+                        _dependency.c.idgroup == _depgroup.c.idgroup
+                    ).join(cause, cause.c.idevent == _correvent.c.idcause)],
+        ).where(_aggregate.c.idevent != _correvent.c.idcause
+        ).where(_dependency.c.idsupitem == cause.c.idsupitem
+        ).where(_dependency.c.distance == 1
+        ).where(_depgroup.c.role == u'topology'
+        ).where(_correvent.c.idcorrevent == bindparam('idcorrevent'))
+
+DISAGGREGATION_CAUSES = _disaggregation_causes()
+
+# Événements bruts d'un agrégat, accompagnés de chacun des éléments
+# supervisés dont ils dépendent topologiquement (cf. la désagrégation
+# réalisée par CorrEventBuilder).
+DISAGGREGATION_EVENTS = select(
+        [_event.c.idevent, _event.c.idsupitem,
+         _dependency.c.idsupitem.label('idancestor')],
+        from_obj=[_event.join(_depgroup,
+                    _depgroup.c.iddependent == _event.c.idsupitem
+                ).join(_dependency,
+                    _dependency.c.idgroup == _depgroup.c.idgroup
+                ).join(_aggregate,
+                    _aggregate.c.idevent == _event.c.idevent)],
+    ).where(_depgroup.c.role == u'topology'
+    ).where(_aggregate.c.idcorrevent == bindparam('idcorrevent'))
+
+
+# Noms des requêtes, utilisés pour identifier les opérations
+# dans les métriques de la base de données (cf. get_label).
+_labels = dict((id(statement), name) for (name, statement) in (
+    ('OPEN_CORREVENT', OPEN_CORREVENT),
+    ('OPEN_AGGREGATE', OPEN_AGGREGATE),
+    ('OPEN_AGGREGATES', OPEN_AGGREGATES),
+    ('RAW_EVENT_CANDIDATES', RAW_EVENT_CANDIDATES),
+    ('DISAGGREGATION_CAUSES', DISAGGREGATION_CAUSES),
+    ('DISAGGREGATION_EVENTS', DISAGGREGATION_EVENTS),
+))
+
+
+def get_label(statement):
+    """
+    Retourne le nom de l'une des requêtes de ce module.
+
+    @param statement: Requête.
+    @type statement: C{sqlalchemy.sql.expression.Select}
+    @return: Nom de la requête ou C{None} si elle n'appartient
+        pas à ce module.
+    @rtype: C{str}
+    """
+    return _labels.get(id(statement))
+
+
+def state_params():
+    """
+    Retourne les paramètres décrivant les états OK/UP
+    attendus par les requêtes de ce module.
+
+    @rtype: C{dict}
+    """
+    return {
+        'state_ok': statenames.statename_to_value(u'OK'),
+        'state_up': statenames.statename_to_value(u'UP'),
+    }
+
+
+def execute(statement, **params):
+    """
+    Exécute l'une des requêtes de ce module dans la transaction
+    de la session courante, en utilisant le cache de compilation.
+
+    @note: Cette fonction doit être exécutée dans le thread
+        dédié à la base de données.
+    @param statement: Requête à exécuter.
+    @type statement: C{sqlalchemy.sql.expression.Select}
+    @note: Les paramètres nommés sont transmis à la requête.
+    @return: Le résultat de la requête.
+    @rtype: C{sqlalchemy.engine.ResultProxy}
+    """
+    # Comme pour les requêtes de l'ORM, les modifications
+    # en attente sont envoyées avant l'exécution.
+    DBSession.flush()
+    connection = DBSession.connection().execution_options(
+        compiled_cache=_compiled_cache)
+    return connection.execute(statement, **params)
+
+
+def fetch_all(statement, **params):
+    """
+    Exécute une requête et retourne toutes les lignes du résultat.
+    Voir L{execute} pour les paramètres.
+
+    @rtype: C{list}
+    """
+    return execute(statement, **params).fetchall()
+
+
+def fetch_first(statement, **params):
+    """
+    Exécute une requête et retourne la première ligne du résultat
+    (ou C{None}). Voir L{execute} pour les paramètres.
+    """
+    return execute(statement, **params).first()
+
+
+def fetch_scalar(statement, **params):
+    """
+    Exécute une requête et retourne la première colonne de la première
+    ligne du résultat (ou C{None}). Voir L{execute} pour les paramètres.
+    """
+    return execute(statement, **params).scalar()
+
+
+def fetch_entities(entity, statement, **params):
+    """
+    Exécute une requête portant sur les colonnes de la table d'une
+    classe du modèle et retourne les instances correspondant aux lignes
+    du résultat, rattachées à la session courante (les colonnes
+    supplémentaires sont ignorées). Voir L{execute} pour les paramètres.
+
+    @param entity: Classe du modèle.
+    @type entity: C{type}
+    @rtype: C{list}
+    """
+    return list(DBSession.query(entity).instances(
+        execute(statement, **params)))
@@ -7,8 +7,9 @@ Un module permettant de gérer les règles de corrélation
 ainsi que les dépendances entre ces règles.
 """
 
+import re
 import sys
-import pkg_resources
+import importlib
 
 from vigilo.correlator.datatypes import Named
 from vigilo.correlator.rule import Rule
@@ -24,6 +25,41 @@ _ = translate(__name__)
 __all__ = ( 'get_registry', )
 
 
+_RULE_NAME = re.compile(r'^[^\s=]+$')
+_RULE_CLASS = re.compile(r'^(?P<module>\w+(?:\.\w+)*)\s*:\s*'
+                         r'(?P<attrs>\w+(?:\.\w+)*)$')
+
+
+def resolve_rule(rule_name, rule_class):
+    """
+    Importe la classe d'une règle de corrélation.
+
+    Contrairement à C{pkg_resources.EntryPoint}, aucun analyseur générique
+    ni aucune vérification des dépendances du paquet n'est nécessaire :
+    seul le module contenant la règle est importé.
+
+    @param rule_name: Nom de la règle dans la configuration.
+    @type rule_name: C{str}
+    @param rule_class: Emplacement de la classe de la règle,
+        sous la forme C{paquet.module:Classe}.
+    @type rule_class: C{str}
+    @return: La classe de la règle.
+    @rtype: C{type}
+    @raise ValueError: Le nom ou l'emplacement de la règle est invalide.
+    @raise ImportError: La règle n'a pas pu être importée.
+    """
+    match = _RULE_CLASS.match(rule_class.strip())
+    if not _RULE_NAME.match(rule_name) or not match:
+        raise ValueError(rule_name)
+    obj = importlib.import_module(match.group('module'))
+    for attr in match.group('attrs').split('.'):
+        try:
+            obj = getattr(obj, attr)
+        except AttributeError:
+            raise ImportError("%r has no %r attribute" % (obj, attr))
+    return obj
+
+
 class RegistryDict(object):
     """
     A registry for named items.
@@ -182,14 +218,10 @@ class Registry(object):
 
         for rule_name, rule_class in settings.get('rules', {}).iteritems():
             try:
-                ep = pkg_resources.EntryPoint.parse('%s = %s'
-                                            % (rule_name, rule_class))
+                rule = resolve_rule(rule_name, rule_class)
             except ValueError:
                 LOGGER.error(_('Not a valid rule name "%s"'), rule_name)
                 continue
-
-            try:
-                rule = ep.load(False)
             except ImportError:
                 LOGGER.error(_('Unable to load rule "%(name)s" (%(class)s)'),
                              {"name": rule_name, "class": rule_class})
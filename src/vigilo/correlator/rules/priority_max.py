@@ -10,10 +10,16 @@ Ce module contient une règle de corrélation qui empêche
 de diminuer la priorité d'un événement.
 Ceci permet en pratique de toujours voir la priorité
 la plus importante reçue dans VigiBoard.
+
+La priorité courante est lue depuis le cache des priorités du processus
+(cf. L{vigilo.correlator.priorities}) et n'est recherchée dans la base
+de données qu'en cas d'absence du cache, ou lorsque celui-ci ne peut pas
+être utilisé (plusieurs instances se partageant les événements
+d'un même élément supervisé).
 """
 from __future__ import absolute_import
 
-from sqlalchemy import not_ , and_
+import time
 
 from vigilo.correlator.rule import Rule
 
@@ -21,8 +27,7 @@ from vigilo.common.logging import get_logger
 from vigilo.common.gettext import translate
 from vigilo.common.conf import settings
 
-from vigilo.models.session import DBSession
-from vigilo.models.tables import SupItem, CorrEvent, Event, StateName
+from vigilo.correlator import queries, priorities
 
 LOGGER = get_logger(__name__)
 _ = translate(__name__)
@@ -32,6 +37,9 @@ class PriorityMaxRule(Rule):
 
     depends = ['PriorityRule']
 
+    # Fonction de choix de la priorité la plus importante.
+    _best_priority = None
+
     def process(self, link, msg_id):
         """
         Traitement du message par la règle.
@@ -46,27 +54,54 @@ class PriorityMaxRule(Rule):
         priority = ctx.get('priority')
         item_id = ctx.get('idsupitem')
 
-        state_ok = StateName.statename_to_value(u'OK')
-        state_up = StateName.statename_to_value(u'UP')
-        curr_priority = self._database.run(
-            DBSession.query(
-                CorrEvent.priority
-            ).join(
-                (Event, CorrEvent.idcause == Event.idevent),
-                (SupItem, SupItem.idsupitem == Event.idsupitem),
-            ).filter(SupItem.idsupitem == item_id
-            ).filter(
-                not_(and_(
-                    Event.current_state.in_([state_ok, state_up]),
-                    CorrEvent.ack == CorrEvent.ACK_CLOSED
-                ))
-            ).scalar)
+        start = time.time()
+        cache = priorities.get_cache()
+        # Le cache n'est utilisé que si les événements de cet élément
+        # ne peuvent pas être traités par un autre processus.
+        cached = cache.exclusive and cache.get(item_id) or None
+        if cached is not None:
+            curr_priority = cached[1]
+        else:
+            # La lecture a lieu sur la base de données principale :
+            # la valeur lue est conservée jusqu'à son expiration.
+            version = cache.version(item_id)
+            row = self._database.run(
+                queries.fetch_first,
+                queries.OPEN_CORREVENT,
+                idsupitem=item_id,
+                **queries.state_params())
+            if row is None:
+                # L'absence d'événement corrélé n'est pas conservée :
+                # celui-ci peut être en cours de création.
+                curr_priority = None
+            else:
+                if cache.exclusive:
+                    cache.fill(item_id, row.idcorrevent, row.priority,
+                               version)
+                curr_priority = row.priority
+        cache.add_lookup_time(time.time() - start)
 
         if curr_priority is None or priority is None:
             return
 
-        if settings['correlator']['priority_order'] == 'asc':
-            priority = min(priority, curr_priority)
-        else:
-            priority = max(priority, curr_priority)
-        ctx.set('priority', priority)
+        ctx.set('priority', self._get_best_priority()(priority, curr_priority))
+
+    def _get_best_priority(self):
+        """
+        Retourne la fonction permettant de choisir la plus importante
+        de deux priorités, selon l'ordre de tri configuré (l'option
+        n'est lue qu'une seule fois).
+        """
+        if self._best_priority is None:
+            if settings['correlator']['priority_order'] == 'asc':
+                self._best_priority = min
+            else:
+                self._best_priority = max
+        return self._best_priority
+
+    def getStats(self):
+        """
+        Récupère les métriques du cache des priorités (taux de succès
+        et durée moyenne de la recherche de la priorité courante).
+        """
+        return priorities.get_cache().getStats("rule-%s" % self.name)
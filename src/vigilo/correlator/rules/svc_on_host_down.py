@@ -15,6 +15,15 @@ suivante ::
 
     svc_on_host_down = vigilo.correlator.rules.svc_on_host_down:SvcHostDown
 
+Lorsque l'option C{nagios_bulk_commands} de la section [correlator]
+est activée, les commandes destinées à Nagios sont regroupées dans
+un unique message ::
+
+    {"type": "nagios", "timestamp": ..., "commands": [
+        {"cmdname": "PROCESS_SERVICE_CHECK_RESULT", "value": "..."},
+        ...
+    ]}
+
 """
 
 import time
@@ -23,18 +32,21 @@ from twisted.internet import defer
 
 from vigilo.correlator.rule import Rule
 
-from vigilo.models.session import DBSession
-from vigilo.models.tables import StateName, Host, LowLevelService
-
+from vigilo.common.conf import settings
 from vigilo.common.logging import get_logger
 from vigilo.common.gettext import translate
 
 from vigilo.correlator.context import Context
-from vigilo.correlator.db_insertion import insert_state
+from vigilo.correlator import statenames, hostservices
+from vigilo.correlator.db_insertion import insert_states
 
 LOGGER = get_logger(__name__)
 _ = translate(__name__)
 
+# Valeur par défaut de la directive "max_check_attempts" de Nagios
+# pour les services qui ne la redéfinissent pas.
+DEFAULT_MAX_CHECK_ATTEMPTS = 3
+
 
 
 @defer.inlineCallbacks
@@ -48,28 +60,32 @@ def on_host_down(result, forwarder, database, idnt, ctx=None):
     message = _("Host is down")
     services = yield get_all_services(hostname, database)
     LOGGER.info(_("Setting %d services to UNKNOWN"), len(services))
-    for svc in services:
-        yield database.run(
-            insert_state, {
-                "host": hostname,
-                "service": svc.servicename,
-                "message": message,
-                "timestamp": timestamp,
-                "state": "UNKNOWN",
-                "idsupitem": svc.idsupitem,
-            }
-        )
+    # Tous les états sont enregistrés en une seule opération.
+    yield database.run(
+        insert_states, [{
+            "host": hostname,
+            "service": svc.servicename,
+            "message": message,
+            "timestamp": timestamp,
+            "state": "UNKNOWN",
+            "idsupitem": svc.idsupitem,
+        } for svc in services]
+    )
 
 
 def get_all_services(hostname, database):
-    query = DBSession.query(
-            LowLevelService.idsupitem,
-            LowLevelService.servicename,
-        ).join(
-            (Host, Host.idsupitem == LowLevelService.idhost)
-        ).filter(Host.name == unicode(hostname)
-        ).all
-    return database.run(query)
+    """
+    Retourne les services d'un hôte.
+
+    Les services sont lus depuis le cache du processus
+    (cf. L{vigilo.correlator.hostservices}) et ne sont recherchés
+    dans la base de données qu'en cas d'absence du cache.
+    """
+    services = hostservices.lookup(hostname)
+    if services is not None:
+        return services
+    # La configuration change rarement : le réplica suffit.
+    return database.run(hostservices.get_services, hostname, readonly=True)
 
 
 
@@ -105,7 +121,7 @@ class SvcHostDown(Rule): # pylint: disable-msg=W0232
         if previous_state is None:
             previous_statename = "UP" # inconnu = UP
         else:
-            previous_statename = StateName.value_to_statename(previous_state)
+            previous_statename = statenames.value_to_statename(previous_state)
         if statename == previous_statename:
             return # Pas de changement
 
@@ -127,27 +143,58 @@ class SvcHostDown(Rule): # pylint: disable-msg=W0232
                       len(services))
 
         # On envoie un message à Nagios lui indiquant que les services
-        # de l'hôte sont vus comme "UNKNOWN" par Vigilo...
-        msg_tpl = {"type": "nagios",
-                   "timestamp": utcnow,
-                   "cmdname": "PROCESS_SERVICE_CHECK_RESULT",
-                   }
-        # @FIXME:   le nombre d'itérations devrait correspondre
-        #           au max_check_attempts du service.
-        iterations = range(3)
+        # de l'hôte sont vus comme "UNKNOWN" par Vigilo, autant de fois
+        # que nécessaire pour que l'état devienne définitif (HARD)...
+        commands = []
         for svc in services:
-            for _dummy in iterations:
-                msg = msg_tpl.copy()
-                msg["value"] = ("%(host)s;%(svc)s;3;Host is down"
-                               % {"host": hostname, "svc": svc.servicename})
-                link.sendItem(msg)
-
-        # On demande à Nagios de revérifier l'état de tous les services
-        # de la machine et de nous notifier les états.
-        link.sendItem({
-            "type": 'nagios',
-            "timestamp": utcnow,
-            "cmdname": "SCHEDULE_HOST_SVC_CHECKS",
-            "value": "%s;%s" % (hostname, utcnow + 1),
-        })
+            value = ("%(host)s;%(svc)s;3;Host is down"
+                     % {"host": hostname, "svc": svc.servicename})
+            for _dummy in xrange(self._max_check_attempts(svc)):
+                commands.append(("PROCESS_SERVICE_CHECK_RESULT", value))
+
+        # ... puis on lui demande de revérifier l'état de tous
+        # les services de la machine et de nous notifier les états.
+        commands.append(("SCHEDULE_HOST_SVC_CHECKS",
+                         "%s;%s" % (hostname, utcnow + 1)))
+
+        # Tous les messages sont transmis en un seul appel au dispatcher.
+        link.sendItems(self._nagios_messages(utcnow, commands))
+
+    def _max_check_attempts(self, svc):
+        try:
+            return max(1, int(svc.max_check_attempts))
+        except (TypeError, ValueError):
+            return DEFAULT_MAX_CHECK_ATTEMPTS
+
+    def _nagios_messages(self, timestamp, commands):
+        """
+        Construit les messages à destination de Nagios.
+
+        @param timestamp: Horodatage des commandes.
+        @type timestamp: C{int}
+        @param commands: Commandes Nagios, sous la forme de couples
+            (nom de la commande, arguments).
+        @type commands: C{list} of C{tuple}
+        @return: Messages à envoyer sur le bus : un message par commande
+            ou un unique message regroupant toutes les commandes si
+            l'option C{nagios_bulk_commands} est activée.
+        @rtype: C{list} of C{dict}
+        """
+        try:
+            bulk = settings['correlator'].as_bool('nagios_bulk_commands')
+        except KeyError:
+            bulk = False
+        if bulk:
+            return [{
+                "type": "nagios",
+                "timestamp": timestamp,
+                "commands": [{"cmdname": cmdname, "value": value}
+                             for cmdname, value in commands],
+            }]
+        return [{
+            "type": "nagios",
+            "timestamp": timestamp,
+            "cmdname": cmdname,
+            "value": value,
+        } for cmdname, value in commands]
 
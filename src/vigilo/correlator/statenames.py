@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Cache des noms d'états (L{StateName}) partagé par tout le processus.
+
+La table des noms d'états est chargée en une seule requête au démarrage
+du corrélateur (puis à chaque réception du signal SIGHUP) et conservée
+en mémoire sous la forme d'une table de correspondance bidirectionnelle
+immuable. Les conversions nom <-> valeur réalisées au cours de la
+corrélation ne nécessitent ainsi plus aucun accès à la base de données.
+
+Le remplacement de la table de correspondance se fait de manière atomique
+(simple affectation), ce qui permet de l'utiliser sans verrou depuis
+n'importe quel thread (réacteur, thread de la base de données ou règles).
+
+La table n'est jamais chargée à la demande : les messages ne sont consommés
+qu'une fois celle-ci chargée (cf. L{vigilo.correlator.warmup}) et toute
+conversion réalisée auparavant lève une exception L{StateNamesNotLoaded}.
+"""
+
+from vigilo.models.session import DBSession
+from vigilo.models.tables import StateName
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'StateNamesNotLoaded',
+    'StateNameMap',
+    'load',
+    'reset',
+    'statename_to_value',
+    'value_to_statename',
+)
+
+
+class StateNamesNotLoaded(RuntimeError):
+    """
+    Exception levée lorsque les noms d'états sont utilisés
+    avant le chargement de leur table de correspondance.
+    """
+    pass
+
+
+class StateNameMap(object):
+    """
+    Table de correspondance bidirectionnelle et immuable
+    entre les noms d'états et leurs identifiants.
+    """
+
+    __slots__ = ('_by_name', '_by_value')
+
+    def __init__(self, pairs):
+        """
+        Construit la table de correspondance.
+
+        @param pairs: Couples (nom de l'état, identifiant de l'état).
+        @type pairs: C{iterable} of C{tuple}
+        """
+        by_name = {}
+        by_value = {}
+        for statename, value in pairs:
+            by_name[unicode(statename)] = value
+            by_value[value] = unicode(statename)
+        object.__setattr__(self, '_by_name', by_name)
+        object.__setattr__(self, '_by_value', by_value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("StateNameMap objects are read-only")
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def statename_to_value(self, statename):
+        """
+        Retourne l'identifiant associé à un nom d'état.
+
+        @param statename: Nom de l'état.
+        @type statename: C{unicode}
+        @return: Identifiant de l'état.
+        @rtype: C{int}
+        @raise KeyError: Le nom d'état est inconnu.
+        """
+        if not isinstance(statename, unicode):
+            statename = statename.decode('utf-8')
+        return self._by_name[statename]
+
+    def value_to_statename(self, value):
+        """
+        Retourne le nom d'état associé à un identifiant.
+
+        @param value: Identifiant de l'état.
+        @type value: C{int}
+        @return: Nom de l'état.
+        @rtype: C{unicode}
+        @raise KeyError: L'identifiant est inconnu.
+        """
+        return self._by_value[value]
+
+
+_current = None
+
+
+def load():
+    """
+    Charge (ou recharge) l'intégralité de la table des noms d'états.
+
+    @note: Cette fonction exécute une requête SQL et doit donc être
+        appelée depuis le thread dédié à la base de données
+        (cf. L{DatabaseWrapper.run}).
+    @return: La nouvelle table de correspondance.
+    @rtype: L{StateNameMap}
+    """
+    global _current # pylint: disable-msg=W0603
+    rows = DBSession.query(
+            StateName.statename,
+            StateName.idstatename,
+        ).all()
+    _current = StateNameMap(rows)
+    LOGGER.debug(_('Loaded %d state names'), len(_current))
+    return _current
+
+
+def reset():
+    """
+    Oublie la table de correspondance actuellement chargée.
+    Elle devra être rechargée (cf. L{load}) avant toute conversion.
+    """
+    global _current # pylint: disable-msg=W0603
+    _current = None
+
+
+def get_map():
+    """
+    Retourne la table de correspondance courante.
+
+    Cette fonction n'exécute aucune requête SQL et peut donc être
+    appelée depuis n'importe quel thread.
+
+    @rtype: L{StateNameMap}
+    @raise StateNamesNotLoaded: La table n'a pas encore été chargée.
+    """
+    current = _current
+    if current is None:
+        raise StateNamesNotLoaded(
+            "The state names must be loaded before being used")
+    return current
+
+
+def statename_to_value(statename):
+    """
+    Retourne l'identifiant associé à un nom d'état.
+
+    @param statename: Nom de l'état.
+    @type statename: C{unicode}
+    @return: Identifiant de l'état.
+    @rtype: C{int}
+    @raise KeyError: Le nom d'état est inconnu.
+    @raise StateNamesNotLoaded: La table n'a pas encore été chargée.
+    """
+    return get_map().statename_to_value(statename)
+
+
+def value_to_statename(value):
+    """
+    Retourne le nom d'état associé à un identifiant.
+
+    @param value: Identifiant de l'état.
+    @type value: C{int}
+    @return: Nom de l'état.
+    @rtype: C{unicode}
+    @raise KeyError: L'identifiant est inconnu.
+    @raise StateNamesNotLoaded: La table n'a pas encore été chargée.
+    """
+    return get_map().value_to_statename(value)
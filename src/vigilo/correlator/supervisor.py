@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Exécution du corrélateur sous la forme de plusieurs processus.
+
+Un unique processus Python ne peut exploiter qu'un seul cœur à la fois
+(décodage des messages, accès à la base de données via l'ORM, chaînes
+de Deferreds, etc.). Lorsque l'option C{workers} de la section
+[correlator] est supérieure à 1, le processus lancé par twistd devient
+un superviseur (L{Supervisor}) qui démarre autant de processus, chacun
+exécutant l'intégralité de la chaîne de traitement du corrélateur.
+
+Les événements sont répartis entre les processus selon l'hôte concerné
+(cf. L{vigilo.correlator.partitioning}). Le superviseur relance les
+processus qui s'arrêtent, leur transmet le signal SIGHUP et agrège
+leurs métriques, qui sont publiées par le processus n°1 de l'instance
+n°1 uniquement.
+
+Le superviseur et chaque processus communiquent via un tube
+(descripteur L{STATUS_FD} côté superviseur, entrée standard côté
+processus) au moyen de messages JSON séparés par des sauts de ligne.
+"""
+
+import os
+import sys
+import json
+
+from twisted.application import service
+from twisted.internet import defer, error, protocol
+from twisted.protocols.basic import LineReceiver
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'current_worker',
+    'aggregate_stats',
+    'WorkerProcess',
+    'Supervisor',
+    'WorkerChannel',
+    'supervisor_factory',
+    'run_worker',
+)
+
+
+# Variables d'environnement transmises aux processus.
+WORKER_ENV = 'VIGILO_CORRELATOR_WORKER'
+OPTIONS_ENV = 'VIGILO_CORRELATOR_OPTIONS'
+
+# Descripteur sur lequel chaque processus écrit ses réponses.
+STATUS_FD = 3
+
+WORKER_MAIN = "from vigilo.correlator.supervisor import run_worker; " \
+              "run_worker()"
+
+# Métriques dont on conserve la moyenne (durées moyennes, taux, etc.)
+# ou le maximum (quantiles, durées maximales) lors de l'agrégation.
+# Les autres métriques sont des compteurs, additionnés.
+AVERAGED_PREFIXES = ('rule-', )
+AVERAGED_SUFFIXES = ('-wait', '-exec', '-hit-ratio', '-lookup', '-usage',
+                     '-group-size', '-flush-size', '-flush-time')
+MAXIMUM_PREFIXES = ('db-slowest-', )
+MAXIMUM_SUFFIXES = ('-p95', '-p99', '-max', '-members')
+
+
+def current_worker():
+    """
+    Retourne le numéro du processus courant et le nombre total
+    de processus de l'instance.
+
+    @return: Couple (numéro, nombre de processus), ou C{None}
+        si le processus courant n'a pas été démarré par un superviseur.
+    @rtype: C{tuple}
+    """
+    value = os.environ.get(WORKER_ENV)
+    if not value:
+        return None
+    worker, workers = value.split('/', 1)
+    return int(worker), int(workers)
+
+
+def aggregate_stats(stats_list):
+    """
+    Agrège les métriques de plusieurs processus.
+
+    @param stats_list: Métriques de chacun des processus.
+    @type stats_list: C{list} of C{dict}
+    @return: Métriques agrégées.
+    @rtype: C{dict}
+    """
+    values = {}
+    for stats in stats_list:
+        for key, value in stats.iteritems():
+            values.setdefault(key, []).append(value)
+
+    result = {}
+    for key, key_values in values.iteritems():
+        if key.startswith(MAXIMUM_PREFIXES) or \
+            key.endswith(MAXIMUM_SUFFIXES):
+            result[key] = max(key_values)
+        elif key.startswith(AVERAGED_PREFIXES) or \
+            key.endswith(AVERAGED_SUFFIXES):
+            result[key] = round(float(sum(key_values)) / len(key_values), 5)
+        else:
+            result[key] = sum(key_values)
+    return result
+
+
+def _with_timeout(d, timeout, clock):
+    """
+    Retourne un Deferred qui échoue si C{d} n'a pas été appelé
+    au bout de C{timeout} secondes.
+    """
+    result = defer.Deferred()
+    def expired():
+        if not result.called:
+            result.errback(defer.TimeoutError())
+    call = clock.callLater(timeout, expired)
+    def fired(res):
+        if call.active():
+            call.cancel()
+        if not result.called:
+            result.callback(res)
+    d.addBoth(fired)
+    return result
+
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    Représente, au sein du superviseur, l'un des processus démarrés.
+    """
+
+    def __init__(self, supervisor, number):
+        """
+        @param supervisor: Superviseur ayant démarré le processus.
+        @type supervisor: L{Supervisor}
+        @param number: Numéro du processus (à partir de 1).
+        @type number: C{int}
+        """
+        self.supervisor = supervisor
+        self.number = number
+        self.ended = defer.Deferred()
+        self._buffer = ''
+        self._pending = []
+
+
+    def connectionMade(self):
+        LOGGER.info(_('Correlator worker #%(number)d started '
+                      '(PID %(pid)d)'), {
+                        'number': self.number,
+                        'pid': self.transport.pid,
+                    })
+
+
+    def send(self, obj):
+        """
+        Envoie un message au processus.
+
+        @param obj: Message à envoyer.
+        @type obj: C{dict}
+        """
+        self.transport.write(json.dumps(obj) + '\n')
+
+
+    def signal(self, signame):
+        """
+        Envoie un signal au processus (s'il est encore en cours
+        d'exécution).
+
+        @param signame: Nom du signal (par exemple C{"HUP"}).
+        @type signame: C{str}
+        """
+        try:
+            self.transport.signalProcess(signame)
+        except error.ProcessExitedAlready:
+            pass
+
+
+    def getStats(self):
+        """
+        Demande au processus ses métriques de fonctionnement.
+
+        @rtype: L{defer.Deferred}
+        """
+        d = defer.Deferred()
+        self._pending.append(d)
+        self.send({"command": "stats"})
+        return d
+
+
+    def childDataReceived(self, childFD, data):
+        if childFD != STATUS_FD:
+            return
+        self._buffer += data
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                LOGGER.warning(_('Invalid message from correlator '
+                                 'worker #%(number)d: %(line)r'), {
+                                    'number': self.number,
+                                    'line': line,
+                                })
+                continue
+            self.objectReceived(obj)
+
+
+    def objectReceived(self, obj):
+        if "stats" in obj:
+            if self._pending:
+                self._pending.pop(0).callback(obj["stats"])
+        elif obj.get("command") == "collect":
+            d = self.supervisor.collectStats()
+            d.addCallback(lambda stats: self.send({"collected": stats}))
+
+
+    def processEnded(self, reason):
+        pending = self._pending
+        self._pending = []
+        for d in pending:
+            d.errback(reason)
+        self.supervisor.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+
+class Supervisor(service.Service):
+    """
+    Service démarrant et surveillant les processus du corrélateur.
+    """
+
+    restart_delay = 1.0
+    stats_timeout = 10.0
+
+    def __init__(self, workers, options, reactor=None):
+        """
+        @param workers: Nombre de processus à démarrer.
+        @type workers: C{int}
+        @param options: Options de la ligne de commande, transmises
+            à chaque processus.
+        @type options: C{dict}
+        @param reactor: Reactor utilisé pour démarrer les processus
+            (le reactor de Twisted par défaut).
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.workers = workers
+        self.options = options
+        self.processes = {}
+        self._reactor = reactor
+        self._restarts = {}
+        self._restarted = 0
+
+
+    def startService(self):
+        service.Service.startService(self)
+        for number in xrange(1, self.workers + 1):
+            self.spawn(number)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for call in self._restarts.values():
+            if call.active():
+                call.cancel()
+        self._restarts = {}
+        processes = self.processes.values()
+        for process in processes:
+            process.signal('TERM')
+        return defer.DeferredList([process.ended for process in processes])
+
+
+    def spawn(self, number):
+        """
+        Démarre le processus portant le numéro donné.
+
+        @param number: Numéro du processus (à partir de 1).
+        @type number: C{int}
+        """
+        self._restarts.pop(number, None)
+        process = WorkerProcess(self, number)
+        env = os.environ.copy()
+        env[WORKER_ENV] = "%d/%d" % (number, self.workers)
+        env[OPTIONS_ENV] = json.dumps(self.options, default=str)
+        self._reactor.spawnProcess(
+            process, sys.executable, [sys.executable, '-c', WORKER_MAIN],
+            env=env, childFDs={0: 'w', 1: 1, 2: 2, STATUS_FD: 'r'})
+        self.processes[number] = process
+        return process
+
+
+    def workerEnded(self, process, reason):
+        """
+        Appelée lorsqu'un processus s'est arrêté.
+        Le processus est relancé si le superviseur est toujours actif.
+        """
+        if self.processes.get(process.number) is process:
+            del self.processes[process.number]
+        if not self.running:
+            return
+        LOGGER.warning(_('Correlator worker #%(number)d died (%(reason)s), '
+                         'restarting it'), {
+                            'number': process.number,
+                            'reason': reason.getErrorMessage(),
+                        })
+        self._restarted += 1
+        self._restarts[process.number] = self._reactor.callLater(
+            self.restart_delay, self.spawn, process.number)
+
+
+    def reload(self):
+        """Transmet le signal SIGHUP à l'ensemble des processus."""
+        for process in self.processes.values():
+            process.signal('HUP')
+
+
+    def collectStats(self):
+        """
+        Récupère et agrège les métriques de l'ensemble des processus.
+
+        @return: Deferred renvoyant les métriques agrégées.
+        @rtype: L{defer.Deferred}
+        """
+        processes = sorted(self.processes.values(),
+                           key=lambda process: process.number)
+        dl = defer.DeferredList([
+            _with_timeout(process.getStats(), self.stats_timeout,
+                          self._reactor)
+            for process in processes
+        ], consumeErrors=True)
+        def aggregate(results):
+            stats_list = []
+            for process, (success, result) in zip(processes, results):
+                if success:
+                    stats_list.append(result)
+                else:
+                    LOGGER.warning(_('Could not get the statistics of '
+                                     'correlator worker #%(number)d: '
+                                     '%(error)s'), {
+                                        'number': process.number,
+                                        'error': result.getErrorMessage(),
+                                    })
+            stats = aggregate_stats(stats_list)
+            stats["workers"] = len(stats_list)
+            stats["workers-restarted"] = self._restarted
+            self._restarted = 0
+            return stats
+        dl.addCallback(aggregate)
+        return dl
+
+
+
+class WorkerChannel(LineReceiver):
+    """
+    Canal de communication d'un processus avec son superviseur.
+
+    Le canal répond aux demandes de métriques du superviseur. Il sert
+    aussi de fournisseur de métriques pour la publication de l'état
+    du corrélateur : les métriques retournées sont alors celles de
+    l'ensemble des processus.
+    """
+
+    delimiter = '\n'
+    MAX_LENGTH = 1 << 20
+
+    def __init__(self, provider):
+        """
+        @param provider: Fournisseur des métriques du processus courant.
+        @type provider: L{RuleDispatcher}
+        """
+        self.provider = provider
+        self._collecting = []
+
+
+    def sendObject(self, obj):
+        self.sendLine(json.dumps(obj))
+
+
+    def lineReceived(self, line):
+        obj = json.loads(line)
+        if obj.get("command") == "stats":
+            d = defer.maybeDeferred(self.provider.getStats)
+            def eb(failure):
+                LOGGER.warning(_('Could not get the statistics: %s'),
+                               failure.getErrorMessage())
+                return {}
+            d.addErrback(eb)
+            d.addCallback(lambda stats: self.sendObject({"stats": stats}))
+        elif "collected" in obj:
+            if self._collecting:
+                self._collecting.pop(0).callback(obj["collected"])
+
+
+    def getStats(self):
+        """
+        Récupère les métriques agrégées de l'ensemble des processus
+        auprès du superviseur.
+
+        @rtype: L{defer.Deferred}
+        """
+        d = defer.Deferred()
+        self._collecting.append(d)
+        self.sendObject({"command": "collect"})
+        return d
+
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        # Le superviseur s'est arrêté : le processus s'arrête également.
+        from twisted.internet import reactor
+        collecting = self._collecting
+        self._collecting = []
+        for d in collecting:
+            d.errback(reason)
+        if reactor.running:
+            reactor.stop()
+
+
+
+def supervisor_factory(settings, options):
+    """
+    Crée le superviseur si le corrélateur doit s'exécuter sous la forme
+    de plusieurs processus et que le processus courant n'est pas déjà
+    l'un d'entre eux.
+
+    @param settings: Configuration du corrélateur.
+    @param options: Options de la ligne de commande.
+    @return: Superviseur ou C{None}.
+    @rtype: L{Supervisor}
+    """
+    if current_worker() is not None:
+        return None
+    try:
+        workers = settings['correlator'].as_int('workers')
+    except KeyError:
+        workers = 1
+    if workers <= 1:
+        return None
+    return Supervisor(workers, dict(options))
+
+
+def run_worker():
+    """
+    Point d'entrée des processus démarrés par le superviseur.
+    """
+    from twisted.internet import reactor
+    from vigilo.correlator import makeService
+
+    options = json.loads(os.environ[OPTIONS_ENV])
+    if options.get("profile-startup"):
+        from vigilo.correlator import profiling
+        profiling.start()
+    root_service = makeService(options)
+    reactor.callWhenRunning(root_service.startService)
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  root_service.stopService)
+    reactor.run()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Cache des identifiants des éléments supervisés (hôtes et services
+de bas niveau) partagé par tout le processus.
+
+Les identifiants de l'ensemble des hôtes et des services de bas niveau
+sont chargés en une seule requête au démarrage du corrélateur (puis à
+chaque réception du signal SIGHUP). Chaque événement reçu peut ainsi
+être associé à son élément supervisé sans accéder à la base de données.
+
+Les éléments absents du cache (par exemple, ajoutés depuis le dernier
+chargement) sont recherchés individuellement puis ajoutés au cache.
+"""
+
+from vigilo.models.session import DBSession
+from vigilo.models.tables import Host, LowLevelService, SupItem
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'load',
+    'reset',
+    'lookup',
+    'get_supitem',
+)
+
+
+_current = None
+
+
+def _key(hostname, servicename):
+    if hostname is not None and not isinstance(hostname, unicode):
+        hostname = hostname.decode('utf-8')
+    if servicename is not None and not isinstance(servicename, unicode):
+        servicename = servicename.decode('utf-8')
+    return (hostname, servicename)
+
+
+def load():
+    """
+    Charge (ou recharge) les identifiants de l'ensemble des hôtes
+    et des services de bas niveau.
+
+    @note: Cette fonction exécute une requête SQL et doit donc être
+        appelée depuis le thread dédié à la base de données
+        (cf. L{DatabaseWrapper.run}).
+    @return: La nouvelle table de correspondance, indexée par
+        le couple (nom de l'hôte, nom du service ou C{None}).
+    @rtype: C{dict}
+    """
+    global _current # pylint: disable-msg=W0603
+    supitems = {}
+    for hostname, idsupitem in DBSession.query(
+            Host.name, Host.idsupitem).all():
+        supitems[(hostname, None)] = idsupitem
+    for hostname, servicename, idsupitem in DBSession.query(
+            Host.name,
+            LowLevelService.servicename,
+            LowLevelService.idsupitem,
+        ).join(
+            (LowLevelService, LowLevelService.idhost == Host.idsupitem)
+        ).all():
+        supitems[(hostname, servicename)] = idsupitem
+    _current = supitems
+    LOGGER.debug(_('Loaded %d supervised items'), len(supitems))
+    return supitems
+
+
+def reset():
+    """
+    Oublie la table de correspondance actuellement chargée.
+    """
+    global _current # pylint: disable-msg=W0603
+    _current = None
+
+
+def lookup(hostname, servicename=None):
+    """
+    Recherche l'identifiant d'un élément supervisé dans le cache
+    uniquement (aucune requête SQL).
+
+    Cette fonction peut donc être appelée depuis n'importe quel thread.
+
+    @param hostname: Nom de l'hôte.
+    @type hostname: C{unicode}
+    @param servicename: Nom du service de bas niveau, le cas échéant.
+    @type servicename: C{unicode}
+    @return: Identifiant de l'élément supervisé
+        ou C{None} s'il est absent du cache.
+    @rtype: C{int}
+    """
+    current = _current
+    if current is None:
+        return None
+    return current.get(_key(hostname, servicename))
+
+
+def get_supitem(hostname, servicename=None):
+    """
+    Retourne l'identifiant d'un élément supervisé, en le recherchant
+    dans la base de données s'il est absent du cache.
+
+    @note: Cette fonction peut exécuter une requête SQL et doit donc
+        être appelée depuis le thread dédié à la base de données.
+    @param hostname: Nom de l'hôte.
+    @type hostname: C{unicode}
+    @param servicename: Nom du service de bas niveau, le cas échéant.
+    @type servicename: C{unicode}
+    @return: Identifiant de l'élément supervisé ou C{None}
+        s'il n'existe pas.
+    @rtype: C{int}
+    """
+    key = _key(hostname, servicename)
+    current = _current
+    if current is not None:
+        idsupitem = current.get(key)
+        if idsupitem is not None:
+            return idsupitem
+    idsupitem = SupItem.get_supitem(hostname, servicename)
+    # Les éléments inconnus ne sont pas conservés : ils peuvent
+    # être ajoutés par un déploiement de la configuration.
+    if idsupitem is not None and current is not None:
+        current[key] = idsupitem
+    return idsupitem
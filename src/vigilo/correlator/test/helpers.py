@@ -30,6 +30,9 @@ from vigilo.models.session import metadata, DBSession
 from vigilo.models.tables import StateName
 
 from vigilo.correlator.context import Context
+from vigilo.correlator import statenames
+from vigilo.correlator import hlsnames, hostservices, priorities
+from vigilo.correlator import supitems, metrics
 from vigilo.correlator.memcached_connection import MemcachedConnection
 from vigilo.correlator.db_thread import DummyDatabaseWrapper
 from vigilo.correlator.actors.rule_dispatcher import RuleDispatcher
@@ -124,6 +127,12 @@ def teardown_db():
     DBSession.rollback()
     DBSession.flush()
     metadata.drop_all()
+    statenames.reset()
+    hlsnames.reset()
+    hostservices.reset()
+    priorities.reset()
+    supitems.reset()
+    metrics.reset()
 
 
 # Mocks
@@ -144,6 +153,13 @@ class ConnectionStub(object):
         value = self.data.get(key)
         return self._must_defer and defer.succeed(value) or value
 
+    def get_multi(self, keys, transaction=True):
+        # pylint: disable-msg=W0613
+        # W0613: Unused argument 'transaction'
+        values = dict((key, self.data.get(key)) for key in keys)
+        print("GETTING: %r" % values)
+        return self._must_defer and defer.succeed(values) or values
+
     def set(self, key, value, transaction=True, **kwargs):
         # pylint: disable-msg=W0613
         # W0613: Unused argument 'transaction' and 'kwargs'
@@ -152,6 +168,29 @@ class ConnectionStub(object):
         if self._must_defer:
             return defer.succeed(None)
 
+    def set_multi(self, values, transaction=True, **kwargs):
+        # pylint: disable-msg=W0613
+        # W0613: Unused argument 'transaction' and 'kwargs'
+        for key, value in values.iteritems():
+            print("SETTING: %r = %r" % (key, value))
+            self.data[key] = value
+        if self._must_defer:
+            return defer.succeed(None)
+
+    def add_multi(self, values, transaction=True, **kwargs):
+        # pylint: disable-msg=W0613
+        # W0613: Unused argument 'transaction' and 'kwargs'
+        stored = 0
+        for key, value in values.iteritems():
+            if key in self.data:
+                continue
+            print("ADDING: %r = %r" % (key, value))
+            self.data[key] = value
+            stored += 1
+        if self._must_defer:
+            return defer.succeed(stored)
+        return stored
+
     def delete(self, key, transaction=True):
         # pylint: disable-msg=E0202,W0613
         # E0202: An attribute inherited from TestApiFunctions hide this method (Mock)
@@ -264,6 +303,28 @@ class MemcachedConnectionStub(MemcachedConnection):
         return cls.instance
 
 
+class LocalBroker(object):
+    """
+    Simule le bus pour la transmission des messages entre plusieurs
+    instances du corrélateur exécutées dans le même processus
+    (cf. L{vigilo.correlator.partitioning}).
+    """
+
+    def __init__(self):
+        self.instances = {}
+        self.forwarded = []
+
+    def register(self, instance, dispatcher):
+        self.instances[str(instance)] = dispatcher
+
+    def unregister(self, instance):
+        del self.instances[str(instance)]
+
+    def forward(self, owner, msg):
+        self.forwarded.append((owner, msg))
+        return self.instances[owner].processForwardedMessage(msg)
+
+
 
 @defer.inlineCallbacks
 def setup_context(factory, message_id, context_keys):
@@ -296,3 +357,4 @@ def populate_statename():
     DBSession.add(StateName(statename=u'DOWN', order=3))
     DBSession.add(StateName(statename=u'UNREACHABLE', order=1))
     DBSession.flush()
+    statenames.load()
@@ -172,28 +172,70 @@ class TestSvcHostDownRule(unittest.TestCase):
         rule_dispatcher = Mock()
         yield self.rule.process(rule_dispatcher, self.message_id)
         servicenames.insert(0, "testservice") # crée en setUp
-        print("Count:", rule_dispatcher.sendItem.call_count)
+        # Tous les messages sont envoyés en un seul appel.
+        self.assertEqual(rule_dispatcher.sendItems.call_count, 1)
+        self.assertEqual(rule_dispatcher.sendItem.call_count, 0)
+        msgs = rule_dispatcher.sendItems.call_args[0][0]
+        print("Count:", len(msgs))
         # 3 messages envoyés (changement d'état) par service
         # + 1 message de resynchro de l'hôte
-        self.assertEqual(
-            rule_dispatcher.sendItem.call_count,
-            len(servicenames) * 3 + 1
-        )
+        self.assertEqual(len(msgs), len(servicenames) * 3 + 1)
 
         # On vérifie qu'il y a bien eu 3 messages
         # de resynchronisation par service.
         for i, servicename in enumerate(servicenames):
             for j in xrange(3):
-                call = rule_dispatcher.method_calls[i * 3 + j]
-                print(servicename, call)
-                self.assertEqual(call[0], "sendItem")
-                self.assertEqual(call[1][0]["cmdname"],
+                msg = msgs[i * 3 + j]
+                print(servicename, msg)
+                self.assertEqual(msg["cmdname"],
                     "PROCESS_SERVICE_CHECK_RESULT")
-                self.assertEqual(call[1][0]["value"].count(
+                self.assertEqual(msg["value"].count(
                     "%s;%s;" % (self.host.name, servicename)), 1)
         # + 1 message de resynchronisation
         # pour (l'ensemble des services de) l'hôte.
-        call = rule_dispatcher.method_calls[len(servicenames) * 3]
-        self.assertEqual(call[1][0]["value"].count(self.host.name + ';'), 1)
-        self.assertEqual(call[1][0]["cmdname"], "SCHEDULE_HOST_SVC_CHECKS")
+        msg = msgs[len(servicenames) * 3]
+        self.assertEqual(msg["value"].count(self.host.name + ';'), 1)
+        self.assertEqual(msg["cmdname"], "SCHEDULE_HOST_SVC_CHECKS")
+
+
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_host_up_max_check_attempts(self):
+        """Le nombre de messages dépend du max_check_attempts du service"""
+        yield self.setup_context("DOWN", "UP")
+        DBSession.add(tables.ConfItem(supitem=self.lls,
+                                      name=u'max_check_attempts',
+                                      value=u'5'))
+        DBSession.flush()
+        yield self.rule.process(self.rule_dispatcher, self.message_id)
+
+        # 5 changements d'état + 1 message de resynchronisation.
+        self.assertEqual(len(self.rule_dispatcher.buffer), 6)
+        for msg in self.rule_dispatcher.buffer[:-1]:
+            self.assertEqual(msg["cmdname"], "PROCESS_SERVICE_CHECK_RESULT")
+
 
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_host_up_bulk(self):
+        """Regroupement des commandes Nagios dans un seul message"""
+        yield self.setup_context("DOWN", "UP")
+        helpers.settings['correlator']['nagios_bulk_commands'] = 'True'
+        try:
+            yield self.rule.process(self.rule_dispatcher, self.message_id)
+        finally:
+            del helpers.settings['correlator']['nagios_bulk_commands']
+
+        self.assertEqual(len(self.rule_dispatcher.buffer), 1)
+        msg = self.rule_dispatcher.buffer[0]
+        value = "testhost;testservice;3;Host is down"
+        self.assertEqual({
+            "type": "nagios",
+            "timestamp": 42,
+            "commands": [
+                {"cmdname": "PROCESS_SERVICE_CHECK_RESULT", "value": value},
+                {"cmdname": "PROCESS_SERVICE_CHECK_RESULT", "value": value},
+                {"cmdname": "PROCESS_SERVICE_CHECK_RESULT", "value": value},
+                {"cmdname": "SCHEDULE_HOST_SVC_CHECKS", "value": "testhost;43"},
+            ],
+        }, msg)
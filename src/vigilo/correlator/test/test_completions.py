@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste la transmission groupée des résultats au réacteur."""
+
+import unittest
+
+from vigilo.correlator.completions import CompletionBuffer
+
+
+class FakeReactor(object):
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, func, *args):
+        self.calls.append((func, args))
+
+    def iterate(self):
+        calls, self.calls = self.calls, []
+        for func, args in calls:
+            func(*args)
+
+
+class TestCompletionBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.buffer = CompletionBuffer(self.reactor)
+        self.results = []
+
+    def test_batching(self):
+        """Un seul réveil du réacteur pour plusieurs résultats"""
+        for i in xrange(3):
+            self.buffer.call_from_thread(self.results.append, i)
+        self.assertEqual(1, len(self.reactor.calls))
+        self.assertEqual([], self.results)
+
+        self.reactor.iterate()
+        self.assertEqual([0, 1, 2], self.results)
+
+        # Un nouveau résultat programme une nouvelle vidange.
+        self.buffer.call_from_thread(self.results.append, 3)
+        self.assertEqual(1, len(self.reactor.calls))
+        self.reactor.iterate()
+        self.assertEqual([0, 1, 2, 3], self.results)
+        self.assertEqual({"reactor-wakeups": 2, "reactor-completions": 4},
+                         self.buffer.getStats())
+
+    def test_error(self):
+        """Une erreur n'empêche pas la transmission des autres résultats"""
+        def fail():
+            raise ValueError()
+        self.buffer.call_from_thread(fail)
+        self.buffer.call_from_thread(self.results.append, 1)
+        self.reactor.iterate()
+        self.assertEqual([1], self.results)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste le regroupement des ordres de calcul des services de haut niveau."""
+
+import json
+import unittest
+
+from mock import Mock, patch
+from twisted.internet import defer, task
+
+from vigilo.correlator.computation_orders import ComputationOrderCoalescer
+from vigilo.correlator.test import helpers
+
+
+class TestComputationOrderCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        super(TestComputationOrderCoalescer, self).setUp()
+        self.clock = task.Clock()
+        self.compute = Mock(return_value=defer.succeed(None))
+        self.coalescer = ComputationOrderCoalescer(
+            self.compute, window=1, max_latency=3, clock=self.clock)
+
+    def test_merge(self):
+        """Les ordres reçus pendant la fenêtre sont fusionnés"""
+        results = []
+        self.coalescer.add('1', [u'HLS 1', u'HLS 2']).addCallback(
+            results.append)
+        self.clock.advance(0.5)
+        self.coalescer.add('2', [u'HLS 2', u'HLS 3']).addCallback(
+            results.append)
+        self.clock.advance(0.5)
+        self.assertEqual(0, self.compute.call_count)
+        self.clock.advance(0.5)
+        self.compute.assert_called_once_with('2', [u'HLS 1', u'HLS 2',
+                                                   u'HLS 3'])
+        self.assertEqual(2, len(results))
+        self.assertEqual({
+            "computation-orders": 2,
+            "computation-orders-merged": 1,
+            "hls-computations-saved": 1,
+        }, self.coalescer.getStats())
+
+    def test_max_latency(self):
+        """Le calcul est déclenché au plus tard après le délai maximum"""
+        for i in xrange(6):
+            self.coalescer.add(str(i), [u'HLS 1'])
+            self.clock.advance(0.5)
+        self.assertEqual(1, self.compute.call_count)
+        self.assertEqual('5', self.compute.call_args[0][0])
+
+    def test_failure(self):
+        """Un échec du calcul est transmis à tous les ordres fusionnés"""
+        self.compute.return_value = defer.fail(ValueError())
+        errors = []
+        self.coalescer.add('1', [u'HLS 1']).addErrback(errors.append)
+        self.coalescer.add('2', [u'HLS 1']).addErrback(errors.append)
+        self.coalescer.flush()
+        self.assertEqual(2, len(errors))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+
+class TestComputationOrderMessages(unittest.TestCase):
+    """Ordres de calcul reçus depuis le bus"""
+
+    def setUp(self):
+        super(TestComputationOrderMessages, self).setUp()
+        self.clock = task.Clock()
+        self.rd = helpers.RuleDispatcherStub()
+        self.rd.keepProducing = False
+        self.rd.processingSucceeded = Mock(name="processingSucceeded")
+        self.rd.processingFailed = Mock(name="processingFailed")
+        self.compute = Mock(return_value=defer.succeed(None))
+        self.rd.computation_orders = ComputationOrderCoalescer(
+            self.compute, window=1, max_latency=3, clock=self.clock)
+        registry = Mock(name="registry")
+        registry.get_registry.return_value.rules.keys.return_value = \
+            ['HighLevelServiceDepsRule']
+        self.patcher = patch(
+            'vigilo.correlator.actors.rule_dispatcher.registry', registry)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        super(TestComputationOrderMessages, self).tearDown()
+
+    def _write(self, msgid, hls):
+        msg = Mock(name="message")
+        msg.fields = [None, msgid]
+        msg.content.body = json.dumps({
+            "type": "computation-order",
+            "hls": hls,
+        })
+        return self.rd.write(msg)
+
+    def test_acknowledged_after_computation(self):
+        """Les ordres sont acquittés une fois le calcul regroupé effectué"""
+        self.rd.keepProducing = True
+        self.rd.producer = Mock(name="producer")
+        results = []
+        self._write('1', [u'HLS 1', u'HLS 2']).addCallback(results.append)
+        self._write('2', [u'HLS 2', u'HLS 3']).addCallback(results.append)
+        # Les messages suivants sont consommés sans attendre le calcul.
+        self.assertEqual(2, self.rd.producer.resumeProducing.call_count)
+        self.assertEqual(0, len(results))
+        self.assertEqual(0, self.rd.processingSucceeded.call_count)
+        self.assertEqual(0, self.compute.call_count)
+        self.clock.advance(1)
+        self.compute.assert_called_once_with(
+            '2.42', [u'HLS 1', u'HLS 2', u'HLS 3'])
+        self.assertEqual(2, len(results))
+        self.assertEqual(2, self.rd.processingSucceeded.call_count)
+
+    def test_computation_failure(self):
+        """Les ordres sont retraités si le calcul regroupé échoue"""
+        self.compute.return_value = defer.fail(ValueError())
+        self._write('1', [u'HLS 1'])
+        self.clock.advance(1)
+        self.assertEqual(1, self.compute.call_count)
+        self.assertEqual(0, self.rd.processingSucceeded.call_count)
+        self.assertEqual(1, self.rd.processingFailed.call_count)
+
+    def test_serialized_with_events(self):
+        """Le calcul n'interfère pas avec le traitement d'un événement"""
+        pending = defer.Deferred()
+        self.rd._processMessage = lambda _msg: pending
+        self.rd._compute_hls = Mock(return_value=defer.succeed(None))
+        self.rd.processForwardedMessage({"type": "event"})
+        self.rd._serialized_compute_hls('1', [u'HLS 1'])
+        self.assertEqual(0, self.rd._compute_hls.call_count)
+        pending.callback(None)
+        self.rd._compute_hls.assert_called_once_with('1', [u'HLS 1'])
@@ -60,6 +60,17 @@ class TestApiFunctions(unittest.TestCase):
         foo = yield ctx.get("foo")
         self.assertEqual(foo, "bar")
 
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_get_multi(self):
+        """Lecture de plusieurs attributs en une seule fois"""
+        ctx = Context(42)
+        ctx._connection = ConnectionStub()
+        yield ctx.set("foo", "bar")
+        yield ctx.set("baz", 42)
+        values = yield ctx.getMulti(("foo", "baz", "qux"))
+        self.assertEqual({"foo": "bar", "baz": 42, "qux": None}, values)
+
     @deferred(timeout=60)
     @defer.inlineCallbacks
     def test_context_specific(self):
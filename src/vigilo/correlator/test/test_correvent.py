@@ -134,4 +134,45 @@ class TestCorrevents(unittest.TestCase):
         LOGGER.debug("Event's state: %r", state)
         self.assertEqual(u'UP', state)
         self.assertEqual(0,
-                len(self.corrbuilder.publisher.sendMessage.call_args_list))
+                len(self.corrbuilder.publisher.publish_correvent.call_args_list))
+
+    @deferred(timeout=60)
+    def test_update_open_correvent(self):
+        """
+        Mise à jour d'un CorrEvent sans passer par une instance de l'ORM.
+        """
+        ts = datetime.utcfromtimestamp(int(time.time()))
+        event = Event(
+            supitem=self.host,
+            timestamp=ts,
+            current_state=StateName.statename_to_value(u'DOWN'),
+            message=u'DOWN',
+        )
+        DBSession.add(event)
+        correvent = CorrEvent(
+            cause=event,
+            priority=42,
+            trouble_ticket=None,
+            ack=CorrEvent.ACK_NONE,
+            occurrence=1,
+            timestamp_active=ts,
+        )
+        DBSession.add(correvent)
+        DBSession.flush()
+
+        row = self.corrbuilder._get_updated_correvent(self.host.idhost, ts)
+        self.assertEqual(correvent.idcorrevent, row.idcorrevent)
+        self.assertEqual(event.idevent, row.idcause)
+        self.assertEqual({}, row.changes())
+
+        row.priority = 4
+        row.occurrence = 2
+        self.assertEqual({'priority': 4, 'occurrence': 2}, row.changes())
+        self.corrbuilder._save_correvent(row)
+
+        # L'instance déjà chargée dans la session est mise à jour.
+        db_correvent = DBSession.query(CorrEvent).one()
+        self.assertEqual(4, db_correvent.priority)
+        self.assertEqual(2, db_correvent.occurrence)
+        self.assertEqual(CorrEvent.ACK_NONE, db_correvent.ack)
+        return defer.succeed(None)
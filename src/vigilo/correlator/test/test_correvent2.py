@@ -176,7 +176,7 @@ class TestAggregates(unittest.TestCase):
                 ).first()
             correvents.append(correvent)
 
-            print(self.corrbuilder.publisher.sendMessage.call_args_list)
+            print(self.corrbuilder.publisher.publish_correvent.call_args_list)
 
         # Il doit y avoir 1 seul agrégat, dont la cause est Host2
         # et qui contient 4 événements correspondant aux 4 hôtes.
@@ -330,6 +330,49 @@ class TestCorrevents4(unittest.TestCase):
         )
 
 
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_desaggregate_cache(self):
+        """Mise à jour du cache des agrégats ouverts lors de la désagrégation"""
+        # Ajout des dépendances topologiques :
+        # - Host 2 dépend de Host 1
+        # - Host 3 dépend de Host 2 (et donc de Host 1)
+        dep_group = functions.add_dependency_group(
+                        self.hosts[2], None, u'topology', u'|')
+        functions.add_dependency(dep_group, self.hosts[1], 1)
+        dep_group = functions.add_dependency_group(
+                        self.hosts[3], None, u'topology', u'|')
+        functions.add_dependency(dep_group, self.hosts[2], 1)
+        functions.add_dependency(dep_group, self.hosts[1], 2)
+
+        res, idcorrevent1 = yield self.handle_alert(self.hosts[1], 'DOWN')
+        self.assertNotEquals(res, None)
+        res, _idcorrevent = yield self.handle_alert(
+            self.hosts[2], 'UNREACHABLE', preds=[idcorrevent1])
+        self.assertEqual(res, None)
+        res, _idcorrevent = yield self.handle_alert(
+            self.hosts[3], 'UNREACHABLE', preds=[idcorrevent1])
+        self.assertEqual(res, None)
+
+        # Host 1 remonte : un nouvel agrégat est créé pour Host 2,
+        # qui contient également l'événement brut sur Host 3.
+        res, _idcorrevent = yield self.handle_alert(self.hosts[1], 'UP')
+        self.assertNotEquals(res, None)
+        self.assertEqual(2, DBSession.query(tables.CorrEvent).count())
+        correvent = DBSession.query(tables.CorrEvent).filter(
+            tables.CorrEvent.idcorrevent != idcorrevent1).one()
+        self.assertEqual(self.hosts[2].idhost, correvent.cause.idsupitem)
+        self.assertEqual(
+            [u'Host 2', u'Host 3'],
+            sorted([ev.supitem.name for ev in correvent.events])
+        )
+
+        ctx = self.context_factory(self.ts)
+        for i in (2, 3):
+            open_aggr = yield ctx.getShared(
+                'open_aggr:%d' % self.hosts[i].idhost)
+            self.assertEqual(correvent.idcorrevent, open_aggr)
+
     @deferred(timeout=60)
     @defer.inlineCallbacks
     def test_pseudo_triangle(self):
@@ -125,3 +125,44 @@ class TestCorrevents6(unittest.TestCase):
         self.assertEqual(1, DBSession.query(tables.CorrEvent).count())
         self.assertEqual(3, DBSession.query(tables.Event).count())
 
+
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_multiple_predecessors(self):
+        """Agrégation topologique : plusieurs prédécesseurs."""
+        ctx = self.context_factory(42)
+        event1 = functions.add_event(self.hosts[1], 'DOWN', u'foo')
+        event2 = functions.add_event(self.hosts[2], 'DOWN', u'foo')
+        event3 = functions.add_event(self.hosts[3], 'UNREACHABLE', u'foo')
+        host4 = functions.add_host(u'Host 4')
+        event4 = functions.add_event(host4, 'UNREACHABLE', u'foo')
+        aggr1 = functions.add_correvent([event1])
+        aggr2 = functions.add_correvent([event2])
+        aggr4 = functions.add_correvent([event4])
+        ids = dict(aggr1=aggr1.idcorrevent, aggr2=aggr2.idcorrevent,
+                   aggr4=aggr4.idcorrevent, event1=event1.idevent,
+                   event3=event3.idevent, event4=event4.idevent)
+        ctx.set('predecessors_aggregates',
+                [aggr1.idcorrevent, aggr2.idcorrevent, 1000])
+        ctx.set('successors_aggregates', [aggr4.idcorrevent])
+        res = yield self.corrbuilder._aggregate_topologically(
+                    ctx, None, event3.idevent, self.hosts[3].idhost)
+        self.assertEqual(True, res)
+        # L'agrégat successeur a été fusionné dans le premier prédécesseur.
+        self.assertEqual(2, DBSession.query(tables.CorrEvent).count())
+        DBSession.expunge_all()
+        aggr1 = DBSession.query(tables.CorrEvent).get(ids['aggr1'])
+        self.assertEqual(
+            sorted([ids['event1'], ids['event3'], ids['event4']]),
+            sorted([event.idevent for event in aggr1.events]))
+
+        # Les messages publiés sur le bus sont regroupés.
+        publisher = self.corrbuilder.publisher
+        self.assertEqual(1, len(publisher.publish_aggregate.call_args_list))
+        self.assertEqual(
+            (([ids['aggr1'], ids['aggr2']],
+              [ids['event3'], ids['event4']]), {}),
+            publisher.publish_aggregate.call_args)
+        self.assertEqual(
+            (([ids['aggr4']], ), {}),
+            publisher.delete_published_aggregates.call_args)
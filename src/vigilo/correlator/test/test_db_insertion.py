@@ -9,7 +9,7 @@ import unittest
 import calendar
 
 from vigilo.correlator.db_insertion import insert_event, insert_state, \
-                                    OldStateReceived
+                                    insert_states, OldStateReceived
 from vigilo.correlator.test import helpers
 
 from vigilo.models.demo import functions
@@ -204,3 +204,35 @@ class TestDbInsertion(unittest.TestCase):
         supitem = DBSession.query(SupItem).get(idsupitem)
         self.assertEqual(supitem.state.timestamp, ts_recent_dt)
 
+    def test_insert_states(self):
+        """Insertion groupée d'états, en ignorant les états anciens"""
+        host = functions.add_host(u'server.example.com')
+        lls1 = functions.add_lowlevelservice(host, u'Load')
+        lls2 = functions.add_lowlevelservice(host, u'CPU')
+        ts_old = datetime.utcfromtimestamp(1239104006)
+        ts_recent = datetime.utcfromtimestamp(1239104042)
+        lls1.state.timestamp = ts_old
+        lls2.state.timestamp = ts_recent
+        DBSession.flush()
+
+        states = []
+        for lls in (lls1, lls2):
+            states.append({
+                "host": u"server.example.com",
+                "service": lls.servicename,
+                "state": u"UNKNOWN",
+                "message": u"Host is down",
+                "timestamp": datetime.utcfromtimestamp(1239104020),
+                "idsupitem": lls.idsupitem,
+            })
+        updated = insert_states(states)
+
+        # Seul l'état du premier service a été mis à jour,
+        # le second étant plus récent que celui reçu.
+        self.assertEqual([lls1.idsupitem], updated)
+        self.assertEqual(u'UNKNOWN',
+            StateName.value_to_statename(lls1.state.state))
+        self.assertEqual(u'Host is down', lls1.state.message)
+        self.assertEqual(ts_recent, lls2.state.timestamp)
+        self.assertNotEqual(u'UNKNOWN',
+            StateName.value_to_statename(lls2.state.state))
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste la répartition des opérations entre les threads de la BDD."""
+
+import unittest
+import threading
+
+import transaction
+from twisted.internet import defer
+
+from vigilo.correlator.db_thread import DatabaseWrapper, DatabaseWorker, \
+                                        DatabaseProfiler, _describe, \
+                                        _current_worker, _local, \
+                                        add_after_commit_hook, QUERY_SCOPE
+from vigilo.correlator import queries
+
+
+def make_wrapper(workers, replicas=0):
+    # On ne démarre aucun thread : seule la répartition est testée.
+    database = DatabaseWrapper.__new__(DatabaseWrapper)
+    database.workers = [DatabaseWorker(i) for i in xrange(workers)]
+    database.replicas = [DatabaseWorker(i, True) for i in xrange(replicas)]
+    database.queue = database.workers[0].queue
+    database.defer = None
+    database.group_commit = 0
+    database.profiler = DatabaseProfiler()
+    return database
+
+
+def func():
+    pass
+
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = []
+
+    def make(self, name):
+        def op():
+            self.calls.append(name)
+        return op
+
+
+def _scope_in_thread(worker=None):
+    scopes = []
+    def target():
+        if worker is not None:
+            _local.worker = worker.key
+        scopes.append(_current_worker())
+    t = threading.Thread(target=target)
+    t.start()
+    t.join()
+    return scopes[0]
+
+
+class SessionStub(object):
+    def __init__(self):
+        self.calls = []
+
+    def begin_nested(self):
+        self.calls.append('begin_nested')
+
+    def commit(self):
+        self.calls.append('commit')
+
+    def rollback(self):
+        self.calls.append('rollback')
+
+
+class TestDatabaseWrapper(unittest.TestCase):
+
+    def test_session_scopes(self):
+        """Seuls les threads de la base de données partagent leur session"""
+        self.assertEqual(0, _scope_in_thread(DatabaseWorker(0)))
+        self.assertEqual(('replica', 1),
+                         _scope_in_thread(DatabaseWorker(1, True)))
+        # Les autres threads ne reçoivent jamais la session d'un thread
+        # de la base de données, mais partagent une même session.
+        self.assertEqual(QUERY_SCOPE, _scope_in_thread())
+        self.assertEqual(QUERY_SCOPE, _scope_in_thread())
+
+    def test_default_worker(self):
+        """Les opérations sans affinité vont au premier thread"""
+        database = make_wrapper(4)
+        for _i in xrange(3):
+            database.run(func)
+        self.assertEqual([3, 0, 0, 0],
+                         [w.queue.qsize() for w in database.workers])
+
+    def test_affinity(self):
+        """Une même clé d'affinité désigne toujours le même thread"""
+        database = make_wrapper(4)
+        for _i in xrange(3):
+            database.run(func, affinity=42)
+            database.run(func, affinity=43, readonly=True)
+        self.assertEqual(3, database.workers[42 % 4].queue.qsize())
+        self.assertEqual(3, database.workers[43 % 4].queue.qsize())
+
+    def test_pinned(self):
+        """Les opérations d'un wrapper épinglé portent son affinité"""
+        database = make_wrapper(4)
+        pinned = database.pinned(42)
+        pinned.run(func, transaction=False, readonly=True)
+        op = database.workers[42 % 4].queue.get_nowait()
+        self.assertEqual(func, op[0])
+        self.assertEqual({}, op[2])
+        self.assertFalse(op[4])
+
+    def test_readonly(self):
+        """Les lectures sans affinité vont au thread le moins chargé"""
+        database = make_wrapper(3)
+        database.run(func)
+        database.run(func, affinity=1)
+        database.run(func, readonly=True)
+        self.assertEqual([1, 1, 1],
+                         [w.queue.qsize() for w in database.workers])
+
+    def test_stats(self):
+        """Profondeur des files d'attente et taux d'occupation"""
+        database = make_wrapper(2)
+        database.run(func, affinity=1)
+        stats = database.getStats()
+        self.assertEqual(0, stats["db-worker0-queue"])
+        self.assertEqual(1, stats["db-worker1-queue"])
+        self.assertEqual(1, stats["db-queue"])
+        self.assertEqual(0.0, stats["db-worker0-usage"])
+
+    def test_group_commit(self):
+        """Regroupement des opérations transactionnelles en attente"""
+        database = make_wrapper(1)
+        database.group_commit = 3
+        recorder = Recorder()
+        groups = []
+        database._run_group = lambda worker, group: \
+            groups.append([op[0].__name__ for op in group])
+
+        for name in ('a', 'b', 'c', 'd'):
+            op = recorder.make(name)
+            op.__name__ = name
+            database.run(op)
+        database.run(recorder.make('e'), transaction=False)
+        database.queue.put(None)
+        database._db_thread(database.workers[0])
+
+        # Les 3 premières opérations sont validées ensemble,
+        # la 4ème est seule en attente lorsque l'opération
+        # non transactionnelle arrive.
+        self.assertEqual([['a', 'b', 'c']], groups)
+        self.assertEqual(['d', 'e'], recorder.calls)
+
+    def test_labels(self):
+        """Étiquetage des opérations dans les métriques"""
+        self.assertEqual('func', _describe(func, ()))
+        self.assertEqual('Recorder.make',
+                         _describe(Recorder().make, ('a', )))
+        self.assertEqual('OPEN_CORREVENT', _describe(
+            queries.fetch_first, (queries.OPEN_CORREVENT, )))
+
+        database = make_wrapper(1)
+        database.run(func, label='custom')
+        self.assertEqual('custom', database.queue.get_nowait()[5])
+
+    def test_profiler(self):
+        """Profil des opérations sur la base de données"""
+        profiler = DatabaseProfiler(top=2)
+        profiler.record('a', 0.001, 0.002)
+        profiler.record('a', 0.001, 0.5)
+        profiler.record('b', 0.1, 0.02)
+        stats = profiler.getStats()
+        self.assertEqual(2, stats["db-op-a-count"])
+        self.assertEqual(0.251, stats["db-op-a-exec"])
+        self.assertEqual(0.5, stats["db-op-a-exec-max"])
+        self.assertEqual(0.1, stats["db-op-b-wait"])
+        self.assertEqual(0.5, stats["db-slowest-1"])
+        self.assertEqual(0.02, stats["db-slowest-2"])
+        self.assertFalse("db-slowest-3" in stats)
+        # Les mesures sont remises à zéro après chaque collecte.
+        self.assertEqual({}, profiler.getStats())
+
+    def test_replica(self):
+        """Les lectures sont confiées aux threads du réplica"""
+        database = make_wrapper(2, 2)
+        database.run(func, readonly=True)
+        database.run(func, readonly=True)
+        database.pinned(1).run(func, readonly=True)
+        database.pinned(1).run(func)
+        database.run(func)
+        self.assertEqual([1, 1], [w.queue.qsize() for w in database.workers])
+        self.assertEqual([2, 1], [w.queue.qsize() for w in database.replicas])
+        stats = database.getStats()
+        self.assertEqual(2, stats["db-replica0-queue"])
+        self.assertEqual(5, stats["db-queue"])
+
+    def test_savepoint_hooks(self):
+        """Les actions d'une opération annulée ne sont pas exécutées"""
+        database = make_wrapper(1)
+        session = SessionStub()
+        def hook(*_args):
+            pass
+        def succeeds():
+            add_after_commit_hook(hook, args=('ok', ))
+        def fails():
+            add_after_commit_hook(hook, args=('failed', ))
+            raise ValueError()
+
+        transaction.begin()
+        try:
+            for func in (succeeds, fails):
+                database._run_savepoint(
+                    session, (func, (), {}, defer.Deferred(), True,
+                              func.__name__, 0))
+            registered = [args for (_hook, args, _kws)
+                          in transaction.get().getAfterCommitHooks()]
+        finally:
+            transaction.abort()
+        self.assertEqual([('ok', )], registered)
+        self.assertEqual(['begin_nested', 'commit',
+                          'begin_nested', 'rollback'], session.calls)
+        # En dehors d'un groupe, les actions sont directement
+        # rattachées à la transaction courante.
+        transaction.begin()
+        try:
+            add_after_commit_hook(hook)
+            self.assertEqual(
+                1, len(list(transaction.get().getAfterCommitHooks())))
+        finally:
+            transaction.abort()
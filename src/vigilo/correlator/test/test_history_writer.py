@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste l'écriture différée de l'historique."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from sqlalchemy import create_engine, MetaData, Table, Column, \
+                        Integer, Unicode, select, func, exc
+
+from nose.twistedtools import reactor  # pylint: disable-msg=W0611
+from nose.twistedtools import deferred
+
+from vigilo.correlator.history_writer import HistoryWriter
+
+
+class TestHistoryWriter(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHistoryWriter, self).setUp()
+        # Une base de données sur disque est nécessaire
+        # car le tampon utilise sa propre connexion.
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' %
+            os.path.join(self.tmpdir, 'history.db'))
+        metadata = MetaData()
+        self.table = Table('history', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('text', Unicode(32)),
+        )
+        metadata.create_all(bind=self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+        super(TestHistoryWriter, self).tearDown()
+
+    def _count(self):
+        return self.engine.execute(
+            select([func.count()]).select_from(self.table)).scalar()
+
+    @deferred(timeout=30)
+    def test_flush_on_shutdown(self):
+        """Les lignes en attente sont écrites à l'arrêt"""
+        writer = HistoryWriter(self.engine, batch_size=100,
+                               flush_interval=60)
+        writer.start()
+        for i in xrange(10):
+            writer.add(self.table, {'text': u'%d' % i})
+
+        def check(_result):
+            self.assertEqual(10, self._count())
+            stats = writer.getStats()
+            self.assertEqual(1, stats['history-flushes'])
+            self.assertEqual(10, stats['history-flush-size'])
+            self.assertEqual(0, stats['history-pending'])
+        d = writer.shutdown()
+        d.addCallback(check)
+        return d
+
+    @deferred(timeout=30)
+    def test_flush_by_batch(self):
+        """Les lignes sont écrites par lots de taille bornée"""
+        writer = HistoryWriter(self.engine, batch_size=5,
+                               flush_interval=60, max_pending=5)
+        writer.start()
+        # Le nombre de lignes en attente étant borné,
+        # l'écriture est nécessairement découpée en lots.
+        for i in xrange(20):
+            writer.add(self.table, {'text': u'%d' % i})
+
+        def check(_result):
+            self.assertEqual(20, self._count())
+            stats = writer.getStats()
+            self.assertTrue(stats['history-flushes'] >= 4)
+        d = writer.shutdown()
+        d.addCallback(check)
+        return d
+
+    @deferred(timeout=30)
+    def test_after_commit(self):
+        """Seul l'historique des transactions validées est écrit"""
+        writer = HistoryWriter(self.engine, flush_interval=60)
+        writer.start()
+
+        transaction.begin()
+        writer.add_after_commit(self.table, {'text': u'aborted'})
+        transaction.abort()
+
+        transaction.begin()
+        writer.add_after_commit(self.table, {'text': u'committed'})
+        transaction.commit()
+
+        def check(_result):
+            rows = self.engine.execute(select([self.table.c.text])).fetchall()
+            self.assertEqual([u'committed'], [row.text for row in rows])
+        d = writer.shutdown()
+        d.addCallback(check)
+        return d
+
+    def _failing_writer(self, failures):
+        writer = HistoryWriter(self.engine, flush_interval=60)
+        write = writer._write
+        calls = []
+        def _write(connection, batch):
+            calls.append(len(batch))
+            if len(calls) <= failures:
+                raise exc.OperationalError("INSERT", {}, Exception("boom"))
+            return write(connection, batch)
+        writer._write = _write
+        writer.start()
+        for i in xrange(3):
+            writer.add(self.table, {'text': u'%d' % i})
+        return writer, calls
+
+    @deferred(timeout=30)
+    def test_retry_on_shutdown(self):
+        """L'écriture est retentée une fois lors de l'arrêt"""
+        writer, calls = self._failing_writer(1)
+
+        def check(_result):
+            self.assertEqual([3, 3], calls)
+            self.assertEqual(3, self._count())
+            self.assertEqual(1, writer.getStats()['history-errors'])
+        d = writer.shutdown()
+        d.addCallback(check)
+        return d
+
+    @deferred(timeout=30)
+    def test_drop_on_shutdown(self):
+        """Les lignes sont abandonnées si la nouvelle tentative échoue"""
+        writer, calls = self._failing_writer(2)
+
+        def check(_result):
+            self.assertEqual([3, 3], calls)
+            self.assertEqual(0, self._count())
+            stats = writer.getStats()
+            self.assertEqual(2, stats['history-errors'])
+            self.assertEqual(0, stats['history-pending'])
+        d = writer.shutdown()
+        d.addCallback(check)
+        return d
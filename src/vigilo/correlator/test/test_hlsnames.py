@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste le cache des noms des services de haut niveau."""
+
+import unittest
+
+from vigilo.correlator import hlsnames
+from vigilo.correlator.test import helpers
+
+from vigilo.models.demo import functions
+from vigilo.models.session import DBSession
+from vigilo.models.tables import HighLevelService
+
+
+class TestHighLevelServiceNames(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHighLevelServiceNames, self).setUp()
+        helpers.setup_db()
+        self.hls1 = functions.add_highlevelservice(u'HLS 1')
+        self.hls2 = functions.add_highlevelservice(u'HLS 2')
+
+    def tearDown(self):
+        helpers.teardown_db()
+        super(TestHighLevelServiceNames, self).tearDown()
+
+    def test_get_names(self):
+        """Noms des services de haut niveau à partir de leurs identifiants"""
+        names = hlsnames.get_names([self.hls1.idservice, self.hls2.idservice,
+                                    self.hls2.idservice + 1])
+        self.assertEqual({
+            self.hls1.idservice: u'HLS 1',
+            self.hls2.idservice: u'HLS 2',
+        }, names)
+
+    def test_no_query_once_loaded(self):
+        """Aucune requête n'est émise une fois le cache chargé"""
+        hlsnames.load()
+        DBSession.query(HighLevelService).delete()
+        DBSession.flush()
+        self.assertEqual({self.hls1.idservice: u'HLS 1'},
+                         hlsnames.get_names([self.hls1.idservice]))
+        self.assertEqual({u'HLS 2': self.hls2.idservice},
+                         hlsnames.get_ids([u'HLS 2']))
+
+    def test_missing_from_cache(self):
+        """Les services absents du cache sont recherchés puis ajoutés"""
+        hlsnames.load()
+        hls3 = functions.add_highlevelservice(u'HLS 3')
+        self.assertEqual(({}, [u'HLS 3']), hlsnames.lookup_ids([u'HLS 3']))
+        self.assertEqual({u'HLS 3': hls3.idservice},
+                         hlsnames.get_ids([u'HLS 3', u'HLS 4']))
+        self.assertEqual(({u'HLS 3': hls3.idservice}, [u'HLS 4']),
+                         hlsnames.lookup_ids([u'HLS 3', u'HLS 4']))
+
+    def test_lookup_without_cache(self):
+        """Sans cache chargé, la recherche locale ne trouve rien"""
+        self.assertEqual(({}, [u'HLS 1']), hlsnames.lookup_ids([u'HLS 1']))
+
+    def test_read_only(self):
+        """La table de correspondance est immuable"""
+        mapping = hlsnames.load()
+        self.assertRaises(AttributeError, setattr, mapping, '_by_id', {})
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste le cache des services de chaque hôte."""
+
+import unittest
+
+from vigilo.correlator import hostservices
+from vigilo.correlator.test import helpers
+
+from vigilo.models.demo import functions
+from vigilo.models.session import DBSession
+from vigilo.models.tables import LowLevelService
+
+
+class TestHostServices(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHostServices, self).setUp()
+        helpers.setup_db()
+        self.host1 = functions.add_host(u'host1')
+        self.host2 = functions.add_host(u'host2')
+        self.lls1 = functions.add_lowlevelservice(self.host1, u'svc1')
+        self.lls2 = functions.add_lowlevelservice(self.host1, u'svc2')
+        self.lls3 = functions.add_lowlevelservice(self.host2, u'svc3')
+
+    def tearDown(self):
+        helpers.teardown_db()
+        super(TestHostServices, self).tearDown()
+
+    def test_load(self):
+        """Chargement des services de tous les hôtes"""
+        hostservices.load()
+        services = hostservices.lookup(u'host1')
+        self.assertEqual(
+            [(self.lls1.idsupitem, u'svc1'), (self.lls2.idsupitem, u'svc2')],
+            sorted((svc.idsupitem, svc.servicename) for svc in services))
+        self.assertEqual(None, services[0].max_check_attempts)
+
+    def test_no_query_once_loaded(self):
+        """Aucune requête n'est émise une fois le cache chargé"""
+        hostservices.load()
+        DBSession.query(LowLevelService).update({'servicename': u'renamed'})
+        DBSession.flush()
+        self.assertEqual([u'svc3'], [svc.servicename for svc in
+                                     hostservices.get_services(u'host2')])
+
+    def test_missing_from_cache(self):
+        """Les hôtes absents du cache sont recherchés puis ajoutés"""
+        hostservices.load()
+        host3 = functions.add_host(u'host3')
+        lls4 = functions.add_lowlevelservice(host3, u'svc4')
+        self.assertEqual(None, hostservices.lookup(u'host3'))
+        self.assertEqual([lls4.idsupitem], [svc.idsupitem for svc in
+                                            hostservices.get_services(u'host3')])
+        self.assertEqual([u'svc4'], [svc.servicename for svc in
+                                     hostservices.lookup(u'host3')])
+
+    def test_size_limit(self):
+        """Les hôtes les moins récemment utilisés sont retirés du cache"""
+        index = hostservices.HostServicesIndex(2)
+        index.put(u'host1', [])
+        index.put(u'host2', [])
+        index.get(u'host1')
+        index.put(u'host3', [])
+        self.assertEqual(2, len(index))
+        self.assertEqual((), index.get(u'host1'))
+        self.assertEqual(None, index.get(u'host2'))
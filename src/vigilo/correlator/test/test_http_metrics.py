@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste l'exposition des métriques au format de Prometheus."""
+
+import unittest
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from vigilo.correlator.metrics import StageMetrics
+from vigilo.correlator.http_metrics import MetricsResource, \
+                                           metrics_service_factory
+
+
+class TestMetricsResource(unittest.TestCase):
+
+    def setUp(self):
+        self.stages = StageMetrics([0.1, 1.0])
+        self.resource = MetricsResource(self.stages)
+
+    def _render(self):
+        request = DummyRequest([''])
+        body = self.resource.render_GET(request)
+        return request, body.splitlines()
+
+    def test_histogram(self):
+        """Histogramme des durées de chaque étape"""
+        for value in (0.05, 0.5, 2.0):
+            self.stages.observe("decode", value)
+        request, lines = self._render()
+        content_type = request.responseHeaders.getRawHeaders(
+            "content-type")[0]
+        self.assertTrue(content_type.startswith("text/plain; version=0.0.4"))
+        for line in (
+            'vigilo_correlator_stage_duration_seconds_bucket'
+                '{stage="decode",le="0.1"} 1',
+            'vigilo_correlator_stage_duration_seconds_bucket'
+                '{stage="decode",le="1.0"} 2',
+            'vigilo_correlator_stage_duration_seconds_bucket'
+                '{stage="decode",le="+Inf"} 3',
+            'vigilo_correlator_stage_duration_seconds_sum'
+                '{stage="decode"} 2.55',
+            'vigilo_correlator_stage_duration_seconds_count'
+                '{stage="decode"} 3',
+            '# TYPE vigilo_correlator_stage_duration_seconds histogram',
+        ):
+            self.assertTrue(line in lines, line)
+
+    def test_quantiles(self):
+        """Quantiles de la durée de chaque étape"""
+        for _i in xrange(99):
+            self.stages.observe("rule-SvcHostDown", 0.05)
+        self.stages.observe("rule-SvcHostDown", 3.0)
+        _request, lines = self._render()
+        for line in (
+            'vigilo_correlator_stage_latency_seconds'
+                '{stage="rule-SvcHostDown",quantile="0.5"} 0.1',
+            'vigilo_correlator_stage_latency_seconds'
+                '{stage="rule-SvcHostDown",quantile="0.99"} 0.1',
+        ):
+            self.assertTrue(line in lines, line)
+
+    def test_empty(self):
+        """Aucune métrique tant qu'aucun message n'a été traité"""
+        _request, lines = self._render()
+        self.assertEqual([], [line for line in lines
+                              if not line.startswith('#')])
+
+
+class TestMetricsServiceFactory(unittest.TestCase):
+
+    def test_disabled(self):
+        """Le serveur est désactivé par défaut"""
+        self.assertEqual(None, metrics_service_factory({'correlator': {}}))
+
+    def test_worker_port(self):
+        """Chaque processus écoute sur son propre port"""
+        settings = {'correlator': {'metrics_port': '9100'}}
+        service = metrics_service_factory(settings, worker=3)
+        self.assertEqual(9102, service.args[0])
+        self.assertEqual('127.0.0.1', service.kwargs['interface'])
@@ -108,6 +108,20 @@ class TestMemcachedConnection(unittest.TestCase):
         # On vérifie que la méthode get retourne bien 'value'.
         self.assertEqual(result, value)
 
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_get_multi(self):
+        """Récupération des valeurs associées à plusieurs clés"""
+        connection = yield self._connect()
+        yield connection.set("vigilo_test_get_multi", pickle.dumps(42))
+
+        result = yield self.cache.get_multi(
+            ["vigilo_test_get_multi", "vigilo_test_get_multi_missing"])
+        self.assertEqual({
+            "vigilo_test_get_multi": 42,
+            "vigilo_test_get_multi_missing": None,
+        }, result)
+
     @deferred(timeout=60)
     @defer.inlineCallbacks
     def test_delete(self):
@@ -20,7 +20,7 @@ from vigilo.correlator.test import helpers
 
 from vigilo.models.session import DBSession
 from vigilo.models.demo import functions
-from vigilo.models.tables import CorrEvent
+from vigilo.models.tables import CorrEvent, Event
 
 def create_topology_and_events():
     """
@@ -90,6 +90,13 @@ class TestMergeAggregateFunction(unittest.TestCase):
         (events_id, aggregates_id) = create_topology_and_events()
 
         def _check(res, events_id):
+            # L'agrégat supprimé a été retiré de la session.
+            self.assertEqual([], [
+                obj for obj in DBSession.identity_map.values()
+                if isinstance(obj, CorrEvent) and
+                    obj.idcorrevent == aggregates_id[0]
+            ])
+
             aggregate1 = DBSession.query(CorrEvent
                         ).filter(CorrEvent.idcorrevent == aggregates_id[0]
                         ).first()
@@ -129,3 +136,47 @@ class TestMergeAggregateFunction(unittest.TestCase):
         )
         d.addCallback(_check, events_id)
         return d
+
+    @deferred(timeout=60)
+    def test_aggregates_merging_cache(self):
+        """Fusion de 2 agrégats : mise à jour du cache des agrégats ouverts"""
+        (events_id, aggregates_id) = create_topology_and_events()
+        ctx = self.context_factory(42)
+        events = DBSession.query(Event).filter(
+            Event.idevent.in_(events_id[:2])).all()
+        for event in events:
+            helpers.ConnectionStub.data[
+                'shared:open_aggr:%d' % event.idsupitem] = aggregates_id[0]
+
+        def _check(res):
+            self.assertEqual(sorted(res), sorted(events_id[:2]))
+            for event in events:
+                self.assertEqual(0, helpers.ConnectionStub.data[
+                    'shared:open_aggr:%d' % event.idsupitem])
+
+        d = merge_aggregates(
+            aggregates_id[0],
+            aggregates_id[1],
+            DummyDatabaseWrapper(True),
+            ctx,
+        )
+        d.addCallback(_check)
+        return d
+
+    @deferred(timeout=60)
+    def test_merging_nonexistent_aggregate(self):
+        """Fusion d'un agrégat inexistant"""
+        (_events_id, aggregates_id) = create_topology_and_events()
+
+        def _check(res):
+            self.assertEqual(None, res)
+            self.assertEqual(2, DBSession.query(CorrEvent).count())
+
+        d = merge_aggregates(
+            max(aggregates_id) + 1,
+            aggregates_id[1],
+            DummyDatabaseWrapper(True),
+            self.context_factory(42),
+        )
+        d.addCallback(_check)
+        return d
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste les outils de mesure."""
+
+import unittest
+
+from twisted.internet import defer
+
+from vigilo.correlator import metrics
+from vigilo.correlator.metrics import Histogram, StageMetrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        """Répartition des valeurs dans les intervalles"""
+        histogram = Histogram([0.1, 1.0])
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual([2, 1, 1], histogram.counts)
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(2.0, histogram.max)
+        self.assertAlmostEqual(0.6625, histogram.mean())
+        self.assertEqual(
+            [(0.1, 2), (1.0, 3), (float('inf'), 4)],
+            histogram.cumulative())
+
+    def test_quantile(self):
+        """Estimation des quantiles"""
+        histogram = Histogram([0.1, 1.0])
+        self.assertEqual(0.0, histogram.quantile(0.5))
+        for _i in xrange(9):
+            histogram.observe(0.05)
+        histogram.observe(0.7)
+        self.assertEqual(0.1, histogram.quantile(0.5))
+        self.assertEqual(0.7, histogram.quantile(0.95))
+        histogram.observe(3.0)
+        self.assertEqual(3.0, histogram.quantile(1.0))
+
+
+class TestStageMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_observe(self):
+        """Un histogramme par étape"""
+        stages = StageMetrics([0.1, 1.0])
+        self.assertEqual(None, stages.get("decode"))
+        stages.observe("decode", 0.05)
+        stages.observe("publish", 0.5)
+        stages.observe("decode", 0.2)
+        self.assertEqual(2, stages.get("decode").count)
+        self.assertEqual((0.1, 1.0), stages.get("decode").buckets)
+        self.assertEqual(["decode", "publish"],
+                         [stage for (stage, _hist) in stages.stages()])
+
+    def test_timed(self):
+        """Mesure de la durée d'une opération, même en cas d'échec"""
+        results = []
+        d = metrics.timed("insert_state", defer.succeed(42), start=0.0)
+        d.addCallback(results.append)
+        d = metrics.timed("insert_state", defer.fail(ValueError()))
+        d.addErrback(lambda failure: results.append(failure.type))
+        self.assertEqual([42, ValueError], results)
+        histogram = metrics.get_stage_metrics().get("insert_state")
+        self.assertEqual(2, histogram.count)
+        # La première opération a débuté le 1er janvier 1970.
+        self.assertTrue(histogram.max > 1000)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste la répartition des événements entre plusieurs instances."""
+
+import unittest
+
+from twisted.internet import defer, task
+
+from vigilo.correlator.partitioning import HashRing, Partitioner, Membership
+from vigilo.correlator.test import helpers
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_owner(self):
+        """Chaque clé appartient toujours au même membre"""
+        ring = HashRing(['1', '2', '3'])
+        owners = set(ring.owner(u'host%d' % i) for i in xrange(100))
+        self.assertEqual(set(['1', '2', '3']), owners)
+        self.assertEqual(ring.owner(u'host1'), HashRing(['3', '2', '1'])
+                         .owner(u'host1'))
+        self.assertEqual(None, HashRing().owner(u'host1'))
+
+    def test_rebalance(self):
+        """Seules les clés du membre retiré changent de propriétaire"""
+        ring = HashRing(['1', '2', '3'])
+        before = dict((i, ring.owner(u'host%d' % i)) for i in xrange(200))
+        self.assertTrue(ring.set_members(['1', '2']))
+        self.assertFalse(ring.set_members(['2', '1']))
+        for i, owner in before.iteritems():
+            if owner != '3':
+                self.assertEqual(owner, ring.owner(u'host%d' % i))
+            else:
+                self.assertNotEqual('3', ring.owner(u'host%d' % i))
+
+
+class TestPartitioner(unittest.TestCase):
+    """Plusieurs instances exécutées dans le même processus"""
+
+    def setUp(self):
+        super(TestPartitioner, self).setUp()
+        helpers.setup_db()
+        self.broker = helpers.LocalBroker()
+        self.ring = HashRing(['1', '2', '3'])
+        self.processed = {}
+        for instance in ('1', '2', '3'):
+            dispatcher = helpers.RuleDispatcherStub()
+            dispatcher.partitioner = Partitioner(instance, self.ring,
+                                                 self.broker)
+            processed = self.processed[instance] = []
+            dispatcher._processMessage = processed.append
+            self.broker.register(instance, dispatcher)
+
+    def tearDown(self):
+        helpers.teardown_db()
+        super(TestPartitioner, self).tearDown()
+
+    def test_routing(self):
+        """Les événements sont traités par l'instance propriétaire"""
+        msgs = [{"type": "event", "host": u"host%d" % i, "service": None}
+                for i in xrange(30)]
+        for i, msg in enumerate(msgs):
+            # Chaque message est reçu par une instance quelconque.
+            self.broker.instances[str(i % 3 + 1)].processMessage(msg)
+        for instance, processed in self.processed.iteritems():
+            for msg in processed:
+                self.assertEqual(instance, self.ring.owner(msg["host"]))
+        self.assertEqual(30, sum(len(processed) for processed
+                                 in self.processed.itervalues()))
+        # Le propriétaire ne retransmet jamais un message transmis.
+        self.assertTrue(len(self.broker.forwarded) < 30)
+
+    def test_not_partitioned(self):
+        """Les autres messages sont traités par l'instance qui les reçoit"""
+        msg = {"type": "computation-order", "hls": [u"HLS 1"]}
+        self.broker.instances['2'].processMessage(msg)
+        self.assertEqual([msg], self.processed['2'])
+        self.assertEqual([], self.broker.forwarded)
+
+
+class TestForwardedMessages(unittest.TestCase):
+
+    def setUp(self):
+        super(TestForwardedMessages, self).setUp()
+        self.dispatcher = helpers.RuleDispatcherStub()
+        self.pending = []
+        def process(msg):
+            d = defer.Deferred()
+            self.pending.append((msg, d))
+            return d
+        self.dispatcher._processMessage = process
+
+    def test_serialized(self):
+        """Les messages transmis et reçus ne sont pas traités en parallèle"""
+        forwarded = {"type": "event", "host": u"host1", "service": None}
+        received = {"type": "event", "host": u"host2", "service": None}
+        self.dispatcher.processForwardedMessage(forwarded)
+        self.dispatcher.processMessage(received)
+        self.assertEqual([forwarded], [msg for (msg, _d) in self.pending])
+        self.pending[0][1].callback(None)
+        self.assertEqual([forwarded, received],
+                         [msg for (msg, _d) in self.pending])
+
+
+class TestMembership(unittest.TestCase):
+
+    def tearDown(self):
+        helpers.ConnectionStub.data = {}
+        super(TestMembership, self).tearDown()
+
+    def test_join_leave(self):
+        """Les instances qui rejoignent ou quittent la répartition"""
+        clock = task.Clock()
+        ring1 = HashRing()
+        ring2 = HashRing()
+        member1 = Membership('1', ['1', '2'], ring1, helpers.ConnectionStub(),
+                             interval=5, clock=clock)
+        member2 = Membership('2', ['1', '2'], ring2, helpers.ConnectionStub(),
+                             interval=5, clock=clock)
+
+        member1.start()
+        self.assertEqual(frozenset(['1']), ring1.members)
+        member2.start()
+        self.assertEqual(frozenset(['1', '2']), ring2.members)
+        clock.advance(5)
+        self.assertEqual(frozenset(['1', '2']), ring1.members)
+
+        member2.stop()
+        clock.advance(5)
+        self.assertEqual(frozenset(['1']), ring1.members)
@@ -17,7 +17,7 @@ from __future__ import print_function
 import unittest
 from vigilo.correlator.test.helpers import settings
 
-from vigilo.correlator.registry import get_registry
+from vigilo.correlator.registry import get_registry, resolve_rule
 from vigilo.correlator.rule import Rule
 
 
@@ -143,3 +143,28 @@ class TestRuleLoading(unittest.TestCase):
         registry._load_from_settings()
         print(registry.rules.keys())
         self.assertEqual(len(registry.rules), 1)
+
+    def test_resolve_rule(self):
+        """Importation d'une règle à partir de son emplacement"""
+        self.assertEqual(TestRule1, resolve_rule(
+            "rule1", "%s:%s" % (self.__module__, TestRule1.__name__)))
+        self.assertEqual(TestRule1, resolve_rule(
+            "rule1", "%s : %s" % (self.__module__, TestRule1.__name__)))
+        self.assertRaises(ValueError, resolve_rule, "rule1", self.__module__)
+        self.assertRaises(ValueError, resolve_rule, "rule 1",
+                          "%s:%s" % (self.__module__, TestRule1.__name__))
+        self.assertRaises(ImportError, resolve_rule, "rule1",
+                          "%s:NoSuchRule" % self.__module__)
+        self.assertRaises(ImportError, resolve_rule, "rule1",
+                          "vigilo.correlator.no_such_module:Rule")
+
+    def test_rules_load_from_settings_invalid(self):
+        """Les règles invalides de la configuration sont ignorées"""
+        settings["rules"] = {
+            "rule1": "%s:%s" % (self.__module__, TestRule1.__name__),
+            "rule2": "vigilo.correlator.no_such_module:Rule",
+            "rule3": "not a valid location",
+        }
+        registry = get_registry()
+        registry._load_from_settings()
+        self.assertEqual(registry.rules.keys(), ["TestRule1"])
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste le cache des priorités des événements corrélés ouverts."""
+
+import unittest
+
+import transaction
+from configobj import ConfigObj
+from mock import patch
+
+from vigilo.correlator import priorities
+
+
+class TestPriorityCache(unittest.TestCase):
+
+    def tearDown(self):
+        priorities.reset()
+        super(TestPriorityCache, self).tearDown()
+
+    def test_set_get(self):
+        """Enregistrement et lecture des priorités"""
+        cache = priorities.PriorityCache()
+        self.assertEqual(None, cache.get(1))
+        cache.set(1, 42, 4)
+        cache.set(2, None, None)
+        self.assertEqual((42, 4), cache.get(1))
+        self.assertEqual((None, None), cache.get(2))
+        stats = cache.getStats("rule-test")
+        self.assertEqual(0.6667, stats["rule-test-hit-ratio"])
+
+    def test_expiration(self):
+        """Les entrées expirées sont ignorées"""
+        cache = priorities.PriorityCache(ttl=-1)
+        cache.set(1, 42, 4)
+        self.assertEqual(None, cache.get(1))
+
+    def test_forget_correvents(self):
+        """Retrait des événements corrélés supprimés"""
+        cache = priorities.PriorityCache()
+        cache.set(1, 42, 4)
+        cache.set(2, 43, 4)
+        # L'élément 2 change d'événement corrélé.
+        cache.set(2, 44, 2)
+        cache.forget_correvents([42, 43])
+        self.assertEqual(None, cache.get(1))
+        self.assertEqual((44, 2), cache.get(2))
+
+    def test_exclusive(self):
+        """Le cache n'est utilisé que si un seul processus traite un élément"""
+        for options, exclusive in (
+                ({}, False),
+                ({'workers': '1', 'partition_instances': ''}, False),
+                ({'workers': '4'}, True),
+                ({'partition_instances': '1, 2'}, True),
+            ):
+            priorities.reset()
+            config = ConfigObj({'correlator': options})
+            with patch('vigilo.correlator.priorities.settings', config):
+                self.assertEqual(exclusive,
+                                 priorities.get_cache().exclusive)
+
+    def test_after_commit(self):
+        """Le cache n'est mis à jour qu'une fois la transaction validée"""
+        transaction.begin()
+        priorities.set_after_commit(1, 42, 4)
+        transaction.abort()
+        self.assertEqual(None, priorities.get_cache().get(1))
+
+        transaction.begin()
+        priorities.set_after_commit(1, 42, 4)
+        self.assertEqual(None, priorities.get_cache().get(1))
+        transaction.commit()
+        self.assertEqual((42, 4), priorities.get_cache().get(1))
+
+    def test_fill(self):
+        """Une lecture concurrente ne remplace pas une valeur plus récente"""
+        cache = priorities.PriorityCache()
+        version = cache.version(1)
+        # Validation d'une transaction pendant la lecture.
+        cache.set(1, 43, 2)
+        self.assertFalse(cache.fill(1, 42, 4, version))
+        self.assertEqual((43, 2), cache.get(1))
+        self.assertTrue(cache.fill(1, 42, 4, cache.version(1)))
+        self.assertEqual((42, 4), cache.get(1))
+
+    def test_fill_after_forget(self):
+        """Les événements retirés pendant la lecture ne sont pas conservés"""
+        cache = priorities.PriorityCache()
+        cache.set(1, 42, 4)
+        version = cache.version(1)
+        cache.forget_correvents([42])
+        self.assertFalse(cache.fill(1, 42, 4, version))
+        self.assertEqual(None, cache.get(1))
+
+    def test_lookup_time(self):
+        """Durée moyenne de la recherche des priorités"""
+        cache = priorities.PriorityCache()
+        cache.add_lookup_time(0.002)
+        cache.add_lookup_time(0.004)
+        self.assertEqual(0.003, cache.getStats("rule-test")["rule-test-lookup"])
+        self.assertEqual(0.0, cache.getStats("rule-test")["rule-test-lookup"])
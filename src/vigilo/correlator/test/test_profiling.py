@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste le profilage du démarrage."""
+
+import sys
+import unittest
+import __builtin__
+
+from vigilo.correlator.profiling import ImportProfiler
+
+
+class TestImportProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.original = __builtin__.__import__
+        self.profiler = ImportProfiler()
+        sys.modules.pop('colorsys', None)
+
+    def tearDown(self):
+        self.profiler.uninstall()
+        self.assertTrue(__builtin__.__import__ is self.original)
+
+    def test_imports(self):
+        """Les importations de nouveaux modules sont mesurées"""
+        self.profiler.install()
+        import colorsys # pylint: disable-msg=W0612
+        import sys as _sys # pylint: disable-msg=W0404
+        self.profiler.uninstall()
+        self.assertTrue('colorsys' in self.profiler.imports)
+        self.assertFalse('sys' in self.profiler.imports)
+        cumulative, own = self.profiler.imports['colorsys']
+        self.assertTrue(cumulative >= own >= 0)
+
+    def test_report(self):
+        """Le rapport présente les phases et les importations"""
+        self.profiler.install()
+        import colorsys # pylint: disable-msg=W0612
+        self.profiler.phase("settings")
+        self.profiler.uninstall()
+        report = self.profiler.format_report()
+        self.assertTrue("settings" in report)
+        self.assertTrue("colorsys" in report)
@@ -14,6 +14,8 @@ from time import mktime
 
 from mock import Mock
 
+from twisted.internet import defer, task
+
 from vigilo.models.demo import functions
 from vigilo.correlator.publish_messages import MessagePublisher
 
@@ -67,3 +69,107 @@ class MessagePublisherTestCase(unittest.TestCase):
         print(self.mp.sendMessage.call_args)
         self.assertEqual(self.mp.sendMessage.call_args[0][0],
                 {'aggregates': [1, 2], 'type': 'delaggr'})
+
+
+class CoalescingPublisherTestCase(unittest.TestCase):
+    """Regroupement des messages avant leur envoi sur le bus"""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.mp = MessagePublisher({}, coalescing_window=1,
+                                   max_pending=10, clock=self.clock)
+        self.mp.sendMessage = Mock(return_value=defer.succeed(None))
+
+    def _sent(self):
+        return [args[0][0] for args in self.mp.sendMessage.call_args_list]
+
+    def test_window(self):
+        """Les messages sont envoyés à l'expiration de la fenêtre"""
+        self.mp.publish_aggregate([1], [10])
+        self.mp.publish_aggregate([2], [10])
+        self.assertEqual([], self._sent())
+        self.clock.advance(1)
+        self.assertEqual([
+            {'type': 'aggr', 'aggregates': [1, 2], 'alerts': [10]},
+        ], self._sent())
+
+    def test_superseded(self):
+        """La suppression d'un agrégat annule ses publications en attente"""
+        self.mp.publish_correvent({'idcorrevent': 1, 'update': False})
+        self.mp.publish_aggregate([1, 2], [10, 11])
+        self.mp.delete_published_aggregates([1])
+        self.mp.publish_aggregate([1], [12])
+        self.mp.flush()
+        self.assertEqual([
+            {'type': 'aggr', 'aggregates': [2], 'alerts': [10, 11]},
+            {'type': 'delaggr', 'aggregates': [1]},
+        ], self._sent())
+        # Le délai est annulé une fois le tampon vidé.
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_correvent_updates(self):
+        """Seule la dernière mise à jour d'un événement corrélé est envoyée"""
+        self.mp.publish_correvent({'idcorrevent': 1, 'update': False,
+                                   'state': u'WARNING'})
+        self.mp.publish_correvent({'idcorrevent': 1, 'update': True,
+                                   'state': u'CRITICAL'})
+        self.mp.flush()
+        self.assertEqual([
+            {'idcorrevent': 1, 'update': False, 'state': u'CRITICAL'},
+        ], self._sent())
+
+    def test_max_pending(self):
+        """Le tampon est vidé dès que sa taille maximale est atteinte"""
+        self.mp.publish_aggregate([1], range(5))
+        self.assertEqual([], self._sent())
+        self.mp.publish_aggregate([2], range(5, 10))
+        self.assertEqual(2, len(self._sent()))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class DispatcherCoalescingTestCase(unittest.TestCase):
+    """Regroupement des messages produits par plusieurs événements"""
+
+    def setUp(self):
+        helpers.setup_db()
+        self.clock = task.Clock()
+        self.mp = MessagePublisher({}, coalescing_window=1,
+                                   max_pending=10, clock=self.clock)
+        self.mp.sendMessage = Mock(return_value=defer.succeed(None))
+        self.rd = helpers.RuleDispatcherStub()
+        self.rd.bus_publisher = self.mp
+        self.rd.correvent_builder = Mock(name="correvent_builder")
+        def make_correvent(info_dictionary):
+            self.mp.publish_correvent({
+                'idcorrevent': info_dictionary['idcorrevent'],
+                'update': True,
+            })
+            self.mp.publish_aggregate([info_dictionary['idcorrevent']],
+                                      [info_dictionary['idevent']])
+        self.rd.correvent_builder.make_correvent.side_effect = make_correvent
+        # Seule la fin du traitement (construction de l'événement
+        # corrélé) est reproduite pour chaque message.
+        self.rd._processMessage = lambda msg: \
+            self.rd._send_result(None, msg)
+
+    def tearDown(self):
+        helpers.teardown_db()
+
+    def test_several_messages(self):
+        """Les messages de plusieurs événements sont regroupés"""
+        for idevent, idcorrevent in ((10, 1), (11, 1), (12, 2)):
+            self.rd.processMessage({
+                'host': u'host1.example.com',
+                'idsupitem': 1,
+                'idevent': idevent,
+                'idcorrevent': idcorrevent,
+            })
+        self.assertEqual(0, self.mp.sendMessage.call_count)
+        self.clock.advance(1)
+        sent = [args[0][0] for args in self.mp.sendMessage.call_args_list]
+        # Une seule mise à jour par événement corrélé
+        # et un seul message "aggr" par groupe d'alertes.
+        self.assertEqual(
+            [1, 2], [msg['idcorrevent'] for msg in sent
+                     if 'idcorrevent' in msg])
+        self.assertEqual(3, self.rd.correvent_builder.make_correvent.call_count)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste les requêtes précompilées du corrélateur."""
+
+import unittest
+
+from vigilo.correlator import queries
+from vigilo.correlator.test import helpers
+
+from vigilo.models.demo import functions
+from vigilo.models.session import DBSession
+from vigilo.models.tables import Event, CorrEvent, StateName
+
+
+class TestQueries(unittest.TestCase):
+
+    def setUp(self):
+        super(TestQueries, self).setUp()
+        helpers.setup_db()
+        helpers.populate_statename()
+        self.host = functions.add_host(u'server.example.com')
+        self.service = functions.add_lowlevelservice(self.host, u'Load')
+        self.event = functions.add_event(self.service, u'WARNING',
+                                         u'WARNING: Load is high')
+        self.correvent = functions.add_correvent([self.event])
+        self.correvent.priority = 3
+        DBSession.flush()
+
+    def tearDown(self):
+        helpers.teardown_db()
+        super(TestQueries, self).tearDown()
+
+    def test_open_correvent(self):
+        """Recherche de l'événement corrélé ouvert d'un élément supervisé"""
+        row = queries.fetch_first(queries.OPEN_CORREVENT,
+            idsupitem=self.service.idsupitem, **queries.state_params())
+        self.assertEqual(self.correvent.idcorrevent, row.idcorrevent)
+        self.assertEqual(3, row.priority)
+        self.assertEqual(self.event.idevent, row.idcause)
+        self.assertEqual(self.correvent.ack, row.ack)
+
+        # Un événement OK et "Acquitté et clos" n'est plus ouvert.
+        self.event.current_state = StateName.statename_to_value(u'OK')
+        self.correvent.ack = CorrEvent.ACK_CLOSED
+        row = queries.fetch_first(queries.OPEN_CORREVENT,
+            idsupitem=self.service.idsupitem, **queries.state_params())
+        self.assertEqual(None, row)
+
+    def test_raw_event_candidates(self):
+        """Recherche de l'événement brut à mettre à jour"""
+        rows = queries.fetch_all(queries.RAW_EVENT_CANDIDATES,
+            idsupitem=self.service.idsupitem, **queries.state_params())
+        self.assertEqual([(self.event.idevent, 1)],
+                         [(row.idevent, row.rank) for row in rows])
+
+    def test_fetch_entities(self):
+        """Chargement des événements bruts sans requête supplémentaire"""
+        events = queries.fetch_entities(Event, queries.RAW_EVENT_CANDIDATES,
+            idsupitem=self.service.idsupitem, **queries.state_params())
+        self.assertEqual([self.event], events)
+
+    def test_compiled_cache(self):
+        """Les requêtes ne sont compilées qu'une seule fois"""
+        queries._compiled_cache.clear()
+        for _i in xrange(3):
+            queries.fetch_scalar(queries.OPEN_AGGREGATE,
+                idsupitem=self.service.idsupitem, **queries.state_params())
+        self.assertEqual(1, len(queries._compiled_cache))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste le cache des noms d'états."""
+
+import unittest
+
+from vigilo.correlator import statenames
+from vigilo.correlator.test import helpers
+
+from vigilo.models.session import DBSession
+from vigilo.models.tables import StateName
+
+
+class TestStateNames(unittest.TestCase):
+
+    def setUp(self):
+        super(TestStateNames, self).setUp()
+        helpers.setup_db()
+        helpers.populate_statename()
+
+    def tearDown(self):
+        helpers.teardown_db()
+        super(TestStateNames, self).tearDown()
+
+    def test_bidirectional(self):
+        """Conversions nom <-> valeur depuis le cache"""
+        for statename in (u'OK', u'UP', u'DOWN', u'UNKNOWN'):
+            value = DBSession.query(StateName.idstatename).filter(
+                StateName.statename == statename).scalar()
+            self.assertEqual(value, statenames.statename_to_value(statename))
+            self.assertEqual(statename, statenames.value_to_statename(value))
+
+    def test_unknown_statename(self):
+        """Un nom d'état inconnu lève une KeyError"""
+        self.assertRaises(KeyError, statenames.statename_to_value, u'FOO')
+
+    def test_no_query_once_loaded(self):
+        """Aucune requête n'est émise une fois le cache chargé"""
+        statenames.load()
+        DBSession.query(StateName).delete()
+        DBSession.flush()
+        self.assertEqual(0, DBSession.query(StateName).count())
+        statenames.statename_to_value(u'OK')
+
+    def test_reload(self):
+        """Le rechargement prend en compte les nouveaux états"""
+        statenames.load()
+        self.assertRaises(KeyError, statenames.statename_to_value, u'FOO')
+        DBSession.add(StateName(statename=u'FOO', order=4))
+        DBSession.flush()
+        statenames.load()
+        value = statenames.statename_to_value(u'FOO')
+        self.assertEqual(u'FOO', statenames.value_to_statename(value))
+
+    def test_read_only(self):
+        """La table de correspondance est immuable"""
+        mapping = statenames.load()
+        self.assertRaises(AttributeError, setattr, mapping, '_by_name', {})
+
+    def test_not_loaded(self):
+        """Les noms d'états ne sont jamais chargés à la demande"""
+        statenames.reset()
+        self.assertRaises(statenames.StateNamesNotLoaded,
+                          statenames.statename_to_value, u'OK')
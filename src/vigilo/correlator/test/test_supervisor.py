@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste la supervision des processus du corrélateur."""
+
+import json
+import unittest
+
+from nose.twistedtools import reactor  # pylint: disable-msg=W0611
+from nose.twistedtools import deferred
+
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+from vigilo.correlator import supervisor
+from vigilo.correlator.supervisor import Supervisor, WorkerChannel, \
+                                         aggregate_stats, STATUS_FD
+
+
+class ProcessTransportStub(object):
+    """Transport d'un processus simulé"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.written = []
+        self.signals = []
+
+    def write(self, data):
+        self.written.extend(json.loads(line) for line in data.splitlines())
+
+    def signalProcess(self, signame):
+        self.signals.append(signame)
+
+
+class ReactorStub(task.Clock):
+    """Reactor simulant le démarrage de processus"""
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, process, executable, args, env, childFDs):
+        self.spawned.append((process, env))
+        process.makeConnection(ProcessTransportStub(len(self.spawned)))
+
+
+class ProviderStub(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+    def getStats(self):
+        return defer.succeed(self.stats)
+
+
+def _reply(process, stats):
+    process.childDataReceived(STATUS_FD, json.dumps({"stats": stats}) + '\n')
+
+
+class TestAggregateStats(unittest.TestCase):
+
+    def test_aggregate(self):
+        """Agrégation des métriques de plusieurs processus"""
+        stats = aggregate_stats([
+            {"sent": 3, "rule-total": 0.2, "db-rw-exec-p95": 0.5},
+            {"sent": 4, "rule-total": 0.4, "db-rw-exec-p95": 0.1},
+        ])
+        self.assertEqual(7, stats["sent"])
+        self.assertAlmostEqual(0.3, stats["rule-total"])
+        self.assertEqual(0.5, stats["db-rw-exec-p95"])
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = ReactorStub()
+        self.supervisor = Supervisor(2, {"config": "test.ini"}, self.reactor)
+        self.supervisor.startService()
+
+    def test_spawn(self):
+        """Chaque processus connaît son numéro"""
+        self.assertEqual(2, len(self.reactor.spawned))
+        envs = [env[supervisor.WORKER_ENV]
+                for _process, env in self.reactor.spawned]
+        self.assertEqual(["1/2", "2/2"], envs)
+
+    def test_restart(self):
+        """Un processus qui s'arrête est relancé"""
+        process = self.supervisor.processes[2]
+        process.processEnded(failure.Failure(error.ProcessTerminated(1)))
+        self.assertFalse(2 in self.supervisor.processes)
+        self.reactor.advance(self.supervisor.restart_delay)
+        self.assertEqual(3, len(self.reactor.spawned))
+        self.assertEqual(2, self.supervisor.processes[2].number)
+
+    def test_reload(self):
+        """Le signal SIGHUP est transmis à tous les processus"""
+        self.supervisor.reload()
+        for process in self.supervisor.processes.values():
+            self.assertEqual(['HUP'], process.transport.signals)
+
+    @deferred(timeout=60)
+    def test_stop(self):
+        """Les processus ne sont pas relancés après l'arrêt"""
+        d = self.supervisor.stopService()
+        for process in self.supervisor.processes.values():
+            self.assertEqual(['TERM'], process.transport.signals)
+            process.processEnded(failure.Failure(error.ProcessDone(0)))
+        self.reactor.advance(self.supervisor.restart_delay)
+        self.assertEqual(2, len(self.reactor.spawned))
+        return d
+
+    def test_collect(self):
+        """Le processus n°1 reçoit les métriques de tous les processus"""
+        process1 = self.supervisor.processes[1]
+        process2 = self.supervisor.processes[2]
+        process1.childDataReceived(
+            STATUS_FD, json.dumps({"command": "collect"}) + '\n')
+        _reply(process1, {"sent": 1})
+        _reply(process2, {"sent": 2})
+        self.assertEqual({"command": "stats"}, process2.transport.written[0])
+        collected = process1.transport.written[-1]["collected"]
+        self.assertEqual(3, collected["sent"])
+        self.assertEqual(2, collected["workers"])
+
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_collect_timeout(self):
+        """Un processus qui ne répond pas est ignoré"""
+        d = self.supervisor.collectStats()
+        _reply(self.supervisor.processes[1], {"sent": 1})
+        self.reactor.advance(self.supervisor.stats_timeout)
+        stats = yield d
+        self.assertEqual(1, stats["sent"])
+        self.assertEqual(1, stats["workers"])
+
+
+class TestWorkerChannel(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = proto_helpers.StringTransport()
+        self.channel = WorkerChannel(ProviderStub({"sent": 5}))
+        self.channel.makeConnection(self.transport)
+
+    def test_stats(self):
+        """Le processus répond aux demandes de métriques"""
+        self.channel.dataReceived(json.dumps({"command": "stats"}) + '\n')
+        self.assertEqual({"stats": {"sent": 5}},
+                         json.loads(self.transport.value()))
+
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_collect(self):
+        """Les métriques agrégées sont obtenues auprès du superviseur"""
+        d = self.channel.getStats()
+        self.assertEqual({"command": "collect"},
+                         json.loads(self.transport.value()))
+        self.channel.dataReceived(
+            json.dumps({"collected": {"sent": 12}}) + '\n')
+        stats = yield d
+        self.assertEqual({"sent": 12}, stats)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# pylint: disable-msg=C0111,W0212,R0904
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""Teste le préchargement des caches au démarrage."""
+
+import unittest
+
+from nose.twistedtools import reactor  # pylint: disable-msg=W0611
+from nose.twistedtools import deferred
+
+from mock import Mock, patch
+from twisted.internet import defer, task
+
+from vigilo.correlator import supitems, hostservices, statenames
+from vigilo.correlator.warmup import WarmUp
+from vigilo.correlator.db_thread import DummyDatabaseWrapper
+from vigilo.correlator.test import helpers
+
+from vigilo.models.demo import functions
+from vigilo.models.session import DBSession
+from vigilo.models.tables import Host
+
+
+class TestWarmUp(unittest.TestCase):
+
+    def setUp(self):
+        super(TestWarmUp, self).setUp()
+        helpers.setup_db()
+        self.host1 = functions.add_host(u'host1')
+        self.host2 = functions.add_host(u'host2')
+        self.lls1 = functions.add_lowlevelservice(self.host1, u'svc1')
+        event = functions.add_event(self.host2, u'DOWN', u'down')
+        self.correvent = functions.add_correvent([event])
+        self.connection = helpers.ConnectionStub(must_defer=True)
+        self.clock = task.Clock()
+        self.warmup = WarmUp(DummyDatabaseWrapper(True), self.connection,
+                             context_timeout=60, clock=self.clock)
+
+    def tearDown(self):
+        helpers.teardown_db()
+        helpers.ConnectionStub.data = {}
+        super(TestWarmUp, self).tearDown()
+
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_warm_up(self):
+        """Préchargement des caches et des agrégats ouverts"""
+        report = yield self.warmup.run()
+        self.assertTrue(self.warmup.ready.called)
+        self.assertEqual(
+            set(['statenames', 'supitems', 'hlsnames', 'hostservices',
+                 'open_aggregates']),
+            set(report.keys()))
+        self.assertFalse(None in report.values())
+        self.assertEqual(self.lls1.idsupitem,
+                         supitems.lookup(u'host1', u'svc1'))
+        self.assertEqual(self.host2.idhost, supitems.lookup(u'host2'))
+        self.assertNotEqual(None, hostservices.lookup(u'host1'))
+        # Agrégat ouvert sur host2, aucun agrégat sur les autres éléments.
+        data = helpers.ConnectionStub.data
+        self.assertEqual(self.correvent.idcorrevent,
+                         data['shared:open_aggr:%d' % self.host2.idhost])
+        self.assertEqual(0, data['shared:open_aggr:%d' % self.host1.idhost])
+        self.assertEqual(0, data['shared:open_aggr:%d' % self.lls1.idsupitem])
+
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_concurrent_update(self):
+        """Les agrégats ouverts en cours de préchargement sont conservés"""
+        key1 = 'shared:open_aggr:%d' % self.host1.idhost
+        key2 = 'shared:open_aggr:%d' % self.host2.idhost
+        # Valeur déjà présente (enregistrée par une autre instance).
+        helpers.ConnectionStub.data[key2] = 0
+        add_multi = self.connection.add_multi
+        def racing_add_multi(values, *args, **kwargs):
+            # Un agrégat est ouvert sur host1 par une autre instance
+            # entre la lecture de la base et l'écriture dans memcached.
+            helpers.ConnectionStub.data[key1] = 42
+            return add_multi(values, *args, **kwargs)
+        self.connection.add_multi = racing_add_multi
+        yield self.warmup.run()
+        data = helpers.ConnectionStub.data
+        self.assertEqual(42, data[key1])
+        self.assertEqual(0, data[key2])
+        self.assertEqual(0, data['shared:open_aggr:%d' % self.lls1.idsupitem])
+
+    def test_timeout(self):
+        """Le corrélateur démarre même si le préchargement est trop long"""
+        warmup = WarmUp(DummyDatabaseWrapper(True), timeout=5,
+                        clock=self.clock)
+        warmup._start = 0
+        warmup._statenames = True
+        warmup._timer = self.clock.callLater(5, warmup._expire)
+        self.assertFalse(warmup.ready.called)
+        self.clock.advance(5)
+        self.assertTrue(warmup.ready.called)
+
+    def test_timeout_without_statenames(self):
+        """Le délai maximum n'affranchit pas du chargement des noms d'états"""
+        warmup = WarmUp(DummyDatabaseWrapper(True), timeout=5,
+                        clock=self.clock)
+        warmup._start = 0
+        warmup._timer = self.clock.callLater(5, warmup._expire)
+        self.clock.advance(5)
+        self.assertFalse(warmup.ready.called)
+        warmup._statenames_loaded(statenames.StateNameMap([]))
+        self.assertTrue(warmup.ready.called)
+
+    @deferred(timeout=60)
+    @defer.inlineCallbacks
+    def test_statenames_retry(self):
+        """Le chargement des noms d'états est retenté en cas d'échec"""
+        load = Mock(side_effect=[ValueError(), statenames.StateNameMap([])])
+        with patch('vigilo.correlator.statenames.load', load):
+            yield self.warmup.run()
+            self.assertFalse(self.warmup.ready.called)
+            self.clock.advance(self.warmup.retry_delay)
+        self.assertEqual(2, load.call_count)
+        self.assertTrue(self.warmup.ready.called)
+
+
+class TestSupItems(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSupItems, self).setUp()
+        helpers.setup_db()
+        self.host = functions.add_host(u'host1')
+        self.lls = functions.add_lowlevelservice(self.host, u'svc1')
+
+    def tearDown(self):
+        helpers.teardown_db()
+        super(TestSupItems, self).tearDown()
+
+    def test_no_query_once_loaded(self):
+        """Aucune requête n'est émise une fois le cache chargé"""
+        supitems.load()
+        DBSession.query(Host).update({'name': u'renamed'})
+        DBSession.flush()
+        self.assertEqual(self.host.idhost, supitems.get_supitem(u'host1'))
+        self.assertEqual(self.lls.idsupitem,
+                         supitems.get_supitem('host1', 'svc1'))
+
+    def test_missing_from_cache(self):
+        """Les éléments absents du cache sont recherchés puis ajoutés"""
+        supitems.load()
+        host2 = functions.add_host(u'host2')
+        self.assertEqual(None, supitems.lookup(u'host2'))
+        self.assertEqual(host2.idhost, supitems.get_supitem(u'host2'))
+        self.assertEqual(host2.idhost, supitems.lookup(u'host2'))
+        self.assertEqual(None, supitems.get_supitem(u'unknown'))
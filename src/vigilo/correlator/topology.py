@@ -6,17 +6,17 @@
 """Graphe topologique"""
 
 from vigilo.models.session import DBSession
-from sqlalchemy.sql.expression import not_, and_
 
 import networkx as nx
 import networkx.exception as nx_exc
 
 from vigilo.models.tables import Dependency, DependencyGroup
-from vigilo.models.tables import Event, CorrEvent, StateName
 
 from vigilo.common.logging import get_logger
 from vigilo.common.gettext import translate
 
+from vigilo.correlator import queries
+
 LOGGER = get_logger(__name__)
 _ = translate(__name__)
 
@@ -182,20 +182,14 @@ def get_open_aggregate(ctx, database, item_id):
 
         # Sinon on récupère l'information
         # depuis la base de données...
-        state_ok = StateName.statename_to_value('OK')
-        state_up = StateName.statename_to_value('UP')
+        # Ici, on ne prend pas en compte l'état d'acquittement :
+        # on n'agrège jamais une alerte dans un agrégat OK/UP
+        # (voir le ticket #1027 pour plus d'information).
         aggregate = database.run(
-            DBSession.query(
-                CorrEvent.idcorrevent
-            ).join(
-                (Event, CorrEvent.idcause == Event.idevent)
-            ).filter(
-                # Ici, on ne prend pas en compte l'état d'acquittement :
-                # on n'agrège jamais une alerte dans un agrégat OK/UP
-                # (voir le ticket #1027 pour plus d'information).
-                not_(Event.current_state.in_([state_ok, state_up]))
-            ).filter(Event.idsupitem == item_id
-            ).scalar)
+            queries.fetch_scalar,
+            queries.OPEN_AGGREGATE,
+            idsupitem=item_id,
+            **queries.state_params())
 
         # ...et on met à jour le cache avant de retourner l'ID.
         # NB: la valeur 0 est utilisée à la place de None pour que
@@ -204,3 +198,4 @@ def get_open_aggregate(ctx, database, item_id):
         return aggregate
 
     return _fetch_db(res)
+
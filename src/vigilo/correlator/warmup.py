@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Préchargement des caches au démarrage du corrélateur.
+
+Juste après un redémarrage, les caches en mémoire et memcached sont vides :
+chaque événement donne alors lieu à plusieurs requêtes SQL, précisément
+au moment où les messages en attente sur le bus sont les plus nombreux.
+
+Les caches du processus (noms d'états, services de haut niveau, éléments
+supervisés, services de chaque hôte) sont donc chargés en parallèle avant
+la consommation des messages. Les agrégats ouverts sont également
+enregistrés dans memcached en une seule opération (sans écraser les
+valeurs déjà présentes, qui peuvent être plus récentes).
+
+La consommation des messages ne débute qu'une fois le préchargement
+terminé (L{WarmUp.ready}), ou au plus tard à l'expiration du délai
+C{warmup_timeout} : en cas d'échec, le corrélateur fonctionne
+simplement avec des caches froids.
+
+Seuls les noms d'états sont indispensables (ils ne sont jamais chargés
+à la demande, cf. L{vigilo.correlator.statenames}) : la consommation
+des messages attend toujours leur chargement, qui est retenté
+en cas d'échec.
+"""
+
+import time
+
+from twisted.internet import defer
+
+from vigilo.correlator import statenames, hlsnames, hostservices, \
+                              supitems, queries
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+__all__ = (
+    'WarmUp',
+    'warmup_factory',
+)
+
+
+def _fetch_open_aggregates():
+    return queries.fetch_all(queries.OPEN_AGGREGATES,
+                             **queries.state_params())
+
+
+class WarmUp(object):
+    """
+    Préchargement des caches, avec mesure de la durée de chaque étape.
+
+    @ivar ready: Deferred appelé une fois le préchargement terminé
+        (ou le délai maximum écoulé), les noms d'états chargés.
+    @type ready: L{defer.Deferred}
+    @ivar report: Durée (en secondes) de chaque étape,
+        ou C{None} si l'étape a échoué.
+    @type report: C{dict}
+    """
+
+    retry_delay = 5
+
+    def __init__(self, database, connection=None, context_timeout=None,
+                 timeout=60, clock=None):
+        """
+        @param database: Objet qui encapsule les échanges
+            avec la base de données.
+        @type database: L{DatabaseWrapper}
+        @param connection: Connexion à memcached dans laquelle enregistrer
+            les agrégats ouverts (C{None} pour ne pas les précharger).
+        @type connection: L{MemcachedConnection}
+        @param context_timeout: Durée de rétention (en secondes)
+            des agrégats ouverts dans memcached.
+        @type context_timeout: C{float}
+        @param timeout: Délai maximum (en secondes) avant le début
+            de la consommation des messages.
+        @type timeout: C{float}
+        @param clock: Horloge utilisée pour le délai maximum
+            (le reactor de Twisted par défaut).
+        @type clock: C{twisted.internet.interfaces.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._database = database
+        self._connection = connection
+        self._context_timeout = context_timeout
+        self._timeout = timeout
+        self._clock = clock
+        self._timer = None
+        self._start = None
+        self._statenames = False
+        self._done = False
+        self.ready = defer.Deferred()
+        self.report = {}
+
+
+    def _step(self, name, d):
+        start = time.time()
+        def done(result):
+            self.report[name] = round(time.time() - start, 3)
+            return result
+        def failed(failure):
+            self.report[name] = None
+            LOGGER.error(_('Could not warm up the "%(step)s" cache: '
+                           '%(error)s'), {
+                                'step': name,
+                                'error': failure.getErrorMessage(),
+                            })
+            return None
+        d.addCallbacks(done, failed)
+        return d
+
+
+    def _load(self, name, loader, **kwargs):
+        kwargs.setdefault('readonly', True)
+        return self._step(name, self._database.run(
+            loader, transaction=False, **kwargs))
+
+
+    def run(self):
+        """
+        Lance le préchargement de l'ensemble des caches.
+
+        @return: Deferred appelé une fois toutes les étapes terminées,
+            avec la durée de chacune d'elles.
+        @rtype: L{defer.Deferred}
+        """
+        self._start = time.time()
+        if self._timeout and not self.ready.called:
+            self._timer = self._clock.callLater(self._timeout, self._expire)
+
+        d_states = self._load_statenames()
+        d_supitems = self._load('supitems', supitems.load)
+        steps = [
+            d_states,
+            d_supitems,
+            self._load('hlsnames', hlsnames.load),
+            self._load('hostservices', hostservices.load),
+        ]
+        if self._connection is not None:
+            # Les agrégats ouverts sont lus sur la base de données
+            # principale (le réplica peut être en retard).
+            d_aggr = defer.gatherResults([d_states, d_supitems])
+            d_aggr.addCallback(self._store_open_aggregates)
+            steps.append(d_aggr)
+
+        d = defer.DeferredList(steps)
+        d.addCallback(self._finished)
+        return d
+
+
+    def _load_statenames(self):
+        d = self._load('statenames', statenames.load)
+        d.addCallback(self._statenames_loaded)
+        return d
+
+
+    def _statenames_loaded(self, result):
+        if result is None:
+            # Le chargement a échoué (cf. _step) : il est retenté.
+            self._clock.callLater(self.retry_delay, self._load_statenames)
+            return result
+        self._statenames = True
+        if self._done:
+            self._fire()
+        return result
+
+
+    def _fire(self):
+        if self._statenames and not self.ready.called:
+            self.ready.callback(self.report)
+
+
+    def _store_open_aggregates(self, results):
+        known = results[1] or {}
+        d = self._database.run(_fetch_open_aggregates, transaction=False)
+        def store(rows):
+            # La valeur 0 indique l'absence d'agrégat ouvert
+            # (cf. topology.get_open_aggregate).
+            values = dict(('shared:open_aggr:%d' % idsupitem, 0)
+                          for idsupitem in known.itervalues())
+            for idsupitem, idcorrevent in rows:
+                values['shared:open_aggr:%d' % idsupitem] = idcorrevent
+            LOGGER.debug(_('Storing %(open)d open aggregates '
+                           '(%(total)d supervised items)'), {
+                                'open': len(rows),
+                                'total': len(values),
+                            })
+            # Les autres instances du corrélateur (ou les autres processus)
+            # peuvent avoir ouvert ou clos un agrégat depuis la lecture :
+            # seules les clés absentes de memcached sont donc renseignées.
+            return self._connection.add_multi(
+                values, False, time=self._context_timeout)
+        def stored(count):
+            LOGGER.debug(_('%d open aggregates keys were missing '
+                           'from memcached'), count)
+        d.addCallback(store)
+        d.addCallback(stored)
+        return self._step('open_aggregates', d)
+
+
+    def _finished(self, _results):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        total = time.time() - self._start
+        LOGGER.info(_('Caches warmed up in %(total).3fs (%(steps)s)'), {
+            'total': total,
+            'steps': u", ".join(
+                u"%s: %s" % (name, duration is None and u"failed"
+                             or u"%.3fs" % duration)
+                for (name, duration) in sorted(self.report.iteritems())
+            ),
+        })
+        self._done = True
+        if not self._statenames:
+            LOGGER.warning(_('The state names could not be loaded, '
+                             'retrying in %ss'), self.retry_delay)
+        self._fire()
+        return self.report
+
+
+    def _expire(self):
+        self._timer = None
+        self._done = True
+        if not self._statenames:
+            LOGGER.warning(_('The caches could not be warmed up within '
+                             '%ss, waiting for the state names'),
+                           self._timeout)
+        else:
+            LOGGER.warning(_('The caches could not be warmed up within '
+                             '%ss, starting with partially warmed caches'),
+                           self._timeout)
+        self._fire()
+
+
+
+def warmup_factory(settings, database):
+    """
+    Crée l'objet de préchargement des caches au démarrage.
+
+    @param settings: Configuration du corrélateur.
+    @param database: Objet qui encapsule les échanges
+        avec la base de données.
+    @type database: L{DatabaseWrapper}
+    @rtype: L{WarmUp}
+    """
+    from vigilo.correlator.memcached_connection import MemcachedConnection
+    options = settings['correlator']
+
+    def _get(name, default, conv):
+        try:
+            return conv(options[name])
+        except KeyError:
+            return default
+
+    return WarmUp(
+        database,
+        MemcachedConnection(),
+        context_timeout=_get('context_timeout', None, float),
+        timeout=_get('warmup_timeout', 60, float),
+    )